@@ -1,3 +1,19 @@
 from django.contrib import admin
+from .models import Cart, CartLine
 
-# Register your models here.
+
+class CartLineAdminInline(admin.TabularInline):
+    model = CartLine
+    raw_id_fields = ('product',)
+
+
+class CartAdmin(admin.ModelAdmin):
+    inlines = (CartLineAdminInline,)
+
+    readonly_fields = ('created_at', 'updated_at')
+
+    list_display = ('id', 'created_at', 'updated_at')
+
+    ordering = ('-updated_at',)
+
+admin.site.register(Cart, CartAdmin)
@@ -0,0 +1,161 @@
+import json
+
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
+
+from products.models import Product
+from . import cart
+from .contexts import get_bag_totals
+from .models import CartLine
+
+# Quantities accepted for a single line, matching the quantity inputs
+MAX_QUANTITY = 99
+# Largest number of changes accepted in one batch
+MAX_BATCH_CHANGES = 100
+# Longest size a cart line can hold
+MAX_SIZE_LENGTH = CartLine._meta.get_field('size').max_length
+
+
+class BagChangeError(Exception):
+    """ A change that can't be applied, reported back as a 400 """
+
+
+def _error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def _money(value):
+    return f'{value:.2f}'
+
+
+def clean_size(size):
+    """
+    Return a size as text, or None, raising BagChangeError for one a
+    cart line can't hold. The bag forms use this as well as the API.
+    """
+    # Sizes come from JSON as well as forms, so anything but text
+    # (or a number, as in shoe sizes) or nothing at all is refused
+    if isinstance(size, int) and not isinstance(size, bool):
+        size = str(size)
+    if size is not None and not isinstance(size, str):
+        raise BagChangeError(f'Invalid size: {size}')
+    if size and len(size) > MAX_SIZE_LENGTH:
+        raise BagChangeError(f'Sizes can be at most {MAX_SIZE_LENGTH} characters')
+    return size
+
+
+def _parse_change(action, item_id, size, quantity):
+    """ Validate one change, returning it as a cart.apply_changes tuple """
+    if action not in cart.BATCH_ACTIONS:
+        raise BagChangeError(f'Unknown action: {action}')
+    try:
+        product_id = int(item_id)
+    except (TypeError, ValueError):
+        raise BagChangeError(f'Invalid item id: {item_id}')
+    size = clean_size(size)
+    if action == 'remove':
+        return (action, product_id, size or '', 0)
+    try:
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        raise BagChangeError(f'Invalid quantity: {quantity}')
+    # Adding needs at least one item, while setting 0 removes the line
+    minimum = 1 if action == 'add' else 0
+    if not minimum <= quantity <= MAX_QUANTITY:
+        raise BagChangeError(f'Quantity must be between {minimum} and {MAX_QUANTITY}')
+    return (action, product_id, size or '', quantity)
+
+
+def _apply(request, changes):
+    """
+    Apply validated changes to the visitor's cart and return a JSON
+    response with the changed lines and the bag's new totals
+    """
+    product_ids = {change[1] for change in changes}
+    # One query checks every product exists and gets its price
+    prices = dict(Product.objects.filter(id__in=product_ids).values_list('id', 'price'))
+    missing = product_ids - prices.keys()
+    if missing:
+        return _error(f'Products not found: {sorted(missing)}', status=404)
+
+    cart_id = cart.get_cart_id(request, create=True)
+    changed = cart.apply_changes(cart_id, changes)
+
+    # The totals stored with the cart already include the changes
+    contents = get_bag_totals(request, refresh=True)
+    return JsonResponse({
+        'lines': [
+            {
+                'item_id': str(product_id),
+                'size': size or None,
+                'quantity': quantity,
+                'price': _money(prices[product_id]),
+                'subtotal': _money(prices[product_id] * quantity),
+            }
+            for (product_id, size), quantity in changed.items()
+        ],
+        'product_count': contents['product_count'],
+        'total': _money(contents['total']),
+        'discount': _money(contents['discount']),
+        'discount_code': contents['discount_code'],
+        'delivery': _money(contents['delivery']),
+        'free_delivery_delta': _money(contents['free_delivery_delta']),
+        'grand_total': _money(contents['grand_total']),
+    })
+
+
+def _single_change(request, action, item_id):
+    """ Apply one change posted with the same fields as the bag forms """
+    try:
+        change = _parse_change(
+            action, item_id, request.POST.get('product_size'),
+            request.POST.get('quantity'))
+    except BagChangeError as e:
+        return _error(str(e))
+    return _apply(request, [change])
+
+
+@require_POST
+def add_to_bag(request, item_id):
+    """ Add a quantity of a product to the bag, returning the new totals """
+    return _single_change(request, 'add', item_id)
+
+
+@require_POST
+def adjust_bag(request, item_id):
+    """ Set the quantity of a product in the bag, removing it at 0 """
+    return _single_change(request, 'set', item_id)
+
+
+@require_POST
+def remove_from_bag(request, item_id):
+    """ Remove a product, or one size of it, from the bag """
+    return _single_change(request, 'remove', item_id)
+
+
+@require_POST
+def update_bag(request):
+    """
+    Apply many changes to the bag in one request. The body is JSON of
+    the form {"changes": [{"action": "set", "item_id": 1, "size": "m",
+    "quantity": 2}, ...]}, and the changes are applied in order in a
+    single transaction.
+    """
+    try:
+        body = json.loads(request.body)
+        raw_changes = body['changes']
+        if not isinstance(raw_changes, list) or not raw_changes:
+            raise BagChangeError('changes must be a non-empty list')
+        if len(raw_changes) > MAX_BATCH_CHANGES:
+            raise BagChangeError(f'At most {MAX_BATCH_CHANGES} changes can be made at once')
+        changes = [
+            _parse_change(
+                change.get('action'), change.get('item_id'),
+                change.get('size'), change.get('quantity'))
+            for change in raw_changes
+        ]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return _error('Expected a JSON body with a list of changes')
+    except BagChangeError as e:
+        return _error(str(e))
+    return _apply(request, changes)
@@ -0,0 +1,323 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from boutique_ado.money import Money, MoneyField
+from products.catalog import price_version
+from products.models import Product
+from .models import Cart, CartLine
+
+# The session only ever holds the id of the visitor's cart
+CART_SESSION_KEY = 'cart_id'
+# Where bags were kept in the session before carts were stored
+LEGACY_BAG_SESSION_KEY = 'bag'
+
+
+def get_cart_id(request, create=False):
+    """
+    Return the id of the visitor's cart, or None if they don't have
+    one. A new cart is created if create is True, and any bag left in
+    the session from before carts were stored is moved into it.
+    """
+    cart_id = request.session.get(CART_SESSION_KEY)
+    legacy_bag = request.session.get(LEGACY_BAG_SESSION_KEY)
+    # Before changing a cart, make sure it hasn't been deleted
+    if cart_id is not None and create and not Cart.objects.filter(id=cart_id).exists():
+        cart_id = None
+    if cart_id is None and (create or legacy_bag):
+        # An empty cart's totals are right at any price version
+        cart_id = Cart.objects.create(price_version=price_version()).id
+        request.session[CART_SESSION_KEY] = cart_id
+    if legacy_bag:
+        _import_legacy_bag(cart_id, legacy_bag)
+        del request.session[LEGACY_BAG_SESSION_KEY]
+    return cart_id
+
+
+def _import_legacy_bag(cart_id, bag):
+    """ Copy the lines of a session bag into a cart """
+    existing = set(Product.objects.filter(
+        id__in=[item_id for item_id in bag if str(item_id).isdigit()]
+    ).values_list('id', flat=True))
+    lines = []
+    for item_id, item_data in bag.items():
+        if not str(item_id).isdigit() or int(item_id) not in existing:
+            continue
+        if isinstance(item_data, int):
+            lines.append(CartLine(cart_id=cart_id, product_id=item_id, quantity=item_data))
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                lines.append(CartLine(
+                    cart_id=cart_id, product_id=item_id, size=size, quantity=quantity))
+    CartLine.objects.bulk_create(lines, ignore_conflicts=True)
+    refresh_totals(cart_id)
+
+
+def refresh_totals(cart_id):
+    """
+    Recalculate the cart's stored totals from its lines and the current
+    prices. It's a single UPDATE, run when the stored totals are from
+    an older price version and can't just be moved on by a change, so
+    the totals are always written with the lines they describe.
+    """
+    # The version is read first, so a price changed while this runs
+    # leaves the totals on an old version and they're redone later
+    version = price_version()
+    lines = CartLine.objects.filter(cart_id=OuterRef('pk')).order_by().values('cart_id')
+    total = lines.annotate(
+        sum=Sum(F('quantity') * F('product__price'), output_field=MoneyField())
+    ).values('sum')
+    product_count = lines.annotate(sum=Sum('quantity')).values('sum')
+    Cart.objects.filter(id=cart_id).update(
+        total=Coalesce(Subquery(total), Value(0), output_field=MoneyField()),
+        product_count=Coalesce(Subquery(product_count), Value(0), output_field=IntegerField()),
+        price_version=version,
+        updated_at=timezone.now(),
+    )
+
+
+def get_totals(cart_id):
+    """
+    Return the cart's (total, product_count) without reading any
+    products, unless a price has changed since they were stored
+    """
+    row = Cart.objects.filter(id=cart_id).values_list(
+        'total', 'product_count', 'price_version').first()
+    if row is None:
+        return 0, 0
+    total, product_count, version = row
+    if version != price_version():
+        refresh_totals(cart_id)
+        total, product_count = Cart.objects.filter(id=cart_id).values_list(
+            'total', 'product_count').first() or (0, 0)
+    return total, product_count
+
+
+def _line(cart_id, product_id, size):
+    return CartLine.objects.filter(cart_id=cart_id, product_id=product_id, size=size or '')
+
+
+def move_totals(cart_id, differences):
+    """
+    Move the cart's stored totals on by the change in quantity of each
+    product, given as a dict of product id to difference, reading only
+    those products' prices. The totals are moved in the database, so
+    changes made at once can't lose each other's. Totals from an older
+    price version are added up again in full instead.
+    """
+    differences = {product_id: difference
+                   for product_id, difference in differences.items() if difference}
+    if not differences:
+        return
+    # The version is read before the prices, as in refresh_totals
+    version = price_version()
+    prices = dict(Product.objects.filter(id__in=differences).values_list('id', 'price'))
+    if prices.keys() < differences.keys():
+        # A product was deleted, so its lines went with it
+        refresh_totals(cart_id)
+        return
+    amount = sum((prices[product_id] * difference
+                  for product_id, difference in differences.items()), Money())
+    moved = Cart.objects.filter(id=cart_id, price_version=version).update(
+        total=F('total') + Value(amount, output_field=MoneyField()),
+        product_count=F('product_count') + sum(differences.values()),
+        updated_at=timezone.now(),
+    )
+    if not moved:
+        refresh_totals(cart_id)
+
+
+def increment(cart_id, product_id, size, quantity):
+    """
+    Add quantity to a line, creating it if needed, and return the
+    line's new quantity. The addition happens in the database, so
+    requests changing the same line at once can't lose each other's
+    updates.
+    """
+    size = size or ''
+    with transaction.atomic():
+        updated = _line(cart_id, product_id, size).update(quantity=F('quantity') + quantity)
+        if not updated:
+            try:
+                # A savepoint lets the update run again if another
+                # request created the line in the meantime
+                with transaction.atomic():
+                    CartLine.objects.create(
+                        cart_id=cart_id, product_id=product_id, size=size,
+                        quantity=quantity)
+            except IntegrityError:
+                _line(cart_id, product_id, size).update(quantity=F('quantity') + quantity)
+        move_totals(cart_id, {product_id: quantity})
+        return _line(cart_id, product_id, size).values_list('quantity', flat=True).first()
+
+
+def _locked_quantity(cart_id, product_id, size):
+    """ Lock a line, where the database supports it, and return its quantity or 0 """
+    return _line(cart_id, product_id, size).select_for_update().values_list(
+        'quantity', flat=True).first() or 0
+
+
+def set_quantity(cart_id, product_id, size, quantity):
+    """ Set a line to quantity, removing it when quantity isn't positive """
+    if quantity <= 0:
+        remove(cart_id, product_id, size)
+        return 0
+    size = size or ''
+    with transaction.atomic():
+        previous = _locked_quantity(cart_id, product_id, size)
+        updated = _line(cart_id, product_id, size).update(quantity=quantity)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    CartLine.objects.create(
+                        cart_id=cart_id, product_id=product_id, size=size,
+                        quantity=quantity)
+            except IntegrityError:
+                # Another request created the line after it was read
+                previous = _locked_quantity(cart_id, product_id, size)
+                _line(cart_id, product_id, size).update(quantity=quantity)
+        move_totals(cart_id, {product_id: quantity - previous})
+    return quantity
+
+
+def remove(cart_id, product_id, size=None):
+    """
+    Remove a line from the cart. Without a size, every
+    size of the product is removed. Returns True if
+    anything was removed.
+    """
+    lines = CartLine.objects.filter(cart_id=cart_id, product_id=product_id)
+    if size:
+        lines = lines.filter(size=size)
+    with transaction.atomic():
+        quantities = list(lines.select_for_update().values_list('quantity', flat=True))
+        deleted, _ = lines.delete()
+        if deleted:
+            move_totals(cart_id, {product_id: -sum(quantities)})
+    return bool(deleted)
+
+
+# Actions a batch of line changes can contain
+BATCH_ACTIONS = ('add', 'set', 'remove')
+
+
+def apply_changes(cart_id, changes):
+    """
+    Apply a batch of line changes in a single transaction. changes is
+    a list of (action, product_id, size, quantity) tuples, where action
+    is one of BATCH_ACTIONS, and they're applied in order. The cart's
+    lines are read once and written back with one statement for each
+    of deletes, updates and inserts, however many changes there are.
+    Returns the new quantity of every line changed, keyed by (product_id,
+    size), with 0 for lines that were removed.
+    """
+    with transaction.atomic():
+        # The cart is locked first, where the database supports it, so
+        # batches for the same cart run one after the other and each
+        # starts from the lines and totals the last one left
+        Cart.objects.select_for_update().get(pk=cart_id)
+        # Locks the cart's lines too, so single line updates wait for
+        # the batch to finish
+        lines = {
+            (line.product_id, line.size): line
+            for line in CartLine.objects.select_for_update().filter(cart_id=cart_id)
+        }
+        quantities = {key: line.quantity for key, line in lines.items()}
+        original = dict(quantities)
+        changed = {}
+        # Lines whose new quantity doesn't depend on what they held
+        replaced = set()
+
+        for action, product_id, size, quantity in changes:
+            size = size or ''
+            if action == 'remove' and not size:
+                # Removing without a size removes every size of the product
+                keys = [key for key in quantities if key[0] == product_id]
+            else:
+                keys = [(product_id, size)]
+            for key in keys:
+                if action == 'add':
+                    quantities[key] = quantities.get(key, 0) + quantity
+                elif action == 'set':
+                    quantities[key] = quantity
+                    replaced.add(key)
+                else:
+                    quantities[key] = 0
+                    replaced.add(key)
+                changed[key] = max(quantities[key], 0)
+
+        to_delete = []
+        to_update = []
+        to_create = []
+        for key, quantity in changed.items():
+            line = lines.get(key)
+            if quantity <= 0:
+                if line is not None:
+                    to_delete.append(line.id)
+            elif line is None:
+                to_create.append(CartLine(
+                    cart_id=cart_id, product_id=key[0], size=key[1], quantity=quantity))
+            elif line.quantity != quantity:
+                line.quantity = quantity
+                to_update.append(line)
+
+        if to_delete:
+            CartLine.objects.filter(id__in=to_delete).delete()
+        if to_update:
+            CartLine.objects.bulk_update(to_update, ['quantity'])
+        if to_create:
+            try:
+                # A savepoint lets the new lines be written as updates
+                # if a single line change created any of them meanwhile
+                with transaction.atomic():
+                    CartLine.objects.bulk_create(to_create)
+            except IntegrityError:
+                _merge_lines(cart_id, to_create, replaced, changed)
+                refresh_totals(cart_id)
+                return changed
+        if changed:
+            differences = Counter()
+            for key, quantity in changed.items():
+                differences[key[0]] += quantity - original.get(key, 0)
+            move_totals(cart_id, differences)
+    return changed
+
+
+def _merge_lines(cart_id, new_lines, replaced, changed):
+    """
+    Write lines that another request created after the batch read the
+    cart. Lines the batch set keep the batch's quantity, and the
+    batch's additions are added to the other request's quantity, as
+    increment does. changed is updated with the quantities written.
+    """
+    for line in new_lines:
+        key = (line.product_id, line.size)
+        if key in replaced:
+            quantity = line.quantity
+        else:
+            quantity = F('quantity') + line.quantity
+        if not _line(cart_id, *key).update(quantity=quantity):
+            CartLine.objects.create(
+                cart_id=cart_id, product_id=line.product_id, size=line.size,
+                quantity=line.quantity)
+        elif key not in replaced:
+            changed[key] = _line(cart_id, *key).values_list('quantity', flat=True).first()
+
+
+def get_bag(request):
+    """ The visitor's cart in the legacy session bag format """
+    cart_id = get_cart_id(request)
+    if cart_id is None:
+        return {}
+    return Cart(id=cart_id).as_bag()
+
+
+def clear(request):
+    """ Delete the visitor's cart, after their order has been placed """
+    cart_id = request.session.pop(CART_SESSION_KEY, None)
+    request.session.pop(LEGACY_BAG_SESSION_KEY, None)
+    if cart_id is not None:
+        Cart.objects.filter(id=cart_id).delete()
@@ -1,72 +1,123 @@
-from decimal import Decimal
 from django.conf import settings
-from django.shortcuts import get_object_or_404
-from products.models import Product
 
-def bag_contents(request):
+from checkout import pricing
+from . import cart
+from .models import CartLine
+
+# Keys added to every template context by bag_contents
+BAG_CONTEXT_KEYS = (
+    'bag_items', 'total', 'product_count', 'discount', 'discount_code',
+    'delivery', 'free_delivery_delta', 'grand_total',
+)
+
+
+def _priced(request, product_count, lines=None, total=0):
+    """
+    The bag's totals, worked out by the pricing rules from either its
+    lines of (price, quantity) or its stored total. The country isn't
+    known until checkout, so the default delivery tiers are used.
+    """
+    rules = pricing.get_rules()
+    discount_code = request.session.get(pricing.DISCOUNT_SESSION_KEY)
+    if lines is not None:
+        quote = rules.quote(lines, discount_code=discount_code)
+    else:
+        quote = rules.quote_total(total, discount_code=discount_code)
+    totals = quote.as_dict()
+    totals['product_count'] = product_count
+    totals['free_delivery_threshold'] = settings.FREE_DELIVERY_THRESHOLD
+    return totals
+
+
+def get_bag_contents(request, refresh=False):
+    """
+    Resolve the visitor's cart into its items and totals. Every line
+    and its product are fetched with a single query, and the result is
+    kept on the request so the work is only done once however many
+    times it's used. Pass refresh=True after changing the cart.
+    Totals here always use the products' current prices.
+    """
+    cached = getattr(request, '_bag_contents', None)
+    if cached is not None and not refresh:
+        return cached
 
     bag_items = []
-    total = 0
+    prices = []
     product_count = 0
-    bag = request.session.get('bag', {})
-
-    for item_id, item_data in bag.items():
-        # Only execute this code if the item has no sizes
-        # Checks to see if item data is an integer, if it
-        # is, we are dealing with the quantity only.
-        if isinstance(item_data, int):
-            # Gets product and id
-            product = get_object_or_404(Product, pk=item_id)
-            # Adds quantity multiplied by price to total
-            total += item_data * product.price
-            # Increment product count by quantity
-            product_count += item_data
-            # Adding dictionary to list of bag items
-            # Product object is added to give access to other product fields such as product.image etc
-            bag_items.append({
-                'item_id': item_id,
-                'quantity': item_data,
-                'product': product,
-            })
-        # If item has a size, we need to iterate through a dictionary
-        else:
-            product = get_object_or_404(Product, pk=item_id)
-            # Iterate through inner dictionary of items_by_size
-            for size, quantity in item_data['items_by_size'].items():
-                # incrementing product and total count accordingly
-                total += quantity * product.price
-                product_count += quantity
-                # Add size the bag_items returned to the template
-                bag_items.append({
-                    'item_id': item_id,
-                    'quantity': quantity,
-                    'product': product,
-                    'size': size,
-            })
-
-    # Calculates delivery under threshold by multiplying
-    # standard delivery percentage by total price
-    if total < settings.FREE_DELIVERY_THRESHOLD:
-        # total is calulated using Decimal() method as it is more accurate
-        delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
-        # Variable calculates how much more user has to spend for free delivery
-        free_delivery_delta = settings.FREE_DELIVERY_THRESHOLD - total
-    # Sets delivery to 0 if total is over threshold
+
+    # Visitors who have never added anything have no cart to load.
+    # Lines are removed along with their product, so a product deleted
+    # while it was in the bag simply drops out of it.
+    cart_id = cart.get_cart_id(request)
+    lines = []
+    if cart_id is not None:
+        lines = CartLine.objects.filter(cart_id=cart_id).select_related('product').order_by('id')
+
+    for line in lines:
+        product = line.product
+        # Price and quantity are handed to the pricing rules to total up
+        prices.append((product.price, line.quantity))
+        # Increment product count by quantity
+        product_count += line.quantity
+        # Adding dictionary to list of bag items
+        # Product object is added to give access to other product fields such as product.image etc
+        item = {
+            'item_id': str(product.id),
+            'quantity': line.quantity,
+            'product': product,
+        }
+        # Lines for products with sizes also pass their size to the template
+        if line.size:
+            item['size'] = line.size
+        bag_items.append(item)
+
+    contents = _priced(request, product_count, lines=prices)
+    contents['bag_items'] = bag_items
+    request._bag_contents = contents
+    return contents
+
+
+def get_bag_totals(request, refresh=False):
+    """
+    The bag's totals without its items. They come from the totals
+    stored on the cart, so only the cart's own row is read, unless the
+    bag has already been resolved for this request. Pass refresh=True
+    after changing the cart.
+    """
+    if not refresh:
+        cached = getattr(request, '_bag_contents', None) or getattr(request, '_bag_totals', None)
+        if cached is not None:
+            return cached
     else:
-        delivery = 0
-        free_delivery_delta = 0
-    
-    grand_total = delivery + total
-    
-    # Add all items to context for use in templates across the site
-    context = {
-        'bag_items': bag_items,
-        'total': total,
-        'product_count': product_count,
-        'delivery': delivery,
-        'free_delivery_delta': free_delivery_delta,
-        'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
-        'grand_total': grand_total,
-    }
-
-    return context
\ No newline at end of file
+        # Items resolved before the change are out of date too
+        request._bag_contents = None
+
+    cart_id = cart.get_cart_id(request)
+    total, product_count = cart.get_totals(cart_id) if cart_id is not None else (0, 0)
+    totals = _priced(request, product_count, total=total)
+    request._bag_totals = totals
+    return totals
+
+
+def bag_contents(request):
+
+    # Pages served from the shared page cache load the bag separately
+    if getattr(request, 'deferred_personalization', False):
+        return {
+            'deferred_personalization': True,
+            'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
+        }
+
+    # Add all items to context for use in templates across the site.
+    # Each value is a function, which templates call when they first
+    # use it, so pages that never show the bag don't load it at all.
+    # The header and other totals only need the cart's stored totals,
+    # so products are only read by templates that list the items.
+    def lazy(key):
+        if key == 'bag_items':
+            return lambda: get_bag_contents(request)[key]
+        return lambda: get_bag_totals(request)[key]
+
+    context = {key: lazy(key) for key in BAG_CONTEXT_KEYS}
+    context['free_delivery_threshold'] = settings.FREE_DELIVERY_THRESHOLD
+    return context
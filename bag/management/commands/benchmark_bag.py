@@ -0,0 +1,93 @@
+import statistics
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory
+
+from bag.cart import CART_SESSION_KEY, refresh_totals
+from bag.contexts import bag_contents, get_bag_contents, get_bag_totals
+from bag.models import Cart, CartLine
+from boutique_ado.queries import QueryRecorder
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = ('Time resolving bags of growing sizes, showing the number '
+            'of queries stays the same however many items they hold')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='*', type=int, default=[1, 10, 50, 100, 200],
+            help='Numbers of distinct products to put in the bag')
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='Number of times each bag is timed')
+
+    def handle(self, *args, **options):
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        largest = max(options['sizes'])
+        if len(product_ids) < largest:
+            raise CommandError(
+                f'Only {len(product_ids)} products exist, fewer than the '
+                f'largest bag of {largest}. Import more with import_catalog.')
+
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        factory = RequestFactory()
+
+        with transaction.atomic():
+            self._benchmark(options, product_ids, session_store, factory)
+            # The carts built for the benchmark are always discarded
+            transaction.set_rollback(True)
+
+    def _benchmark(self, options, product_ids, session_store, factory):
+        self.stdout.write('items  queries  resolve ms  reuse ms  totals ms')
+        for size in options['sizes']:
+            cart = Cart.objects.create()
+            CartLine.objects.bulk_create([
+                CartLine(cart=cart, product_id=product_id, quantity=1)
+                for product_id in product_ids[:size]
+            ])
+            refresh_totals(cart.id)
+            resolve_times = []
+            reuse_times = []
+            totals_times = []
+            for _ in range(options['repeat']):
+                request = factory.get('/bag/')
+                request.session = session_store()
+                request.session[CART_SESSION_KEY] = cart.id
+
+                with QueryRecorder() as recorder:
+                    start = time.perf_counter()
+                    get_bag_contents(request)
+                    resolve_times.append((time.perf_counter() - start) * 1000)
+
+                # A second use in the same request comes from the memo
+                start = time.perf_counter()
+                get_bag_contents(request)
+                reuse_times.append((time.perf_counter() - start) * 1000)
+
+                # The header's totals come from the cart's row alone
+                request = factory.get('/')
+                request.session = session_store()
+                request.session[CART_SESSION_KEY] = cart.id
+                start = time.perf_counter()
+                get_bag_totals(request)
+                totals_times.append((time.perf_counter() - start) * 1000)
+
+            self.stdout.write(
+                f'{size:>5}  {recorder.count:>7}  '
+                f'{statistics.median(resolve_times):>10.2f}  '
+                f'{statistics.median(reuse_times):>8.3f}  '
+                f'{statistics.median(totals_times):>9.2f}')
+
+        # Pages that never use the bag values don't resolve the bag
+        request = factory.get('/')
+        request.session = session_store()
+        request.session[CART_SESSION_KEY] = cart.id
+        with QueryRecorder() as recorder:
+            bag_contents(request)
+        self.stdout.write(
+            f'Context processor on a page not showing the bag: {recorder.count} queries')
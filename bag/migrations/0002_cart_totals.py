@@ -0,0 +1,28 @@
+# Generated by Django 3.2.23 on 2026-10-18 12:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bag', '0001_cart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='price_version',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='product_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+import boutique_ado.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bag', '0002_cart_totals'),
+    ]
+
+    operations = boutique_ado.money.cents_migration(
+        'bag.Cart', 'total',
+        models.DecimalField(max_digits=10, decimal_places=2, default=0),
+        boutique_ado.money.MoneyField(default=0),
+    )
@@ -1,3 +1,61 @@
 from django.db import models
 
-# Create your models here.
+from boutique_ado.money import MoneyField
+
+from products.models import Product
+
+
+class Cart(models.Model):
+    """
+    A shopping bag stored in the database. The session only holds
+    the cart's id, and each product and size is a separate CartLine
+    so lines can be changed without rewriting the whole bag.
+    """
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Running totals, updated whenever the lines change so the bag's
+    # totals can be shown without reading any products. They were
+    # calculated with the prices at price_version, and are
+    # recalculated when that's no longer the current version.
+    total = MoneyField(default=0)
+    product_count = models.PositiveIntegerField(default=0)
+    price_version = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Cart {self.id}'
+
+    def as_bag(self, lines=None):
+        """
+        The cart in the format the session bag used, {product_id:
+        quantity} or {product_id: {'items_by_size': {size: quantity}}}.
+        Stripe metadata and Order.original_bag keep using this format.
+        """
+        if lines is None:
+            lines = self.lines.order_by('id')
+        bag = {}
+        for line in lines:
+            item_id = str(line.product_id)
+            if line.size:
+                bag.setdefault(item_id, {'items_by_size': {}})
+                bag[item_id]['items_by_size'][line.size] = line.quantity
+            else:
+                bag[item_id] = line.quantity
+        return bag
+
+
+class CartLine(models.Model):
+    """ The quantity of one product, in one size, in a cart """
+
+    class Meta:
+        unique_together = ('cart', 'product', 'size')
+
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='lines')
+    # Lines are removed along with their product, so a product
+    # deleted from the store drops out of every cart holding it
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='cart_lines')
+    # Blank for products that don't have sizes
+    size = models.CharField(max_length=10, blank=True, default='')
+    quantity = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product} in cart {self.cart_id}'
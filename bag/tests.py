@@ -1,3 +1,180 @@
+import json
+from unittest import mock
+
 from django.test import TestCase
 
-# Create your tests here.
+from boutique_ado.money import Money
+from boutique_ado.testing import QueryBudgetMixin
+from products.catalog import price_version
+from products.tests import make_catalog
+from . import cart
+from .models import Cart, CartLine
+
+
+class BagViewQueryTests(QueryBudgetMixin, TestCase):
+    """ The bag page stays within its budget in QUERY_BUDGETS """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog(categories=1)
+
+    def add(self, product, quantity=1, size=None):
+        data = {'quantity': quantity, 'redirect_url': '/bag/'}
+        if size:
+            data['product_size'] = size
+        self.client.post(f'/bag/add/{product.id}/', data)
+
+    def test_empty_bag(self):
+        response = self.assertWithinQueryBudget('/bag/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_bag_with_many_lines(self):
+        for product in self.products:
+            if product.has_sizes:
+                for size in ('s', 'm', 'l'):
+                    self.add(product, size=size)
+            else:
+                self.add(product, quantity=2)
+        # Shows the messages left by adding, which are then removed
+        # from the session, so only the bag itself is measured
+        self.client.get('/bag/')
+
+        response = self.assertWithinQueryBudget('/bag/')
+        self.assertEqual(response.status_code, 200)
+        for product in self.products:
+            self.assertContains(response, product.name)
+
+
+class CartTotalsTests(TestCase):
+    """ Totals moved on by each batch match adding up the lines again """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog(categories=1, products_per_category=4)
+
+    def setUp(self):
+        self.cart_id = Cart.objects.create(price_version=price_version()).id
+
+    def assertTotalsMatchLines(self):
+        stored = Cart.objects.get(id=self.cart_id)
+        lines = CartLine.objects.filter(cart_id=self.cart_id).select_related('product')
+        self.assertEqual(stored.total, sum((line.product.price * line.quantity for line in lines), Money()))
+        self.assertEqual(stored.product_count, sum(line.quantity for line in lines))
+
+    def test_batches(self):
+        first, second, third, fourth = (product.id for product in self.products)
+        for changes in (
+            [('add', first, '', 2), ('add', second, 'm', 1), ('add', second, 'l', 3)],
+            [('add', first, '', 1), ('set', second, 'm', 5), ('add', third, '', 4)],
+            [('remove', second, '', 0), ('set', third, '', 0), ('add', fourth, 's', 2)],
+            [('remove', third, 'xl', 0), ('set', first, '', 1)],
+        ):
+            cart.apply_changes(self.cart_id, changes)
+            self.assertTotalsMatchLines()
+
+    def test_single_line_changes(self):
+        first, second = self.products[0].id, self.products[1].id
+        # With the totals current, they're only ever moved on
+        with mock.patch.object(cart, 'refresh_totals', side_effect=AssertionError('added up')):
+            for change in (
+                lambda: cart.increment(self.cart_id, first, '', 2),
+                lambda: cart.increment(self.cart_id, first, '', 1),
+                lambda: cart.increment(self.cart_id, second, 'm', 4),
+                lambda: cart.set_quantity(self.cart_id, second, 'l', 2),
+                lambda: cart.set_quantity(self.cart_id, second, 'm', 1),
+                lambda: cart.set_quantity(self.cart_id, first, '', 0),
+                lambda: cart.remove(self.cart_id, second, 'l'),
+                lambda: cart.increment(self.cart_id, second, 's', 3),
+                lambda: cart.remove(self.cart_id, second),
+            ):
+                change()
+                self.assertTotalsMatchLines()
+
+    def test_single_line_change_after_price_change(self):
+        cart.increment(self.cart_id, self.products[0].id, '', 2)
+        product = self.products[0]
+        product.price = '50.00'
+        product.save()
+        cart.set_quantity(self.cart_id, self.products[1].id, '', 3)
+        self.assertTotalsMatchLines()
+        self.assertEqual(Cart.objects.get(id=self.cart_id).price_version, price_version())
+
+    def test_price_change(self):
+        cart.apply_changes(self.cart_id, [('add', self.products[0].id, '', 2)])
+        product = self.products[1]
+        product.price = '123.45'
+        product.save()
+        # The stored totals are from an older price version, so they're
+        # added up again rather than moved on
+        cart.apply_changes(self.cart_id, [('add', product.id, '', 1)])
+        self.assertTotalsMatchLines()
+        self.assertEqual(Cart.objects.get(id=self.cart_id).price_version, price_version())
+
+    def test_line_created_meanwhile(self):
+        first, second = self.products[0].id, self.products[1].id
+        select_for_update = CartLine.objects.select_for_update
+
+        class ReadThenCreate:
+            """ Another request adds the same products just after the batch reads the lines """
+            def filter(self, **lookups):
+                lines = list(select_for_update().filter(**lookups))
+                CartLine.objects.create(cart_id=lookups['cart_id'], product_id=first, quantity=1)
+                CartLine.objects.create(cart_id=lookups['cart_id'], product_id=second, quantity=4)
+                return lines
+
+        with mock.patch.object(CartLine.objects, 'select_for_update', ReadThenCreate):
+            changed = cart.apply_changes(
+                self.cart_id, [('add', first, '', 2), ('set', second, '', 3)])
+        self.assertEqual(changed, {(first, ''): 3, (second, ''): 3})
+        self.assertEqual(
+            dict(CartLine.objects.filter(cart_id=self.cart_id).values_list('product_id', 'quantity')),
+            {first: 3, second: 3})
+        self.assertTotalsMatchLines()
+
+
+class BagApiTests(TestCase):
+    """ Changes the bag API can't apply are refused with a 400 """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_catalog(categories=1, products_per_category=1)[0]
+
+    def update(self, **change):
+        change = {'action': 'add', 'item_id': self.product.id, 'quantity': 1, **change}
+        return self.client.post(
+            '/bag/api/update/', json.dumps({'changes': [change]}),
+            content_type='application/json')
+
+    def test_sizes(self):
+        for size in ('m', None, 42):
+            response = self.update(size=size)
+            self.assertEqual(response.status_code, 200, size)
+        self.assertEqual(
+            set(CartLine.objects.values_list('size', flat=True)), {'m', '', '42'})
+
+    def test_invalid_sizes(self):
+        for size in (['m'], {'size': 'm'}, True, 4.5, 'x' * 11):
+            response = self.update(size=size)
+            self.assertEqual(response.status_code, 400, size)
+        self.assertFalse(CartLine.objects.exists())
+
+
+class BagFormTests(TestCase):
+    """ The bag forms refuse the same sizes as the bag API """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_catalog(categories=1, products_per_category=1)[0]
+
+    def test_oversized_size(self):
+        for url in (f'/bag/add/{self.product.id}/', f'/bag/adjust/{self.product.id}/'):
+            response = self.client.post(url, {
+                'quantity': 1, 'product_size': 'x' * 11, 'redirect_url': '/bag/'}, follow=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'Sizes can be at most 10 characters')
+        self.assertFalse(CartLine.objects.exists())
+
+    def test_size(self):
+        self.client.post(f'/bag/add/{self.product.id}/', {
+            'quantity': 2, 'product_size': 'xl', 'redirect_url': '/bag/'})
+        self.assertEqual(list(CartLine.objects.values_list('size', 'quantity')), [('xl', 2)])
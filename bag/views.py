@@ -1,7 +1,11 @@
 from django.shortcuts import render, redirect, reverse, HttpResponse, get_object_or_404
 from django.contrib import messages
+from django.views.decorators.http import require_POST
 
+from checkout import pricing
 from products.models import Product
+from . import cart
+from .api import BagChangeError, clean_size
 
 # Create your views here.
 
@@ -25,49 +29,32 @@ def add_to_bag(request, item_id):
     # the size variable will be set to that value
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-
-    # Stores users shopping bag contents in browser session so
-    # that they can browse the site while the contents are saved.
-    
-    # Create a variable named bag that accesses request session trying
-    # to get this variable if it already exists, and initialising it to
-    # an empty dictionary if it doesnt.
-    bag = request.session.get('bag', {})
+    try:
+        size = clean_size(size)
+    except BagChangeError as e:
+        messages.error(request, f'Error adding {product.name} to your bag: {e}')
+        return redirect(redirect_url)
+
+    # The bag is stored in the database as a cart, with one line for
+    # each product and size. Only the cart id is kept in the session.
+    cart_id = cart.get_cart_id(request, create=True)
+    # The quantity is added in a single update, so adding from two
+    # tabs at once can't lose either addition
+    new_quantity = cart.increment(cart_id, product.id, size, quantity)
 
     if size:
-        # If the item is already in the bag, we check to see if an item with the
-        # same id and size already exists, and if so, increment the quantity for
-        # that size. Otherwise, set it equal to the quantity since the item already
-        # exists in the bag but this is a new size for that item.
-        if item_id in list(bag.keys()):
-            if size in bag[item_id]['items_by_size'].keys():
-                bag[item_id]['items_by_size'][size] += quantity
-                messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')
-            else:
-                bag[item_id]['items_by_size'][size] = quantity
-                messages.success(request, f'Added size {size.upper()} {product.name} to your bag')
-        # If the item is not already in the bag, it is added as a dictionary
-        # with the key of items_by_size as there may be multiple items with
-        # the same id but a different size. This allows us to structure the
-        # bag so that we can have a single item id for each item but still
-        # track multiple sizes.
+        # Adding a size already in the bag increases its quantity
+        if new_quantity > quantity:
+            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {new_quantity}')
         else:
-            bag[item_id] = {'items_by_size': {size: quantity}}
             messages.success(request, f'Added size {size.upper()} {product.name} to your bag')
     # If there is no size, this code is run
     else:
-        # If there is already an id in the bag dictionary matching the product
-        # id selected by the user, the quantity value in incremented
-        if item_id in list(bag.keys()):
-            bag[item_id] += quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')
-        # creating key of products id and set equal to quantity
+        if new_quantity > quantity:
+            messages.success(request, f'Updated {product.name} quantity to {new_quantity}')
         else:
-            bag[item_id] = quantity
             messages.success(request, f'Added {product.name} to your bag')
 
-    # overwriting bag variable in session
-    request.session['bag'] = bag
     return redirect(redirect_url)
 
 
@@ -79,43 +66,28 @@ def adjust_bag(request, item_id):
     size = None
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-    bag = request.session.get('bag', {})
+    try:
+        size = clean_size(size)
+    except BagChangeError as e:
+        messages.error(request, f'Error updating {product.name}: {e}')
+        return redirect(reverse('view_bag'))
+    cart_id = cart.get_cart_id(request, create=True)
 
-    # The below if else operations are basically the same, they just have
-    # to be handled differently due to the complex structure of the bag
-    # for items that have sizes
+    # Sets the line for this product and size to the submitted
+    # quantity, removing it from the bag if the quantity is 0
+    cart.set_quantity(cart_id, product.id, size, quantity)
 
-    # If the item has a size the below code is executed
     if size:
-        # If quantity is greater than 0, set quantity to specified input
         if quantity > 0:
-            # Drill into items_by_size dictionary, find that specific size,
-            # and set its quantity to the updated or remove it if the quantity
-            # submittit is 0.
-            bag[item_id]['items_by_size'][size] = quantity
-            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')
-        # Otherwise delete the item if the quantity is set to 0
+            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {quantity}')
         else:
-            del bag[item_id]['items_by_size'][size]
-            # If that item was the only size the user had it the bag,
-            # this will cause the items_by_size dictionary to be empty
-            # which will evaluate to false. pop() method is used to remove
-            # the entire item id so we dont end up with an empty dictionary.
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
             messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')
-    # If the item does not have a size the following code is executed
     else:
         if quantity > 0:
-            # Set quantity value to updated quantity
-            bag[item_id] = quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')
+            messages.success(request, f'Updated {product.name} quantity to {quantity}')
         else:
-            # Removes item entirely by using pop function
-            bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
-        
-    request.session['bag'] = bag
+
     return redirect(reverse('view_bag'))
 
 
@@ -127,23 +99,40 @@ def remove_from_bag(request, item_id):
         size = None
         if 'product_size' in request.POST:
             size = request.POST['product_size']
-        bag = request.session.get('bag', {})
+        cart_id = cart.get_cart_id(request)
 
-        # If the user removes an item that has a size
+        # Removes just the given size, or every size of the product
+        # when there isn't one
+        if cart_id is not None:
+            cart.remove(cart_id, product.id, size)
         if size:
-            # Deletes the size key in items_by_size dictionary
-            del bag[item_id]['items_by_size'][size]
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
             messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')
-        # If there is no size, we pop the item out of the bag
         else:
-            bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
-            
-        request.session['bag'] = bag
+
         return HttpResponse(status=200)
 
     except Exception as e:
         messages.error(request, f'Error removing item: {e}')
         return HttpResponse(status=500)
+
+
+@require_POST
+def apply_discount(request):
+    """ Apply a discount code to the bag, or remove it if none is given """
+
+    code = request.POST.get('discount_code', '').strip()
+    if not code:
+        request.session.pop(pricing.DISCOUNT_SESSION_KEY, None)
+        messages.success(request, 'Removed your discount code')
+        return redirect(reverse('view_bag'))
+
+    # Codes are checked against the compiled pricing rules, the same
+    # ones used to price the bag and the order
+    discount = pricing.get_rules().discount_for(code)
+    if discount is None:
+        messages.error(request, f'Sorry, {code} is not a valid discount code')
+    else:
+        request.session[pricing.DISCOUNT_SESSION_KEY] = discount.code
+        messages.success(request, f'Applied discount code {discount.code}')
+    return redirect(reverse('view_bag'))
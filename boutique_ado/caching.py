@@ -0,0 +1,79 @@
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends import db
+from django.http import HttpResponse
+
+from products.catalog import catalog_version
+from .queries import cache_queries
+
+
+def _cache_queries(method):
+    @wraps(method)
+    def wrapped(self, *args, **kwargs):
+        with cache_queries():
+            return method(self, *args, **kwargs)
+    return wrapped
+
+
+class DatabaseCache(db.DatabaseCache):
+    """
+    Django's database cache, with its queries marked so query budgets
+    and N+1 detection leave them out
+    """
+    get_many = _cache_queries(db.DatabaseCache.get_many)
+    _base_set = _cache_queries(db.DatabaseCache._base_set)
+    _base_delete_many = _cache_queries(db.DatabaseCache._base_delete_many)
+    has_key = _cache_queries(db.DatabaseCache.has_key)
+    clear = _cache_queries(db.DatabaseCache.clear)
+
+
+def _page_cache_key(request):
+    """
+    Cached pages are keyed by their full url and the catalog
+    version, so they're replaced as soon as a product changes
+    """
+    key_source = f'{catalog_version()}:{request.get_full_path()}'
+    return 'page:' + hashlib.md5(key_source.encode()).hexdigest()
+
+
+def anonymous_page_cache(view):
+    """
+    Serve the view to anonymous visitors from a shared page cache when
+    FULL_PAGE_CACHE is on. Pages are rendered with the bag, messages
+    and CSRF token left out, for base.html to load them afterwards.
+    Forms on these pages leave an empty csrfmiddlewaretoken input in
+    place of {% csrf_token %} while deferred_personalization is set.
+    """
+    @wraps(view)
+    def wrapped_view(request, *args, **kwargs):
+        if (not settings.FULL_PAGE_CACHE or request.method != 'GET'
+                or request.user.is_authenticated):
+            return view(request, *args, **kwargs)
+
+        # Tells the bag context processor and base.html to
+        # leave out anything specific to this visitor
+        request.deferred_personalization = True
+
+        key = _page_cache_key(request)
+        cached = caches['pages'].get(key)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+            response['X-Page-Cache'] = 'hit'
+            return response
+
+        response = view(request, *args, **kwargs)
+        # Only the content is stored, never the cookies or headers
+        # set for the visitor who happened to render the page. A page
+        # that rendered a CSRF token holds this visitor's secret, so
+        # it's never shared.
+        if (response.status_code == 200 and not response.streaming
+                and not request.META.get('CSRF_COOKIE_USED')):
+            caches['pages'].set(key, (response.content, response['Content-Type']))
+            response['X-Page-Cache'] = 'miss'
+        return response
+
+    return wrapped_view
@@ -0,0 +1,83 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Apps whose tables are always read from the primary. A session created
+# on one request has to be found on the next, before any replica could
+# have caught up, and stock and the database cache's versions have to
+# be read as they are now. Writes to them don't pin the request to the
+# primary.
+PRIMARY_ONLY_APPS = {'sessions', 'sessionstore', 'inventory', 'django_cache'}
+
+
+class RoutingState:
+    """ Whether the current request may read from the replicas """
+
+    def __init__(self, use_replicas):
+        self.use_replicas = use_replicas
+        self.wrote = False
+
+
+# Code running outside a request, such as management commands and
+# background threads, has no state and always uses the primary
+_state = ContextVar('database_routing', default=None)
+
+
+def reads_from_replicas():
+    """ True if reads made now may be sent to a replica """
+    state = _state.get()
+    return (
+        state is not None and state.use_replicas and not state.wrote
+        and bool(settings.DATABASE_REPLICAS)
+        # Reads inside a transaction must see the writes made in it
+        and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+    )
+
+
+@contextmanager
+def routing(use_replicas):
+    """ Route reads made within the block, usually a single request """
+    state = RoutingState(use_replicas)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+    Send writes to the primary (default) database and spread reads
+    across DATABASE_REPLICAS. Once a request has written anything, the
+    rest of its reads go to the primary too, and ReplicaPinningMiddleware
+    keeps the session's later requests there for a short while.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in PRIMARY_ONLY_APPS:
+            return DEFAULT_DB_ALIAS
+        if not reads_from_replicas():
+            return DEFAULT_DB_ALIAS
+        # Related objects are read from the replica their parent came from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every database holds the same data, so objects
+        # read from any of them can be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema through replication from the primary
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,115 @@
+import logging
+import time
+
+from django.conf import settings
+
+from products.catalog import versions_for_request
+
+from .db_routers import routing
+from .queries import QueryRecorder
+
+logger = logging.getLogger(__name__)
+
+
+def view_name(request):
+    """ The url name of the view that handled the request, if any """
+    match = getattr(request, 'resolver_match', None)
+    return match.url_name if match else None
+
+
+class QueryBudgetMiddleware:
+    """
+    Count the queries and database time for each request, flag
+    repeated query shapes (N+1 patterns) and views that go over
+    their budget in QUERY_BUDGETS, and report them in the logs
+    and optionally in response headers
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+
+        name = view_name(request)
+        budget = settings.QUERY_BUDGETS.get(name)
+        duplicates = recorder.duplicates(settings.QUERY_DUPLICATE_THRESHOLD)
+
+        if settings.QUERY_BUDGET_HEADERS:
+            response['X-DB-Query-Count'] = recorder.count
+            response['X-DB-Time-Ms'] = f'{recorder.duration_ms:.1f}'
+            response['X-DB-Cache-Queries'] = recorder.cache_count
+            response['X-DB-Duplicate-Queries'] = sum(count for shape, count in duplicates)
+            if budget is not None:
+                response['X-DB-Query-Budget'] = budget
+
+        if budget is not None and recorder.count > budget:
+            logger.warning(
+                '%s %s ran %d queries (%.1fms), over its budget of %d',
+                request.method, request.path, recorder.count,
+                recorder.duration_ms, budget)
+        for shape, count in duplicates:
+            logger.warning(
+                'Possible N+1 on %s %s: query ran %d times: %s',
+                request.method, request.path, count, shape)
+
+        return response
+
+
+class ReplicaPinningMiddleware:
+    """
+    Decide whether each request may read from the database replicas.
+    Unsafe methods, paths in DATABASE_PRIMARY_PATHS and any request
+    in the REPLICA_PIN_SECONDS after one that wrote to the database
+    use the primary, so a visitor always reads their own writes.
+    """
+
+    cookie_name = 'db_primary_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def pinned(self, request):
+        """ True if the request has to read from the primary """
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            return True
+        if request.path.startswith(settings.DATABASE_PRIMARY_PATHS):
+            return True
+        try:
+            pinned_until = float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            return False
+        return pinned_until > time.time()
+
+    def __call__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+
+        with routing(use_replicas=not self.pinned(request)) as state:
+            response = self.get_response(request)
+
+        if state.wrote:
+            # The replicas may not have this request's writes yet, so
+            # the visitor's next few requests keep to the primary. A
+            # cookie works for anonymous visitors and needs no query.
+            seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(
+                self.cookie_name, f'{time.time() + seconds:.3f}',
+                max_age=seconds, httponly=True, samesite='Lax',
+                secure=request.is_secure())
+        return response
+
+
+class CatalogVersionMiddleware:
+    """
+    Read the catalog and price versions from the shared cache at most
+    once a request, however many cache keys are built from them
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with versions_for_request():
+            return self.get_response(request)
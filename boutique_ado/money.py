@@ -0,0 +1,234 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import migrations, models
+from django.db.models.functions import Cast, Round
+from django.db.models.query_utils import DeferredAttribute
+
+# Prices are in dollars, with 100 cents to the dollar
+MINOR_UNITS = 100
+# Percentages are given in basis points, hundredths of a percent
+BASIS_POINTS = 10000
+
+
+def divide_rounding_half_up(numerator, denominator):
+    """ Integer division, with halves rounded away from zero """
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if remainder * 2 >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def basis_points(percentage):
+    """ Convert a percentage, such as Decimal('12.5'), to basis points """
+    return int((Decimal(str(percentage)) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+class Money:
+    """
+    An amount of money held as a whole number of cents. Adding up
+    and multiplying amounts is plain integer arithmetic, so totals are
+    exact and there's no rounding until a percentage is taken.
+
+    Build one from cents with Money(1999), or from an amount in dollars
+    with Money.parse('19.99'). Floats are refused, as they can't hold
+    most amounts exactly.
+    """
+    __slots__ = ('cents',)
+
+    def __init__(self, cents=0):
+        if isinstance(cents, bool) or not isinstance(cents, int):
+            raise TypeError(f'Money needs a whole number of cents, not {cents!r}')
+        self.cents = cents
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Return value as Money. Strings, Decimals and ints are amounts
+        in dollars, with anything past the cent rounded half up.
+        """
+        if isinstance(value, Money):
+            return value
+        if isinstance(value, float):
+            raise TypeError('Amounts must be given as strings or Decimals, not floats')
+        if isinstance(value, int) and not isinstance(value, bool):
+            return cls(value * MINOR_UNITS)
+        try:
+            amount = Decimal(str(value).strip())
+        except ArithmeticError:
+            raise ValueError(f'{value!r} is not an amount of money')
+        if not amount.is_finite():
+            raise ValueError(f'{value!r} is not an amount of money')
+        return cls(int((amount * MINOR_UNITS).to_integral_value(ROUND_HALF_UP)))
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def percent(self, points):
+        """ This amount multiplied by a rate in basis points, to the nearest cent """
+        return Money(divide_rounding_half_up(self.cents * points, BASIS_POINTS))
+
+    def _other_cents(self, other):
+        if isinstance(other, Money):
+            return other.cents
+        if isinstance(other, (int, Decimal)) and not isinstance(other, bool):
+            return Money.parse(other).cents
+        return None
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        # Lets sum() start from 0
+        if other == 0 and isinstance(other, int):
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        return NotImplemented
+
+    def __mul__(self, other):
+        # Only whole quantities; rates go through percent()
+        if isinstance(other, int) and not isinstance(other, bool):
+            return Money(self.cents * other)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __eq__(self, other):
+        cents = self._other_cents(other)
+        return NotImplemented if cents is None else self.cents == cents
+
+    def __lt__(self, other):
+        cents = self._other_cents(other)
+        return NotImplemented if cents is None else self.cents < cents
+
+    def __le__(self, other):
+        cents = self._other_cents(other)
+        return NotImplemented if cents is None else self.cents <= cents
+
+    def __gt__(self, other):
+        cents = self._other_cents(other)
+        return NotImplemented if cents is None else self.cents > cents
+
+    def __ge__(self, other):
+        cents = self._other_cents(other)
+        return NotImplemented if cents is None else self.cents >= cents
+
+    def __hash__(self):
+        # Equal to the hash of the same amount as a Decimal or int,
+        # since they compare equal
+        return hash(self.to_decimal())
+
+    def __str__(self):
+        units, cents = divmod(abs(self.cents), MINOR_UNITS)
+        return f'{"-" if self.cents < 0 else ""}{units}.{cents:02d}'
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+    def __format__(self, spec):
+        return format(self.to_decimal(), spec) if spec else str(self)
+
+    def __reduce__(self):
+        return (Money, (self.cents,))
+
+
+class MoneyDescriptor(DeferredAttribute):
+    """ Turns anything assigned to a MoneyField into Money """
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = self.field.to_python(value)
+
+
+class MoneyField(models.BigIntegerField):
+    """
+    A model field holding Money, stored as a whole number of cents.
+    Lookups, forms and fixtures take amounts in dollars, so
+    price__gte='10' and a fixture price of "19.99" work as before.
+    """
+    description = 'An amount of money, stored in cents'
+    descriptor_class = MoneyDescriptor
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return Money(int(value))
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Money):
+            return value
+        if isinstance(value, float):
+            # JSON fixtures give prices as numbers, which arrive as
+            # floats. Their shortest repr is the amount that was written.
+            value = repr(value)
+        try:
+            return Money.parse(value)
+        except (TypeError, ValueError):
+            raise ValidationError(
+                f'"{value}" is not an amount of money', code='invalid')
+
+    def get_prep_value(self, value):
+        if value is None or hasattr(value, 'resolve_expression'):
+            return value
+        return Money.parse(value).cents
+
+    def get_default(self):
+        return self.to_python(super().get_default())
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        return None if value is None else str(value)
+
+    def formfield(self, **kwargs):
+        # Amounts are entered in dollars, rather than as the integer
+        # the field is stored as
+        return models.Field.formfield(self, **{
+            'form_class': forms.DecimalField,
+            'max_digits': 12,
+            'decimal_places': 2,
+            **kwargs,
+        })
+
+
+def cents_migration(model_name, name, decimal_field, money_field):
+    """
+    Operations replacing a DecimalField with a MoneyField of the same
+    name, converting the amounts to cents. decimal_field is the field
+    as it was, so migrating backwards can restore it.
+    """
+    temporary = f'{name}_cents'
+
+    def forwards(apps, schema_editor):
+        model = apps.get_model(model_name)
+        model.objects.update(**{temporary: Cast(
+            Round(models.F(name) * MINOR_UNITS), models.BigIntegerField())})
+
+    def backwards(apps, schema_editor):
+        model = apps.get_model(model_name)
+        model.objects.update(**{name: models.ExpressionWrapper(
+            models.F(temporary) * Decimal('0.01'), output_field=decimal_field.clone())})
+
+    nullable_decimal = decimal_field.clone()
+    nullable_decimal.null = True
+    nullable_money = money_field.clone()
+    nullable_money.null = True
+    model = model_name.split('.')[1]
+    return [
+        migrations.AddField(model, temporary, nullable_money),
+        migrations.AlterField(model, name, nullable_decimal),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(model, name),
+        migrations.RenameField(model, temporary, name),
+        migrations.AlterField(model, name, money_field),
+    ]
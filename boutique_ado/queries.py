@@ -0,0 +1,93 @@
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+
+# Lists of placeholders such as "IN (%s, %s, %s)" are collapsed so
+# queries that only differ in the number of ids have the same shape
+IN_LIST_RE = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+# Literal values that end up inlined in the SQL itself
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Set while the database cache runs its own queries
+_cache_queries = ContextVar('cache_queries', default=False)
+
+
+@contextmanager
+def cache_queries():
+    """
+    Mark the queries run within the block as the cache's, which are
+    counted apart from the queries for a page's data. With Redis as
+    the cache they wouldn't reach the database at all.
+    """
+    token = _cache_queries.set(True)
+    try:
+        yield
+    finally:
+        _cache_queries.reset(token)
+
+
+def query_shape(sql):
+    """
+    Reduce a SQL statement to its shape by replacing every value
+    with a placeholder, so repeated N+1 queries can be grouped
+    """
+    sql = IN_LIST_RE.sub('(...)', sql)
+    sql = LITERAL_RE.sub('?', sql)
+    return WHITESPACE_RE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    """
+    Context manager that counts and times every query run on any
+    database connection while it is active, recording their shapes.
+    Queries run by the database cache are only counted in cache_count.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.cache_count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self._stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # Used by connection.execute_wrapper() around every query
+        if _cache_queries.get():
+            self.cache_count += 1
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.shapes[query_shape(sql)] += 1
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self._stack = None
+
+    @property
+    def duration_ms(self):
+        return self.duration * 1000
+
+    def duplicates(self, threshold=2):
+        """
+        Return (shape, count) tuples for queries that ran at least
+        threshold times, which usually points to an N+1 pattern
+        """
+        return [
+            (shape, count) for shape, count in self.shapes.most_common()
+            if count >= threshold
+        ]
@@ -0,0 +1,87 @@
+import random
+import uuid
+from datetime import timedelta
+
+from django.db.models import Count, F, Min, Q, Subquery
+from django.utils import timezone
+
+
+def retry_delay(attempts, base_seconds, max_seconds):
+    """
+    Seconds to wait before trying something again after it has failed
+    attempts times, doubling each time up to max_seconds. Delays are
+    spread out a little so things that failed together aren't retried
+    together.
+    """
+    delay = min(base_seconds * 2 ** (attempts - 1), max_seconds)
+    return random.uniform(delay / 2, delay)
+
+
+def claim(model, batch_size, lease_seconds, claimed_status):
+    """
+    Claim up to batch_size rows of a queue model that are due, for this
+    worker alone, moving them to claimed_status. Rows claimed by a
+    worker that stopped before finishing them are claimed again once
+    their lease expires.
+
+    The model has status, next_attempt, claim, lease_expires and
+    attempts fields, and a PENDING status. Claiming is a single update
+    that only matches rows still due, so two workers never claim the
+    same row, and it takes no lock before writing, which SQLite needs.
+    """
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    due = (
+        Q(status=model.PENDING, next_attempt__lte=now)
+        | Q(status=claimed_status, lease_expires__lt=now)
+    )
+    candidates = model.objects.filter(due).order_by('next_attempt').values('id')[:batch_size]
+    claimed = model.objects.filter(due, id__in=Subquery(candidates)).update(
+        status=claimed_status,
+        claim=token,
+        lease_expires=now + timedelta(seconds=lease_seconds),
+        attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        return []
+    return list(model.objects.filter(claim=token).order_by('next_attempt'))
+
+
+def percentile(ordered, fraction):
+    """ The value fraction of the way through a sorted list, or None if it's empty """
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 1)
+
+
+def queue_stats(model, waiting_statuses, finished_status, received_field, finished_field,
+                window=timedelta(hours=1), sample_size=10000):
+    """
+    The number of rows of a queue model in each status, how many are
+    due and how long the oldest has waited, and the time from each row
+    being queued to it being finished, for rows finished within window
+    """
+    now = timezone.now()
+    depth = dict.fromkeys((status for status, _ in model.STATUS_CHOICES), 0)
+    depth.update(model.objects.values_list('status').annotate(count=Count('id')))
+    oldest = model.objects.filter(status__in=waiting_statuses).aggregate(
+        oldest=Min(received_field))['oldest']
+    latencies = sorted(
+        (finished - received).total_seconds() * 1000
+        for received, finished in model.objects.filter(**{
+            'status': finished_status, f'{finished_field}__gte': now - window,
+        }).order_by(f'-{finished_field}').values_list(received_field, finished_field)[:sample_size]
+    )
+    return {
+        'depth': depth,
+        'due': model.objects.filter(status=model.PENDING, next_attempt__lte=now).count(),
+        'oldest_waiting_seconds': round((now - oldest).total_seconds(), 1) if oldest else None,
+        'finished_in_window': len(latencies),
+        'window_seconds': window.total_seconds(),
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': percentile(latencies, 1),
+        },
+    }
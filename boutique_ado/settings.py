@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 import dj_database_url
 
 development = os.environ.get('DEVELOPMENT', False)
@@ -55,6 +56,9 @@ INSTALLED_APPS = [
     'bag',
     'checkout',
     'profiles',
+    'sessionstore',
+    'inventory',
+    'outbox',
 
     # Other
     'crispy_forms',
@@ -63,14 +67,35 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'boutique_ado.middleware.ReplicaPinningMiddleware',
+    'boutique_ado.middleware.CatalogVersionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'boutique_ado.middleware.QueryBudgetMiddleware',
 ]
 
+# Maximum number of queries each view (by url name) should run.
+# Views over budget are logged, and tests using
+# boutique_ado.testing.QueryBudgetMixin fail.
+QUERY_BUDGETS = {
+    'products': 8,
+    'product_detail': 5,
+    'view_bag': 5,
+    'profile': 8,
+    'checkout_success': 10,
+    'api_products': 5,
+    'api_product_detail': 2,
+    'api_update_bag': 10,
+}
+# A query shape run this many times in one request is logged as an N+1
+QUERY_DUPLICATE_THRESHOLD = 3
+# Adds query counts and database time to response headers
+QUERY_BUDGET_HEADERS = development
+
 ROOT_URLCONF = 'boutique_ado.urls'
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
@@ -100,9 +125,19 @@ TEMPLATES = [
     },
 ]
 
+# Serves the home and product pages to anonymous visitors from a shared
+# page cache, with the bag total and messages loaded afterwards
+FULL_PAGE_CACHE = 'FULL_PAGE_CACHE' in os.environ
+FULL_PAGE_CACHE_TIMEOUT = 60 * 10
+
 # Tells django to store messages in the session
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 
+# Sessions are stored a key at a time, so a message or a changed cart id
+# only rewrites that one value. Sessions saved by Django's own database
+# backend are still read, and sweep_sessions --legacy clears them out.
+SESSION_ENGINE = 'sessionstore.backend'
+
 AUTHENTICATION_BACKENDS = (
     # Needed to login by username in Django admin, regardless of `allauth`
     'django.contrib.auth.backends.ModelBackend',
@@ -140,6 +175,78 @@ else:
         }
     }
 
+# Some tests make requests from several threads at once, which can't
+# share an in-memory SQLite database, so SQLite tests use a file
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST', {}).setdefault(
+        'NAME', os.path.join(BASE_DIR, 'test_db.sqlite3'))
+
+# Read replicas of the default database, as a comma separated list of
+# database urls. Reads are spread across them by the router below, and
+# tests run every replica as a mirror of the default database.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    alias = f'replica_{index + 1}'
+    DATABASES[alias] = dj_database_url.parse(url.strip())
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+# The routing tests need a replica even when none are configured, so
+# one mirroring the default database is added for them. It's only
+# read from in tests that put it in DATABASE_REPLICAS.
+if sys.argv[1:2] == ['test'] and not DATABASE_REPLICAS:
+    DATABASES['replica'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['boutique_ado.db_routers.PrimaryReplicaRouter']
+
+# The default cache is shared by every process: the web workers, the
+# background workers and management commands. The catalog and price
+# versions kept in it are how a change made in one reaches the others.
+# Redis is used when REDIS_URL is set, and otherwise a table in the
+# database, created by the home app's migrations. Whole pages are kept
+# apart in 'pages', so they can't crowd the versions out of the default
+# cache, and always expire, in case a change is ever missed.
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        },
+        'pages': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+            'KEY_PREFIX': 'pages',
+            'TIMEOUT': FULL_PAGE_CACHE_TIMEOUT,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'boutique_ado.caching.DatabaseCache',
+            'LOCATION': 'boutique_ado_cache',
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        },
+        'pages': {
+            'BACKEND': 'boutique_ado.caching.DatabaseCache',
+            'LOCATION': 'boutique_ado_page_cache',
+            'TIMEOUT': FULL_PAGE_CACHE_TIMEOUT,
+            'OPTIONS': {'MAX_ENTRIES': 2000},
+        },
+    }
+# Rendered product cards are kept in each process, as there are many
+# to a page. Their keys include the product's update time, so a card
+# can never be served for an older version of its product.
+CACHES['fragments'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'fragments',
+    'OPTIONS': {'MAX_ENTRIES': 5000},
+}
+# Requests under these paths always read from the primary database.
+# Checkout and the Stripe webhook must see orders the moment they're
+# created, and the admin is only used to make changes.
+DATABASE_PRIMARY_PATHS = ('/checkout/', '/admin/')
+# How long a visitor's reads stay on the primary after they write
+REPLICA_PIN_SECONDS = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -217,17 +324,61 @@ if 'USE_AWS' in os.environ:
 # Variables used to calculate delivery costs
 FREE_DELIVERY_THRESHOLD = 50
 STANDARD_DELIVERY_PERCENTAGE = 10
+# Delivery is a percentage of the order total, from the highest of these
+# (threshold, percentage) tiers the total reaches, after any discount
+DELIVERY_TIERS = ((0, STANDARD_DELIVERY_PERCENTAGE), (FREE_DELIVERY_THRESHOLD, 0))
+# Countries charged with their own tiers, for example
+# {'international': {'countries': ('US', 'CA'), 'tiers': ((0, 15), (100, 0))}}
+DELIVERY_ZONES = {}
+# Stock is split across this many rows for each product and size, so
+# checkouts buying the same product don't all wait on one row
+INVENTORY_SHARDS = 8
+# How long stock is held for a checkout that hasn't been paid for.
+# release_reservations puts back the stock of those that have expired.
+INVENTORY_RESERVATION_MINUTES = 30
+# Stripe webhook events are queued and handled by process_webhooks.
+# An event that fails is tried again after WEBHOOK_RETRY_SECONDS,
+# doubling each time up to WEBHOOK_RETRY_MAX_SECONDS, and is
+# dead-lettered after WEBHOOK_MAX_ATTEMPTS tries. A worker that stops
+# part way through has its events picked up after WEBHOOK_LEASE_SECONDS.
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_SECONDS = 30
+WEBHOOK_RETRY_MAX_SECONDS = 3600
+WEBHOOK_LEASE_SECONDS = 300
+# Emails are written to the outbox and sent by send_outbox, over one
+# connection to OUTBOX_EMAIL_BACKEND and no more than
+# OUTBOX_RATE_PER_SECOND a second. An email that fails is tried again
+# the same way as a webhook event.
+EMAIL_BACKEND = 'outbox.backends.OutboxBackend'
+OUTBOX_RATE_PER_SECOND = 5
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_RETRY_SECONDS = 60
+OUTBOX_RETRY_MAX_SECONDS = 3600
+OUTBOX_LEASE_SECONDS = 300
 STRIPE_CURRENCY = 'usd'
 # Stripe Keys
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WH_SECRET = os.getenv('STRIPE_WH_SECRET', '')
+# Calls to Stripe go through checkout.stripe_client, over up to
+# STRIPE_POOL_SIZE kept-open connections. A call that can't connect or
+# get an answer within these many seconds, or that Stripe fails, is made
+# again up to STRIPE_MAX_RETRIES times, waiting about
+# STRIPE_RETRY_SECONDS and doubling. After STRIPE_CIRCUIT_FAILURES
+# failures in a row, Stripe isn't called for STRIPE_CIRCUIT_RESET_SECONDS.
+STRIPE_CONNECT_TIMEOUT = 3
+STRIPE_READ_TIMEOUT = 10
+STRIPE_MAX_RETRIES = 2
+STRIPE_RETRY_SECONDS = 0.5
+STRIPE_POOL_SIZE = 10
+STRIPE_CIRCUIT_FAILURES = 5
+STRIPE_CIRCUIT_RESET_SECONDS = 30
 
 if 'DEVELOPMENT' in os.environ:
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
     DEFAULT_FROM_EMAIL = 'boutiqueado@example.com'
 else:
-    EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
     EMAIL_USE_TLS = True
     EMAIL_PORT = 587
     EMAIL_HOST = 'smtp.gmail.com'
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.urls import resolve
+
+from .queries import QueryRecorder
+
+
+def _report(shapes):
+    """ Format (shape, count) tuples for an assertion message """
+    return '\n'.join(f'{count:>4} x {shape}' for shape, count in shapes)
+
+
+@contextmanager
+def query_budget(max_queries, duplicate_threshold=None):
+    """
+    Fail if the code inside the block runs more than max_queries
+    queries, or repeats any query shape duplicate_threshold times
+    """
+    if duplicate_threshold is None:
+        duplicate_threshold = settings.QUERY_DUPLICATE_THRESHOLD
+
+    with QueryRecorder() as recorder:
+        yield recorder
+
+    if recorder.count > max_queries:
+        raise AssertionError(
+            f'{recorder.count} queries run, over the budget of '
+            f'{max_queries}:\n{_report(recorder.shapes.most_common())}')
+    duplicates = recorder.duplicates(duplicate_threshold)
+    if duplicates:
+        raise AssertionError(
+            f'Repeated queries found (possible N+1):\n{_report(duplicates)}')
+
+
+class QueryBudgetMixin:
+    """
+    TestCase mixin for pinning the number of queries a view may run,
+    using the budgets set for each url name in QUERY_BUDGETS
+    """
+
+    def assertWithinQueryBudget(self, path, method='get', budget=None, **kwargs):
+        """
+        Request path with the test client and fail if the view goes
+        over its query budget or repeats a query. Returns the response.
+        """
+        if budget is None:
+            name = resolve(path.split('?')[0]).url_name
+            budget = settings.QUERY_BUDGETS[name]
+        with query_budget(budget):
+            response = getattr(self.client, method)(path, **kwargs)
+        return response
@@ -1,6 +1,29 @@
 from django.shortcuts import render
+from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.views.decorators.cache import never_cache
+
+from bag.contexts import get_bag_totals
 
 
 def handler404(request, exception):
     """ Error Handler 404 - Page Not Found """
-    return render(request, "errors/404.html", status=404)
\ No newline at end of file
+    return render(request, "errors/404.html", status=404)
+
+
+@never_cache
+def page_fragments(request):
+    """
+    Return the visitor specific parts of a page served from the
+    shared page cache: their bag total, messages and CSRF token
+    """
+    grand_total = get_bag_totals(request)['grand_total']
+    messages_html = render_to_string(
+        'includes/toasts/messages.html', request=request)
+
+    return JsonResponse({
+        'grand_total': f'{grand_total:.2f}',
+        'messages': messages_html.strip(),
+        'csrf_token': get_token(request),
+    })
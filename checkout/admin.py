@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from django.utils import timezone
+from .models import Order, OrderLineItem, DiscountCode, WebhookEvent
 
 
 class OrderLineItemAdminInline(admin.TabularInline):
@@ -12,6 +13,7 @@ class OrderAdmin(admin.ModelAdmin):
 
     readonly_fields = ('order_number', 'date',
                        'delivery_cost', 'order_total',
+                       'discount_code', 'discount',
                        'grand_total', 'original_bag',
                        'stripe_pid')
 
@@ -19,7 +21,8 @@ class OrderAdmin(admin.ModelAdmin):
               'email', 'phone_number', 'country',
               'postcode', 'town_or_city', 'street_address1',
               'street_address2', 'county', 'delivery_cost',
-              'order_total', 'grand_total', 'original_bag',
+              'order_total', 'discount_code', 'discount',
+              'grand_total', 'original_bag',
               'stripe_pid')
 
     list_display = ('order_number', 'date', 'full_name',
@@ -28,4 +31,32 @@ class OrderAdmin(admin.ModelAdmin):
 
     ordering = ('-date',)
 
+
+class DiscountCodeAdmin(admin.ModelAdmin):
+    list_display = ('code', 'percentage', 'amount',
+                    'minimum_spend', 'active', 'expires',)
+
+    ordering = ('code',)
+
+
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'type', 'status', 'attempts',
+                    'received', 'processed',)
+    list_filter = ('status', 'type',)
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'type', 'payload', 'status', 'attempts',
+                       'received', 'next_attempt', 'claim', 'lease_expires',
+                       'processed', 'last_error',)
+    actions = ('retry',)
+
+    ordering = ('-received',)
+
+    @admin.action(description='Try the selected events again')
+    def retry(self, request, queryset):
+        queryset.exclude(status=WebhookEvent.PROCESSING).update(
+            status=WebhookEvent.PENDING, attempts=0, next_attempt=timezone.now())
+
+
 admin.site.register(Order, OrderAdmin)
+admin.site.register(DiscountCode, DiscountCodeAdmin)
+admin.site.register(WebhookEvent, WebhookEventAdmin)
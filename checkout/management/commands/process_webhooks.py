@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from checkout import webhook_queue
+
+
+class Command(BaseCommand):
+    help = ('Handle the Stripe webhook events queued by the webhook view, '
+            'with a pool of worker threads. Failed events are retried with '
+            'backoff and dead-lettered after WEBHOOK_MAX_ATTEMPTS. Runs until '
+            'stopped, or with --once until nothing is due.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Number of events handled at the same time')
+        parser.add_argument(
+            '--batch-size', type=int, default=10,
+            help='Number of events a worker claims at a time')
+        parser.add_argument(
+            '--poll-seconds', type=float, default=2,
+            help='How long a worker waits before looking again when nothing is due')
+        parser.add_argument(
+            '--stats-seconds', type=float, default=60,
+            help='How often queue depth and latency are written out')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Stop once no events are due, instead of waiting for more')
+        parser.add_argument(
+            '--stats', action='store_true',
+            help='Write out queue depth and latency as JSON, and stop')
+        parser.add_argument(
+            '--retry-dead', action='store_true',
+            help='Queue the dead-lettered events to be tried again, and stop')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(webhook_queue.queue_stats(), indent=2))
+            return
+        if options['retry_dead']:
+            count = webhook_queue.retry_dead()
+            self.stdout.write(self.style.SUCCESS(f'Queued {count} dead-lettered events again'))
+            return
+
+        stop = threading.Event()
+        handled = [0] * options['workers']
+
+        def worker(index):
+            try:
+                while not stop.is_set():
+                    claimed = webhook_queue.work(options['batch_size'])
+                    handled[index] += claimed
+                    if not claimed:
+                        if options['once']:
+                            return
+                        stop.wait(options['poll_seconds'])
+            finally:
+                # Each thread has its own connection
+                connections.close_all()
+
+        threads = [
+            threading.Thread(target=worker, args=(index,), daemon=True)
+            for index in range(options['workers'])
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(options['stats_seconds'] / len(threads))
+                if not options['once'] and any(thread.is_alive() for thread in threads):
+                    self.stdout.write(json.dumps(webhook_queue.queue_stats()))
+        except KeyboardInterrupt:
+            # Events being handled are finished before stopping
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Handled {sum(handled)} webhook events in {elapsed:.1f}s'))
+        self.stdout.write(json.dumps(webhook_queue.queue_stats()))
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.23 on 2026-10-18 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0004_order_user_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscountCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=32, unique=True)),
+                ('percentage', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=6)),
+                ('minimum_spend', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('active', models.BooleanField(default=True)),
+                ('expires', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=6),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount_code',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
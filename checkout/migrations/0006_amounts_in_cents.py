@@ -0,0 +1,41 @@
+from django.db import migrations, models
+
+from boutique_ado.money import MoneyField, cents_migration
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0005_discount_codes'),
+    ]
+
+    operations = [
+        *cents_migration(
+            'checkout.Order', 'delivery_cost',
+            models.DecimalField(max_digits=6, decimal_places=2, default=0),
+            MoneyField(default=0)),
+        *cents_migration(
+            'checkout.Order', 'order_total',
+            models.DecimalField(max_digits=10, decimal_places=2, default=0),
+            MoneyField(default=0)),
+        *cents_migration(
+            'checkout.Order', 'grand_total',
+            models.DecimalField(max_digits=10, decimal_places=2, default=0),
+            MoneyField(default=0)),
+        *cents_migration(
+            'checkout.Order', 'discount',
+            models.DecimalField(max_digits=6, decimal_places=2, default=0),
+            MoneyField(default=0)),
+        *cents_migration(
+            'checkout.OrderLineItem', 'lineitem_total',
+            models.DecimalField(max_digits=6, decimal_places=2, editable=False),
+            MoneyField(editable=False)),
+        *cents_migration(
+            'checkout.DiscountCode', 'amount',
+            models.DecimalField(max_digits=6, decimal_places=2, default=0),
+            MoneyField(default=0)),
+        *cents_migration(
+            'checkout.DiscountCode', 'minimum_spend',
+            models.DecimalField(max_digits=10, decimal_places=2, default=0),
+            MoneyField(default=0)),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+def clear_duplicate_pids(apps, schema_editor):
+    """
+    Empty payment ids become NULL, so they don't clash once the field is
+    unique. Where the view and the webhook both made an order for one
+    payment, the first order made keeps the payment id.
+    """
+    Order = apps.get_model('checkout', 'Order')
+    Order.objects.filter(stripe_pid='').update(stripe_pid=None)
+    duplicates = (
+        Order.objects.exclude(stripe_pid=None).values('stripe_pid')
+        .annotate(orders=models.Count('id')).filter(orders__gt=1)
+        .values_list('stripe_pid', flat=True)
+    )
+    for stripe_pid in duplicates:
+        later = Order.objects.filter(stripe_pid=stripe_pid).order_by('date', 'id')[1:]
+        Order.objects.filter(id__in=[order.id for order in later]).update(stripe_pid=None)
+
+
+def restore_empty_pids(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    Order.objects.filter(stripe_pid=None).update(stripe_pid='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0006_amounts_in_cents'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(blank=True, default=None, max_length=254, null=True),
+        ),
+        migrations.RunPython(clear_duplicate_pids, restore_empty_pids),
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(blank=True, default=None, max_length=254, null=True, unique=True),
+        ),
+    ]
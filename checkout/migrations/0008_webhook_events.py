@@ -0,0 +1,35 @@
+# Generated by Django 3.2.23 on 2026-10-18 13:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_unique_stripe_pid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(max_length=100)),
+                ('payload', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('dead', 'Dead')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claim', models.CharField(blank=True, db_index=True, default='', max_length=32)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['status', 'next_attempt'], name='checkout_we_status_7e65ad_idx'),
+        ),
+    ]
@@ -2,12 +2,36 @@ import uuid
 
 from django.db import models
 from django.db.models import Sum
-from django.conf import settings
+from django.utils import timezone
 
 from django_countries.fields import CountryField
 
+from boutique_ado.money import MoneyField
+
 from products.models import Product
 from profiles.models import UserProfile
+from . import pricing
+
+
+class DiscountCode(models.Model):
+    """
+    A code shoppers can enter for money off their order. Codes can
+    take off a percentage, a fixed amount or both.
+    """
+    code = models.CharField(max_length=32, unique=True)
+    percentage = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    amount = MoneyField(default=0)
+    minimum_spend = MoneyField(default=0)
+    active = models.BooleanField(default=True)
+    expires = models.DateTimeField(null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        """ Codes are matched in upper case """
+        self.code = self.code.strip().upper()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.code
 
 
 class Order(models.Model):
@@ -32,11 +56,18 @@ class Order(models.Model):
     street_address2 = models.CharField(max_length=80, null=True, blank=True)
     county = models.CharField(max_length=80, null=True, blank=True)
     date = models.DateTimeField(auto_now_add=True)
-    delivery_cost = models.DecimalField(max_digits=6, decimal_places=2, null=False, default=0)
-    order_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
-    grand_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
+    # Amounts are held in cents, see boutique_ado.money
+    delivery_cost = MoneyField(null=False, default=0)
+    # The discount code applied to the order, and how much it took off
+    discount_code = models.CharField(max_length=32, null=False, blank=True, default='')
+    discount = MoneyField(null=False, default=0)
+    order_total = MoneyField(null=False, default=0)
+    grand_total = MoneyField(null=False, default=0)
     original_bag = models.TextField(null=False, blank=False, default='')
-    stripe_pid = models.CharField(max_length=254, null=False, blank=False, default='')
+    # Each payment makes one order, so the checkout view and the webhook
+    # find each other's order by it. Orders made without one, such as
+    # in the admin, leave it empty, and many orders can do that.
+    stripe_pid = models.CharField(max_length=254, null=True, blank=True, unique=True, default=None)
 
     def _generate_order_number(self):
         """
@@ -44,20 +75,36 @@ class Order(models.Model):
         """
         return uuid.uuid4().hex.upper()
 
-    def update_total(self):
+    def price_order(self, order_total):
         """
-        Update grand total each time a line item is added,
-        accounting for delivery costs.
+        Work out the discount and delivery when the order is placed,
+        given the sum of its line item totals, and record them so the
+        order keeps the prices it was placed at.
         """
-        # Adding or zero to the end of this line that aggregates all the line item totals.
-        # This will prevent an error if we manually delete all the line items from an order
-        # by making sure that this sets the order total to zero instead of none.
-        self.order_total = self.lineitems.aggregate(Sum('lineitem_total'))['lineitem_total__sum'] or 0
-        if self.order_total < settings.FREE_DELIVERY_THRESHOLD:
-            self.delivery_cost = self.order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
-        else:
-            self.delivery_cost = 0
-        self.grand_total = self.order_total + self.delivery_cost
+        # Discounts and delivery are worked out by the same pricing
+        # rules as the bag, using the country the order is going to
+        quote = pricing.quote_total(
+            order_total, country=self.country, discount_code=self.discount_code)
+        self.discount_code = quote.discount_code
+        self.discount = quote.discount
+        self.delivery_cost = quote.delivery
+        self.update_total(order_total=order_total)
+
+    def update_total(self, order_total=None):
+        """
+        Update grand total each time a line item is added, keeping the
+        discount and delivery recorded when the order was placed, as
+        today's rules may no longer be the ones it was placed under.
+        order_total is the sum of the line item totals, if the caller
+        already knows it.
+        """
+        if order_total is None:
+            # Adding or zero to the end of this line that aggregates all the line item totals.
+            # This will prevent an error if we manually delete all the line items from an order
+            # by making sure that this sets the order total to zero instead of none.
+            order_total = self.lineitems.aggregate(Sum('lineitem_total'))['lineitem_total__sum'] or 0
+        self.order_total = order_total
+        self.grand_total = self.order_total - self.discount + self.delivery_cost
         self.save()
 
     def save(self, *args, **kwargs):
@@ -78,7 +125,7 @@ class OrderLineItem(models.Model):
     product = models.ForeignKey(Product, null=False, blank=False, on_delete=models.CASCADE)
     product_size = models.CharField(max_length=2, null=True, blank=True) # XS, S, M, L, XL
     quantity = models.IntegerField(null=False, blank=False, default=0)
-    lineitem_total = models.DecimalField(max_digits=6, decimal_places=2, null=False, blank=False, editable=False)
+    lineitem_total = MoneyField(null=False, blank=False, editable=False)
 
     def save(self, *args, **kwargs):
         """
@@ -89,4 +136,45 @@ class OrderLineItem(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f'SKU {self.product.sku} on order {self.order.order_number}'
\ No newline at end of file
+        return f'SKU {self.product.sku} on order {self.order.order_number}'
+
+class WebhookEvent(models.Model):
+    """
+    A verified Stripe webhook event, kept until process_webhooks has
+    handled it. Events are stored once each, by Stripe's event id, so
+    one delivered again isn't handled twice.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        # Failed too many times, and left for someone to look at
+        (DEAD, 'Dead'),
+    )
+
+    class Meta:
+        indexes = [
+            # How workers find the events that are due
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    received = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    # The worker handling the event, and when it's given up on if
+    # that worker stops before finishing
+    claim = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    processed = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return f'{self.type} {self.event_id}'
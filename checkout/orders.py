@@ -0,0 +1,79 @@
+from django.db import IntegrityError, router, transaction
+
+from products.models import Product
+from .models import Order, OrderLineItem
+
+
+def bag_lines(bag):
+    """
+    The (product id, size, quantity) of each line of a bag in the
+    format kept in Order.original_bag, with size None for products
+    that don't have sizes
+    """
+    for item_id, item_data in bag.items():
+        # If the items value is an integer, then we are
+        # working with an item that does not have sizes
+        if isinstance(item_data, int):
+            yield item_id, None, item_data
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                yield item_id, size, quantity
+
+
+def create_order(order, bag, on_saved=None):
+    """
+    Save an unsaved order with a line item for each line of bag, and
+    total it. The products are read in one query and the line items
+    inserted together, so the order costs the same few queries however
+    many lines it has, and it's saved in one transaction so a failure
+    leaves nothing behind.
+
+    The checkout view and the webhook both make the order for a payment,
+    often at the same moment. Whichever saves it first wins, and the
+    other gets that order back instead, found by its unique stripe_pid.
+    Returns the order and whether it was created here. on_saved is
+    called with the order, whichever made it, and whether it was created
+    here, in the same transaction.
+
+    The line items are inserted without OrderLineItem.save() or the
+    signals that total the order after each one, so the order is
+    totalled once here instead. Raises Product.DoesNotExist if a
+    product in the bag no longer exists.
+    """
+    lines = list(bag_lines(bag))
+    products = Product.objects.in_bulk({int(item_id) for item_id, _, _ in lines})
+
+    line_items = []
+    for item_id, size, quantity in lines:
+        product = products.get(int(item_id))
+        if product is None:
+            raise Product.DoesNotExist(f'Product {item_id} in the bag was not found')
+        line_items.append(OrderLineItem(
+            product=product,
+            product_size=size,
+            quantity=quantity,
+            lineitem_total=product.price * quantity,
+        ))
+
+    using = router.db_for_write(Order)
+    with transaction.atomic(using=using):
+        # Saving the order first means a second one for the same payment
+        # waits here until the first is committed, with its line items,
+        # and then fails on the unique stripe_pid
+        try:
+            with transaction.atomic(using=using):
+                order.save(using=using)
+        except IntegrityError:
+            if not order.stripe_pid:
+                raise
+            existing = Order.objects.using(using).get(stripe_pid=order.stripe_pid)
+            if on_saved:
+                on_saved(existing, False)
+            return existing, False
+        for line_item in line_items:
+            line_item.order = order
+        OrderLineItem.objects.using(using).bulk_create(line_items)
+        order.price_order(sum(line_item.lineitem_total for line_item in line_items))
+        if on_saved:
+            on_saved(order, True)
+    return order, True
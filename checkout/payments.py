@@ -0,0 +1,86 @@
+import hashlib
+import json
+
+import stripe
+from django.conf import settings
+
+from .models import Order
+from .stripe_client import get_client
+
+# The payment intent made for the visitor's bag, kept so opening the
+# checkout page again reuses it instead of making another
+PAYMENT_INTENT_SESSION_KEY = 'payment_intent'
+
+
+def fingerprint(*parts):
+    """ A short hash of parts, for telling whether any has changed """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def get_payment_intent(request, bag, amount):
+    """
+    Return the id and client secret of a payment intent for paying
+    amount for bag, and whether it was made or changed for this bag.
+
+    The intent kept in the session is reused, without asking Stripe,
+    while the bag and amount are the ones it was made for. When the bag
+    changes its amount is updated, if that changed too. A new intent is
+    only made for a new session, once the last one has been paid for,
+    or if Stripe won't change it any more.
+    """
+    bag_fingerprint = fingerprint(bag, amount, settings.STRIPE_CURRENCY)
+    stored = request.session.get(PAYMENT_INTENT_SESSION_KEY)
+    if stored and (stored['currency'] != settings.STRIPE_CURRENCY
+                   or Order.objects.filter(stripe_pid=stored['id']).exists()):
+        # Paid for by a checkout that never reached the success page
+        stored = None
+    if stored and stored['fingerprint'] == bag_fingerprint:
+        return stored['id'], stored['client_secret'], False
+
+    if stored and stored['amount'] != amount:
+        try:
+            get_client().modify_payment_intent(stored['id'], amount=amount)
+        except stripe.error.InvalidRequestError:
+            # It has succeeded or been cancelled, so can't be changed
+            stored = None
+        else:
+            stored['amount'] = amount
+            # The amount cache_checkout_data last sent has been replaced
+            stored['sent'] = None
+    if not stored:
+        intent = get_client().create_payment_intent(
+            amount=amount,
+            currency=settings.STRIPE_CURRENCY,
+        )
+        stored = {
+            'id': intent.id,
+            'client_secret': intent.client_secret,
+            'amount': amount,
+            'currency': settings.STRIPE_CURRENCY,
+            'sent': None,
+        }
+    stored['fingerprint'] = bag_fingerprint
+    request.session[PAYMENT_INTENT_SESSION_KEY] = stored
+    return stored['id'], stored['client_secret'], True
+
+
+def update_payment_intent(request, pid, amount, metadata):
+    """
+    Set the amount and metadata of a payment intent before it's paid,
+    unless they're what was last sent for it. Returns whether Stripe
+    was asked to change it.
+    """
+    stored = request.session.get(PAYMENT_INTENT_SESSION_KEY)
+    if stored and stored['id'] != pid:
+        stored = None
+    sent = fingerprint(amount, metadata)
+    if stored and stored['sent'] == sent:
+        return False
+
+    get_client().modify_payment_intent(pid, amount=amount, metadata=metadata)
+    if stored:
+        stored['amount'] = amount
+        stored['sent'] = sent
+        request.session[PAYMENT_INTENT_SESSION_KEY] = stored
+    return True
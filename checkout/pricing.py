@@ -0,0 +1,205 @@
+import bisect
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from boutique_ado.money import Money, basis_points
+from products.catalog import new_version
+
+PRICING_VERSION_KEY = 'checkout:pricing_version'
+# Where the discount code a visitor has entered is kept
+DISCOUNT_SESSION_KEY = 'discount_code'
+# Compiled rules are rebuilt after this many seconds even if the
+# version hasn't changed, in case it was changed in another cache
+RULES_MAX_AGE = 60
+
+ZERO = Money(0)
+
+
+def pricing_version():
+    """
+    Return the current version of the pricing rules. Compiled rules
+    are kept until it changes, which happens when a discount code does.
+    """
+    version = cache.get(PRICING_VERSION_KEY)
+    if version is None:
+        cache.add(PRICING_VERSION_KEY, new_version(), None)
+        version = cache.get(PRICING_VERSION_KEY)
+    return version
+
+
+def bump_pricing_version():
+    """ Move the pricing rules on to a new version after a change """
+    version = new_version()
+    cache.set(PRICING_VERSION_KEY, version, None)
+    return version
+
+
+class DeliveryTiers:
+    """
+    Delivery charged as a percentage of the order total, taken from
+    the highest tier the total reaches. tiers is a list of (threshold,
+    percentage) pairs, such as ((0, 10), (50, 0)) for 10% delivery
+    that's free from 50.
+    """
+
+    def __init__(self, tiers):
+        # Thresholds are kept in cents and percentages in basis points,
+        # so charging delivery is integer arithmetic
+        tiers = sorted((Money.parse(threshold).cents, basis_points(percentage))
+                       for threshold, percentage in tiers)
+        self.thresholds = [threshold for threshold, _ in tiers]
+        self.rates = [rate for _, rate in tiers]
+        # The lowest total from which delivery is free, if there is one
+        free = [threshold for threshold, rate in tiers if not rate]
+        self.free_from = free[0] if free else None
+
+    def charge(self, amount):
+        """ Return the delivery charge and how far amount is from free delivery """
+        index = bisect.bisect_right(self.thresholds, amount.cents) - 1
+        delivery = amount.percent(self.rates[index]) if index >= 0 else ZERO
+        if self.free_from is not None and amount.cents < self.free_from:
+            return delivery, Money(self.free_from - amount.cents)
+        return delivery, ZERO
+
+
+class Discount:
+    """ A discount code, taking a percentage and/or a fixed amount off """
+
+    def __init__(self, code, percentage=0, amount=0, minimum_spend=0, expires=None):
+        self.code = code
+        self.rate = basis_points(percentage)
+        self.amount = Money.parse(amount)
+        self.minimum_spend = Money.parse(minimum_spend)
+        self.expires = expires
+
+    def applies_to(self, subtotal, now):
+        return (
+            subtotal >= self.minimum_spend
+            and (self.expires is None or now < self.expires)
+        )
+
+    def amount_off(self, subtotal):
+        # A discount never takes more than the order is worth
+        return min(subtotal.percent(self.rate) + self.amount, subtotal)
+
+
+class Quote:
+    """ The price of a set of lines, as worked out by RuleSet.quote """
+
+    def __init__(self, line_totals, total, discount, discount_code,
+                 delivery, free_delivery_delta):
+        self.line_totals = line_totals
+        self.total = total
+        self.discount = discount
+        self.discount_code = discount_code
+        self.delivery = delivery
+        self.free_delivery_delta = free_delivery_delta
+        self.grand_total = total - discount + delivery
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'discount': self.discount,
+            'discount_code': self.discount_code,
+            'delivery': self.delivery,
+            'free_delivery_delta': self.free_delivery_delta,
+            'grand_total': self.grand_total,
+        }
+
+
+class RuleSet:
+    """
+    The compiled pricing rules: delivery tiers for each country and
+    the discount codes that can be used. Build one with get_rules(),
+    which keeps it until the rules change.
+    """
+
+    def __init__(self, default_tiers, zone_tiers=None, discounts=None):
+        self.default_tiers = DeliveryTiers(default_tiers)
+        # Each country's tiers, looked up directly rather than by zone
+        self.country_tiers = {}
+        for zone in (zone_tiers or {}).values():
+            tiers = DeliveryTiers(zone['tiers'])
+            for country in zone['countries']:
+                self.country_tiers[country.upper()] = tiers
+        self.discounts = {
+            discount.code.upper(): discount for discount in (discounts or ())
+        }
+
+    def discount_for(self, code):
+        """ The Discount for a code, or None if it doesn't exist """
+        return self.discounts.get((code or '').strip().upper())
+
+    def quote(self, lines, country=None, discount_code=None):
+        """
+        Price lines of (unit price, quantity), where prices are Money.
+        Line totals and the order total are worked out together in one
+        pass over the lines, in whole cents.
+        """
+        line_cents = [price.cents * quantity for price, quantity in lines]
+        return self.quote_total(
+            Money(sum(line_cents)), country=country, discount_code=discount_code,
+            line_totals=[Money(cents) for cents in line_cents])
+
+    def quote_total(self, total, country=None, discount_code=None, line_totals=()):
+        """
+        Price an order whose lines have already been added up. Discounts
+        are taken off first, and delivery is charged on what's left.
+        """
+        total = Money.parse(total)
+        discount = ZERO
+        applied_code = ''
+        offer = self.discount_for(discount_code)
+        if offer is not None and offer.applies_to(total, timezone.now()):
+            discount = offer.amount_off(total)
+            applied_code = offer.code
+        # Countries are given as codes or as django_countries Country objects
+        country = str(getattr(country, 'code', country) or '').upper()
+        tiers = self.country_tiers.get(country, self.default_tiers)
+        delivery, free_delivery_delta = tiers.charge(total - discount)
+        return Quote(line_totals, total, discount, applied_code,
+                     delivery, free_delivery_delta)
+
+
+def compile_rules():
+    """ Build a RuleSet from the settings and the active discount codes """
+    from .models import DiscountCode
+
+    discounts = [
+        Discount(code.code, code.percentage, code.amount,
+                 code.minimum_spend, code.expires)
+        for code in DiscountCode.objects.filter(active=True)
+    ]
+    return RuleSet(settings.DELIVERY_TIERS, settings.DELIVERY_ZONES, discounts)
+
+
+# The compiled rules, with the version and time they were compiled at.
+# It's replaced as a whole, so threads never see part of an update.
+_compiled = (None, 0, None)
+
+
+def get_rules():
+    """
+    Return the current RuleSet. Compiling it reads the discount codes,
+    so it's kept in memory until the pricing version changes.
+    """
+    global _compiled
+    version = pricing_version()
+    compiled_version, compiled_at, rules = _compiled
+    if compiled_version != version or time.monotonic() - compiled_at > RULES_MAX_AGE:
+        rules = compile_rules()
+        _compiled = (version, time.monotonic(), rules)
+    return rules
+
+
+def quote(lines, country=None, discount_code=None):
+    """ Price lines of (unit price, quantity) with the current rules """
+    return get_rules().quote(lines, country=country, discount_code=discount_code)
+
+
+def quote_total(total, country=None, discount_code=None):
+    """ Price an order total with the current rules """
+    return get_rules().quote_total(total, country=country, discount_code=discount_code)
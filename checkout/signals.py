@@ -1,7 +1,8 @@
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from .models import OrderLineItem
+from .models import OrderLineItem, DiscountCode
+from .pricing import bump_pricing_version
 
 # Instance, is the instance of the model that sent the signal.
 # Created, is a boolean sent by django referring to whether 
@@ -22,4 +23,13 @@ def update_on_delete(sender, instance, **kwargs):
     """
     Update order total on lineitem delete
     """
-    instance.order.update_total()
\ No newline at end of file
+    instance.order.update_total()
+
+@receiver(post_save, sender=DiscountCode)
+@receiver(post_delete, sender=DiscountCode)
+def refresh_pricing_rules(sender, **kwargs):
+    """
+    Move the pricing rules on to a new version so they're
+    compiled again with the changed discount code
+    """
+    bump_pricing_version()
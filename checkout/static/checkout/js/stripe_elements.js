@@ -78,6 +78,8 @@ form.addEventListener('submit', function(ev) {
         'csrfmiddlewaretoken': csrfToken,
         'client_secret': clientSecret,
         'save_info': saveInfo,
+        // Delivery is charged by country, so the amount is updated for it
+        'country': $.trim(form.country.value),
     };
     // Create variable for the new url
     var url = '/checkout/cache_checkout_data/';
@@ -0,0 +1,268 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from boutique_ado import queues
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(stripe.error.APIConnectionError):
+    """
+    Raised instead of calling Stripe while the circuit breaker is open,
+    so it's handled the same as Stripe being unreachable
+    """
+
+
+def _unavailable(error):
+    """ Whether an error means Stripe couldn't be reached or failed itself """
+    return (isinstance(error, stripe.error.APIConnectionError)
+            or (error.http_status or 0) >= 500)
+
+
+def _retryable(error):
+    """ Whether a call that failed with error may work if made again """
+    if isinstance(error, CircuitOpen):
+        return False
+    return _unavailable(error) or isinstance(error, stripe.error.RateLimitError)
+
+
+class CircuitBreaker:
+    """
+    Stops calls to Stripe for reset_seconds once failure_threshold
+    calls in a row have failed, so a Stripe outage fails checkouts
+    straight away instead of tying up every worker until they time
+    out. After that, one call is let through to try Stripe again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        """ Whether a call may be made now """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.reset_seconds:
+                return False
+            # This call tries Stripe again. Others are refused for
+            # another reset_seconds unless it works.
+            self.opened = time.monotonic()
+            return True
+
+    def record(self, succeeded):
+        """ Count the outcome of a call that was allowed """
+        with self.lock:
+            if succeeded:
+                if self.opened is not None:
+                    logger.info('Stripe is answering again, closing the circuit breaker')
+                self.failures = 0
+                self.opened = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened is None:
+                logger.error(
+                    'Stripe failed %d times in a row, not calling it for %ss',
+                    self.failures, self.reset_seconds)
+                self.opened = time.monotonic()
+
+
+class Metrics:
+    """ The number of calls, retries and errors, and latencies, of each operation """
+
+    def __init__(self, sample_size=1000):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.retries = Counter()
+        self.errors = defaultdict(Counter)
+        self.latencies = defaultdict(lambda: deque(maxlen=sample_size))
+
+    def record(self, operation, seconds, error=None, retries=0):
+        with self.lock:
+            self.calls[operation] += 1
+            self.retries[operation] += retries
+            self.latencies[operation].append(seconds * 1000)
+            if error is not None:
+                self.errors[operation][type(error).__name__] += 1
+
+    def snapshot(self):
+        """ The metrics so far, by operation, with latency percentiles """
+        with self.lock:
+            snapshot = {}
+            for operation, calls in self.calls.items():
+                latencies = sorted(self.latencies[operation])
+                snapshot[operation] = {
+                    'calls': calls,
+                    'retries': self.retries[operation],
+                    'errors': dict(self.errors[operation]),
+                    'latency_ms': {
+                        'p50': queues.percentile(latencies, 0.50),
+                        'p95': queues.percentile(latencies, 0.95),
+                        'p99': queues.percentile(latencies, 0.99),
+                        'max': queues.percentile(latencies, 1),
+                    },
+                }
+            return snapshot
+
+
+class StripeClient:
+    """
+    Makes the shop's calls to Stripe with its own key and a pool of
+    connections, instead of the stripe module's global api_key and http
+    client, so it's safe to share between threads.
+
+    Every call has connect and read timeouts. Calls that fail because
+    Stripe couldn't be reached, failed itself or was rate limited are
+    made again, up to max_retries times with backoff, and POSTs send an
+    idempotency key, kept across the retries, so Stripe only acts on
+    them once. The circuit breaker stops calls while Stripe is down, and
+    metrics records how each call went.
+    """
+
+    def __init__(self, api_key, api_base=None, connect_timeout=3, read_timeout=10,
+                 max_retries=2, retry_seconds=0.5, pool_size=10, breaker=None,
+                 metrics=None):
+        self.api_key = api_key
+        self.api_base = api_base or stripe.api_base
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_seconds = retry_seconds
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics or Metrics()
+        self._http_client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def http_client(self):
+        """ The pooled http client, made again in a process forked from this one """
+        if self._pid == os.getpid():
+            return self._http_client
+        with self._lock:
+            if self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._http_client = stripe.RequestsClient(
+                    timeout=(self.connect_timeout, self.read_timeout), session=session)
+                self._pid = os.getpid()
+        return self._http_client
+
+    def _request(self, operation, method, url, params=None, idempotency_key=None):
+        headers = {}
+        if method == 'post':
+            headers['Idempotency-Key'] = idempotency_key or uuid.uuid4().hex
+        start = time.perf_counter()
+        retries = 0
+        error = None
+        try:
+            while True:
+                if not self.breaker.allow():
+                    raise CircuitOpen(f'Stripe is failing, so {operation} was not attempted')
+                requestor = stripe.APIRequestor(
+                    key=self.api_key, client=self.http_client, api_base=self.api_base)
+                try:
+                    response, api_key = requestor.request(method, url, params, headers)
+                except stripe.error.StripeError as e:
+                    self.breaker.record(not _unavailable(e))
+                    if not _retryable(e) or retries >= self.max_retries:
+                        raise
+                    retries += 1
+                    delay = queues.retry_delay(
+                        retries, self.retry_seconds, self.retry_seconds * 2 ** self.max_retries)
+                    logger.warning(
+                        'Stripe %s failed, trying again in %.2fs: %s', operation, delay, e)
+                    time.sleep(delay)
+                else:
+                    self.breaker.record(True)
+                    return stripe.util.convert_to_stripe_object(response, api_key)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.metrics.record(operation, time.perf_counter() - start, error, retries)
+            # Errors that are the caller's to handle, such as a declined
+            # card, aren't logged here
+            if isinstance(error, stripe.error.StripeError) and _unavailable(error):
+                logger.warning('Stripe %s failed after %d retries: %s', operation, retries, error)
+
+    def create_payment_intent(self, idempotency_key=None, **params):
+        return self._request(
+            'create_payment_intent', 'post', '/v1/payment_intents', params, idempotency_key)
+
+    def modify_payment_intent(self, intent_id, idempotency_key=None, **params):
+        return self._request(
+            'modify_payment_intent', 'post', f'/v1/payment_intents/{quote(intent_id)}',
+            params, idempotency_key)
+
+    def retrieve_charge(self, charge_id):
+        return self._request('retrieve_charge', 'get', f'/v1/charges/{quote(charge_id)}')
+
+    def construct_event(self, payload, sig_header, secret):
+        """ Verify a webhook's signature and return its event, without calling Stripe """
+        start = time.perf_counter()
+        error = None
+        try:
+            return stripe.Webhook.construct_event(payload, sig_header, secret, api_key=self.api_key)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.metrics.record('construct_event', time.perf_counter() - start, error)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ The client shared by the whole process, made from the settings when first needed """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+                    read_timeout=settings.STRIPE_READ_TIMEOUT,
+                    max_retries=settings.STRIPE_MAX_RETRIES,
+                    retry_seconds=settings.STRIPE_RETRY_SECONDS,
+                    pool_size=settings.STRIPE_POOL_SIZE,
+                    breaker=CircuitBreaker(
+                        settings.STRIPE_CIRCUIT_FAILURES,
+                        settings.STRIPE_CIRCUIT_RESET_SECONDS),
+                )
+    return _client
+
+
+@contextmanager
+def use_client(client):
+    """ Share client instead inside the block, such as one for a fake Stripe """
+    global _client
+    previous = _client
+    _client = client
+    try:
+        yield client
+    finally:
+        _client = previous
@@ -0,0 +1,170 @@
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from checkout.stripe_client import StripeClient
+
+
+def sign(payload, secret, timestamp=None):
+    """ The Stripe-Signature header Stripe would send with a webhook payload """
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(
+        secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def _parse(body):
+    """ Stripe's form encoded parameters, with metadata[key] as a dict """
+    params = {}
+    for name, value in parse_qsl(body, keep_blank_values=True):
+        nested = re.fullmatch(r'(\w+)\[(\w+)\]', name)
+        if nested:
+            params.setdefault(nested.group(1), {})[nested.group(2)] = value
+        else:
+            params[name] = value
+    return params
+
+
+def _error(status, message, error_type='invalid_request_error'):
+    return status, {'error': {'type': error_type, 'message': message}}
+
+
+class _StripeHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, as Stripe does
+    protocol_version = 'HTTP/1.1'
+    # Otherwise the body waits for the headers to be acknowledged
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.answer(self)
+
+    do_POST = do_GET
+
+
+class FakeStripe(ThreadingHTTPServer):
+    """
+    A local stand-in for the parts of the Stripe API the shop uses:
+    creating and modifying payment intents, and retrieving the charges
+    put in charges. Idempotency keys are honoured, and calls counts
+    what was actually done, so retries can be checked.
+
+    The next requests can be made to fail by adding to faults, an HTTP
+    status to answer with, or a number of seconds to wait after acting
+    on the request and before answering it. Used as a context manager,
+    it listens on a free port on localhost in a thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        super().__init__(('127.0.0.1', 0), _StripeHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.intents = {}
+        self.charges = {}
+        self.faults = []
+        self.calls = Counter()
+        self.requests = 0
+        self.connections = set()
+        self._idempotent = {}
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def client(self, **kwargs):
+        """ A StripeClient that calls this fake """
+        return StripeClient('sk_test_fake', api_base=self.url, **kwargs)
+
+    def answer(self, handler):
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        key = handler.headers.get('Idempotency-Key')
+        with self.lock:
+            self.requests += 1
+            self.connections.add(handler.client_address)
+            fault = self.faults.pop(0) if self.faults else None
+        if self.latency:
+            time.sleep(self.latency)
+
+        if isinstance(fault, int):
+            status, data = _error(fault, 'Something went wrong on the fake', 'api_error')
+        else:
+            with self.lock:
+                if key in self._idempotent:
+                    self.calls['replayed'] += 1
+                    status, data = self._idempotent[key]
+                else:
+                    status, data = self._route(
+                        handler.command, handler.path, _parse(body.decode()))
+                    if key:
+                        self._idempotent[key] = status, data
+            if fault:
+                time.sleep(fault)
+
+        content = json.dumps(data).encode()
+        try:
+            handler.send_response(status)
+            handler.send_header('Content-Type', 'application/json')
+            handler.send_header('Content-Length', str(len(content)))
+            handler.end_headers()
+            handler.wfile.write(content)
+        except OSError:
+            # The client gave up waiting
+            pass
+
+    def _route(self, method, path, params):
+        if method == 'POST' and path == '/v1/payment_intents':
+            self.calls['create_payment_intent'] += 1
+            intent_id = f'pi_fake{random.getrandbits(64):016x}'
+            self.intents[intent_id] = {
+                'id': intent_id,
+                'object': 'payment_intent',
+                'amount': int(params['amount']),
+                'currency': params['currency'],
+                'client_secret': f'{intent_id}_secret_fake',
+                'status': 'requires_payment_method',
+                'metadata': params.get('metadata', {}),
+            }
+            return 200, self.intents[intent_id]
+
+        found = re.fullmatch(r'/v1/payment_intents/(\w+)', path)
+        if method == 'POST' and found:
+            intent = self.intents.get(found.group(1))
+            if intent is None:
+                return _error(404, f'No such payment_intent: {found.group(1)}')
+            if intent['status'] == 'succeeded':
+                return _error(400, 'This PaymentIntent could not be updated because '
+                                   'it has a status of succeeded.')
+            self.calls['modify_payment_intent'] += 1
+            if 'amount' in params:
+                intent['amount'] = int(params['amount'])
+            intent['metadata'].update(params.get('metadata', {}))
+            return 200, intent
+
+        found = re.fullmatch(r'/v1/charges/(\w+)', path)
+        if method == 'GET' and found:
+            if found.group(1) not in self.charges:
+                return _error(404, f'No such charge: {found.group(1)}')
+            self.calls['retrieve_charge'] += 1
+            return 200, self.charges[found.group(1)]
+
+        return _error(404, f'Unrecognized request URL ({method}: {path})')
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,232 @@
+import json
+import random
+import threading
+import time
+from unittest import mock
+
+import stripe
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from bag.cart import CART_SESSION_KEY
+from bag.models import Cart
+from checkout import orders, pricing, webhook_handler, webhook_queue
+from checkout.models import DiscountCode, Order, OrderLineItem, WebhookEvent
+from checkout.stripe_client import use_client
+from outbox.models import OutgoingEmail
+from products.tests import make_catalog
+from .fake_stripe import FakeStripe, sign
+from .test_views import make_order
+
+WEBHOOK_SECRET = 'whsec_race'
+
+
+@override_settings(
+    STRIPE_WH_SECRET=WEBHOOK_SECRET,
+    DEFAULT_FROM_EMAIL='shop@example.com',
+    OUTBOX_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class CheckoutWebhookRaceTests(TransactionTestCase):
+    """
+    The checkout form and the payment_intent.succeeded webhook for the
+    same payment, submitted at the same instant, make exactly one
+    complete order between them whichever gets there first
+    """
+    rounds = 20
+    # Each request is held back by up to this long once both are
+    # released, so either can win
+    jitter = 0.1
+
+    def setUp(self):
+        self.products = make_catalog(categories=1, products_per_category=5)
+        self.fake = FakeStripe()
+        self.fake.__enter__()
+        self.addCleanup(self.fake.__exit__)
+        client = use_client(self.fake.client())
+        client.__enter__()
+        self.addCleanup(client.__exit__, None, None, None)
+
+        # Which orders the webhook made, rather than found
+        self.webhook_created = {}
+
+        def create_order(order, bag, on_saved=None):
+            order, created = orders.create_order(order, bag, on_saved)
+            self.webhook_created[order.stripe_pid] = created
+            return order, created
+
+        patcher = mock.patch.object(webhook_handler, 'create_order', create_order)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_view_and_webhook_race(self):
+        for round_number in range(self.rounds):
+            with self.subTest(round=round_number):
+                self._race(f'pi_race_{round_number}')
+        # The webhook handled every payment, making or finding its order
+        self.assertEqual(len(self.webhook_created), self.rounds)
+
+    def _race(self, pid):
+        shopper = Client(raise_request_exception=False)
+        for product in self.products:
+            shopper.post(reverse('add_to_bag', args=[product.id]), {
+                'quantity': random.randint(1, 3), 'redirect_url': '/'})
+        cart = Cart.objects.get(id=shopper.session[CART_SESSION_KEY])
+        bag = cart.as_bag()
+
+        email = f'{pid}@example.com'
+        form = {
+            'full_name': 'Race Shopper', 'email': email, 'phone_number': '0123456789',
+            'country': 'IE', 'postcode': '', 'town_or_city': 'Dublin',
+            'street_address1': '1 Main Street', 'street_address2': '', 'county': '',
+            'client_secret': f'{pid}_secret_race',
+        }
+        self.fake.charges[f'ch_{pid}'] = {
+            'id': f'ch_{pid}', 'object': 'charge',
+            'billing_details': {'email': email},
+            'amount': pricing.quote_total(cart.total, country='IE').grand_total.cents,
+        }
+        event = {
+            'id': f'evt_{pid}', 'object': 'event', 'type': 'payment_intent.succeeded',
+            'data': {'object': {
+                'id': pid, 'object': 'payment_intent', 'latest_charge': f'ch_{pid}',
+                'metadata': {
+                    'bag': json.dumps(bag), 'save_info': '',
+                    'username': 'AnonymousUser', 'discount_code': '',
+                },
+                'shipping': {
+                    'name': form['full_name'], 'phone': form['phone_number'],
+                    'address': {
+                        'country': 'IE', 'postal_code': '', 'city': 'Dublin',
+                        'line1': '1 Main Street', 'line2': '', 'state': '',
+                    },
+                },
+            }},
+        }
+
+        # Both requests are held at the barrier until both are ready
+        start = threading.Barrier(2)
+        responses = {}
+
+        def submit_form():
+            start.wait()
+            time.sleep(random.uniform(0, self.jitter))
+            responses['view'] = shopper.post(reverse('checkout'), form)
+            connections.close_all()
+
+        def deliver_webhook():
+            start.wait()
+            time.sleep(random.uniform(0, self.jitter))
+            payload = json.dumps(event)
+            responses['webhook'] = Client(raise_request_exception=False).post(
+                reverse('webhook'), payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=sign(payload, WEBHOOK_SECRET))
+            # The webhook view only queues the event, so it's handled
+            # here straight away, as a waiting worker would
+            webhook_queue.work()
+            connections.close_all()
+
+        threads = [threading.Thread(target=submit_form), threading.Thread(target=deliver_webhook)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        order = Order.objects.get(stripe_pid=pid)
+        self.assertEqual(order.grand_total.cents, self.fake.charges[f'ch_{pid}']['amount'])
+        self.assertEqual(order.lineitems.count(), len(self.products))
+        self.assertRedirects(
+            responses['view'], reverse('checkout_success', args=[order.order_number]),
+            fetch_redirect_response=False)
+        self.assertEqual(responses['webhook'].status_code, 200)
+        webhook_event = WebhookEvent.objects.get(event_id=event['id'])
+        self.assertEqual(webhook_event.status, WebhookEvent.DONE, webhook_event.last_error)
+        self.assertTrue(OutgoingEmail.objects.filter(
+            key=f'order-confirmation:{order.order_number}').exists())
+
+
+class OrderTotalTests(TestCase):
+    """ Orders keep the discount and delivery they were placed with """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog(categories=1, products_per_category=2)
+
+    def test_lines_changed_after_placing(self):
+        code = DiscountCode.objects.create(code='TENOFF', percentage=10)
+        order, created = orders.create_order(Order(
+            full_name='Test Shopper', email='shopper@example.com',
+            phone_number='0123456789', country='IE', town_or_city='Dublin',
+            street_address1='1 Test Street', discount_code='TENOFF',
+        ), {str(self.products[0].id): 1})
+        self.assertTrue(created)
+        quote = pricing.quote_total(self.products[0].price, country='IE', discount_code='TENOFF')
+        self.assertEqual(order.discount, quote.discount)
+        self.assertEqual(order.delivery_cost, quote.delivery)
+        self.assertTrue(order.discount and order.delivery_cost)
+
+        # The code has since ended, and enough is added to the order
+        # for today's rules to deliver it for free
+        code.active = False
+        code.save()
+        OrderLineItem.objects.create(order=order, product=self.products[1], quantity=40)
+        order.refresh_from_db()
+        self.assertEqual(order.discount_code, 'TENOFF')
+        self.assertEqual(order.discount, quote.discount)
+        self.assertEqual(order.delivery_cost, quote.delivery)
+        self.assertEqual(order.order_total, self.products[0].price + self.products[1].price * 40)
+        self.assertEqual(
+            order.grand_total, order.order_total - order.discount + order.delivery_cost)
+
+
+@override_settings(DEFAULT_FROM_EMAIL='shop@example.com')
+class WebhookProfileTests(TestCase):
+    """
+    The webhook saves the shopper's details to their profile only
+    when it creates the order, and queues the email either way
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog(categories=1, products_per_category=1)
+        cls.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+
+    def handle(self, pid, amount):
+        charge = stripe.Charge.construct_from({
+            'id': f'ch_{pid}', 'billing_details': {'email': 'shopper@example.com'},
+            'amount': amount.cents,
+        }, 'sk_test')
+        event = stripe.Event.construct_from({
+            'id': f'evt_{pid}', 'type': 'payment_intent.succeeded',
+            'data': {'object': {
+                'id': pid, 'latest_charge': charge.id,
+                'metadata': {
+                    'bag': json.dumps({str(self.products[0].id): 1}),
+                    'save_info': 'on', 'username': 'shopper', 'discount_code': '',
+                },
+                'shipping': {
+                    'name': 'Test Shopper', 'phone': '0123456789',
+                    'address': {
+                        'country': 'IE', 'postal_code': '', 'city': 'Galway',
+                        'line1': '1 Main Street', 'line2': '', 'state': '',
+                    },
+                },
+            }},
+        }, 'sk_test')
+        client = mock.Mock(**{'retrieve_charge.return_value': charge})
+        with mock.patch.object(webhook_handler, 'get_client', return_value=client):
+            response = webhook_handler.StripeWH_Handler().dispatch(event)
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.get(stripe_pid=pid)
+        self.assertTrue(OutgoingEmail.objects.filter(
+            key=f'order-confirmation:{order.order_number}').exists())
+        self.user.userprofile.refresh_from_db()
+        return self.user.userprofile
+
+    def test_order_created_by_webhook(self):
+        amount = pricing.quote_total(self.products[0].price, country='IE').grand_total
+        self.assertEqual(self.handle('pi_webhook', amount).default_town_or_city, 'Galway')
+
+    def test_order_already_saved_by_checkout(self):
+        order = make_order(self.products, self.user.userprofile, stripe_pid='pi_checkout')
+        self.assertIsNone(self.handle('pi_checkout', order.grand_total).default_town_or_city)
@@ -0,0 +1,84 @@
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from checkout import payments
+from checkout.stripe_client import use_client
+from products.tests import make_catalog
+from .fake_stripe import FakeStripe
+
+
+@override_settings(STRIPE_PUBLIC_KEY='pk_test_fake')
+class PaymentIntentReuseTests(TestCase):
+    """
+    Reloading the checkout page reuses the session's payment intent,
+    which is only changed or replaced when it has to be
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog(categories=1, products_per_category=2)
+
+    def setUp(self):
+        self.fake = FakeStripe()
+        self.fake.__enter__()
+        self.addCleanup(self.fake.__exit__)
+        client = use_client(self.fake.client())
+        client.__enter__()
+        self.addCleanup(client.__exit__, None, None, None)
+        self.add(self.products[0])
+
+    def add(self, product):
+        self.client.post(reverse('add_to_bag', args=[product.id]), {
+            'quantity': 1, 'redirect_url': '/'})
+
+    def open_checkout(self):
+        response = self.client.get(reverse('checkout'))
+        self.assertEqual(response.status_code, 200)
+        return response.context['client_secret']
+
+    def submit(self, client_secret, save_info=''):
+        response = self.client.post(reverse('cache_checkout_data'), {
+            'client_secret': client_secret, 'save_info': save_info, 'country': 'IE',
+        })
+        self.assertEqual(response.status_code, 200)
+
+    def assertStripeCalls(self, creates, modifies):
+        self.assertEqual(
+            (self.fake.calls['create_payment_intent'], self.fake.calls['modify_payment_intent']),
+            (creates, modifies))
+
+    def test_unchanged_reload_makes_no_calls(self):
+        first = self.open_checkout()
+        self.assertStripeCalls(creates=1, modifies=0)
+        self.assertEqual(self.open_checkout(), first)
+        self.assertEqual(self.open_checkout(), first)
+        self.assertStripeCalls(creates=1, modifies=0)
+        self.assertEqual(
+            self.client.session[payments.PAYMENT_INTENT_SESSION_KEY]['client_secret'], first)
+
+    def test_resubmitting_unchanged_form_makes_no_calls(self):
+        client_secret = self.open_checkout()
+        self.submit(client_secret)
+        self.assertStripeCalls(creates=1, modifies=1)
+        self.submit(client_secret)
+        self.assertStripeCalls(creates=1, modifies=1)
+        self.submit(client_secret, save_info='on')
+        self.assertStripeCalls(creates=1, modifies=2)
+
+    def test_changed_amount_modifies_the_intent(self):
+        first = self.open_checkout()
+        self.add(self.products[1])
+        self.assertEqual(self.open_checkout(), first)
+        self.assertStripeCalls(creates=1, modifies=1)
+        pid = first.split('_secret')[0]
+        self.assertEqual(
+            self.fake.intents[pid]['amount'],
+            self.client.session[payments.PAYMENT_INTENT_SESSION_KEY]['amount'])
+
+    def test_paid_intent_is_replaced(self):
+        first = self.open_checkout()
+        self.fake.intents[first.split('_secret')[0]]['status'] = 'succeeded'
+        self.add(self.products[1])
+        second = self.open_checkout()
+        self.assertNotEqual(second, first)
+        self.assertStripeCalls(creates=2, modifies=0)
@@ -0,0 +1,166 @@
+import random
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.test import SimpleTestCase
+
+from boutique_ado.money import Money, MoneyField
+from checkout.pricing import Discount, RuleSet
+
+CENT = Decimal('0.01')
+
+
+def decimal_cents(value):
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def decimal_quote(lines, tiers, discount):
+    """
+    The bag and order totals worked out with Decimals, the way they
+    were before amounts were held in cents. Used as the reference the
+    integer totals have to match.
+    """
+    line_totals = [price * quantity for price, quantity in lines]
+    total = sum(line_totals, Decimal('0'))
+    amount_off = Decimal('0')
+    if discount is not None and total >= discount['minimum_spend']:
+        amount_off = min(
+            decimal_cents(total * discount['percentage'] / 100 + discount['amount']), total)
+    charged = total - amount_off
+    percentage = Decimal('0')
+    for threshold, tier_percentage in sorted(tiers):
+        if charged >= threshold:
+            percentage = tier_percentage
+    delivery = decimal_cents(charged * percentage / 100)
+    free = sorted(threshold for threshold, tier_percentage in tiers if not tier_percentage)
+    free_delivery_delta = free[0] - charged if free and charged < free[0] else Decimal('0')
+    return {
+        'line_totals': line_totals,
+        'total': total,
+        'discount': amount_off,
+        'delivery': delivery,
+        'free_delivery_delta': free_delivery_delta,
+        'grand_total': charged + delivery,
+    }
+
+
+def cents_quote(lines, tiers, discount):
+    """ The same totals from RuleSet, in cents, as Decimals to compare """
+    rules = RuleSet(tiers, discounts=discount and [Discount('TEST', **discount)])
+    quote = rules.quote(
+        [(Money.parse(price), quantity) for price, quantity in lines],
+        discount_code=discount and 'TEST')
+    return {
+        'line_totals': [line.to_decimal() for line in quote.line_totals],
+        'total': quote.total.to_decimal(),
+        'discount': quote.discount.to_decimal(),
+        'delivery': quote.delivery.to_decimal(),
+        'free_delivery_delta': quote.free_delivery_delta.to_decimal(),
+        'grand_total': quote.grand_total.to_decimal(),
+    }, quote
+
+
+class RandomBags:
+    """ Seeded generator of bags, delivery tiers and discounts """
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def amount(self, high):
+        # Whole dollars and round numbers turn up often in real prices,
+        # and are where rounding and threshold mistakes show
+        rng = self.rng
+        cents = rng.choice([rng.randint(0, high), rng.randint(0, high // 100) * 100, 4999, 5000])
+        return Decimal(cents) / 100
+
+    def percentage(self):
+        rng = self.rng
+        return Decimal(rng.choice(
+            [0, 5, 10, 12.5, 15, 33.33, 50, 100, rng.randint(0, 10000) / 100])).quantize(CENT)
+
+    def example(self):
+        rng = self.rng
+        lines = [
+            (self.amount(99999), rng.randint(1, 99))
+            for _ in range(rng.randint(0, 30))
+        ]
+        tiers = [(Decimal('0'), self.percentage())] + [
+            (self.amount(50000), self.percentage())
+            for _ in range(rng.randint(0, 3))
+        ]
+        discount = None
+        if rng.random() < 0.5:
+            discount = {
+                'percentage': self.percentage(),
+                'amount': self.amount(5000),
+                'minimum_spend': self.amount(10000),
+            }
+        return lines, tiers, discount
+
+
+class MoneyParityTests(SimpleTestCase):
+    """
+    Totals worked out in whole cents match the same totals worked out
+    with Decimals, for many generated bags and for the edge cases
+    """
+    seed = 20240128
+    examples = 10000
+
+    def assertSameTotals(self, lines, tiers, discount=None):
+        actual, quote = cents_quote(lines, tiers, discount)
+        self.assertEqual(
+            actual, decimal_quote(lines, tiers, discount),
+            f'lines={lines} tiers={tiers} discount={discount}')
+        return quote
+
+    def test_random_bags(self):
+        bags = RandomBags(self.seed)
+        field = MoneyField()
+        for example in range(self.examples):
+            lines, tiers, discount = bags.example()
+            with self.subTest(example=example, seed=self.seed):
+                quote = self.assertSameTotals(lines, tiers, discount)
+                # Amounts stored and read back, or shown and parsed
+                # again, must come back unchanged
+                for amount in (quote.total, quote.grand_total, -quote.discount):
+                    self.assertEqual(
+                        field.from_db_value(field.get_prep_value(amount), None, None), amount)
+                    self.assertEqual(Money.parse(str(amount)), amount)
+
+    def test_half_cents_round_up(self):
+        # 5% of 0.10 is half a cent of delivery
+        quote = self.assertSameTotals([(Decimal('0.10'), 1)], [(Decimal('0'), Decimal('5'))])
+        self.assertEqual(quote.delivery, Money(1))
+        # 5% of 0.30 is a cent and a half off
+        quote = self.assertSameTotals(
+            [(Decimal('0.10'), 3)], [(Decimal('0'), Decimal('0'))],
+            {'percentage': Decimal('5'), 'amount': Decimal('0'), 'minimum_spend': Decimal('0')})
+        self.assertEqual(quote.discount, Money(2))
+
+    def test_free_delivery_threshold(self):
+        tiers = [(Decimal('0'), Decimal('10')), (Decimal('50'), Decimal('0'))]
+        quote = self.assertSameTotals([(Decimal('49.99'), 1)], tiers)
+        self.assertEqual(quote.delivery, Money(500))
+        self.assertEqual(quote.free_delivery_delta, Money(1))
+
+        quote = self.assertSameTotals([(Decimal('25.00'), 2)], tiers)
+        self.assertEqual(quote.delivery, Money(0))
+        self.assertEqual(quote.free_delivery_delta, Money(0))
+
+        # A discount taking the total below the threshold brings delivery back
+        quote = self.assertSameTotals(
+            [(Decimal('50.00'), 1)], tiers,
+            {'percentage': Decimal('0'), 'amount': Decimal('0.01'), 'minimum_spend': Decimal('0')})
+        self.assertEqual(quote.delivery, Money(500))
+
+    def test_empty_bag(self):
+        tiers = [(Decimal('0'), Decimal('10')), (Decimal('50'), Decimal('0'))]
+        quote = self.assertSameTotals([], tiers)
+        self.assertEqual(quote.grand_total, Money(0))
+        self.assertEqual(quote.free_delivery_delta, Money(5000))
+
+        # A fixed discount can't take an empty bag below nothing
+        quote = self.assertSameTotals(
+            [], tiers,
+            {'percentage': Decimal('0'), 'amount': Decimal('5'), 'minimum_spend': Decimal('0')})
+        self.assertEqual(quote.discount, Money(0))
+        self.assertEqual(quote.grand_total, Money(0))
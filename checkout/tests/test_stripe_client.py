@@ -0,0 +1,100 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.test import SimpleTestCase
+
+from checkout.stripe_client import CircuitBreaker, CircuitOpen
+from .fake_stripe import FakeStripe, sign
+
+
+class StripeClientTests(SimpleTestCase):
+    """ The Stripe client against a local fake Stripe """
+
+    def setUp(self):
+        self.fake = FakeStripe()
+        self.fake.__enter__()
+        self.addCleanup(self.fake.__exit__)
+
+    def test_threads_share_a_few_connections(self):
+        client = self.fake.client(pool_size=8)
+        with ThreadPoolExecutor(8) as pool:
+            intents = list(pool.map(
+                lambda amount: client.create_payment_intent(amount=amount, currency='usd'),
+                range(100, 200)))
+
+        self.assertEqual(len({intent.id for intent in intents}), 100)
+        self.assertEqual(self.fake.calls['create_payment_intent'], 100)
+        self.assertLessEqual(len(self.fake.connections), 8)
+        self.assertEqual(client.metrics.snapshot()['create_payment_intent']['calls'], 100)
+
+    def test_server_errors_are_retried(self):
+        client = self.fake.client(max_retries=2, retry_seconds=0.05)
+        self.fake.faults += [500, 503]
+        with self.assertLogs('checkout.stripe_client', 'WARNING'):
+            intent = client.create_payment_intent(amount=500, currency='usd')
+        self.assertEqual(self.fake.requests, 3)
+        self.assertEqual(intent.amount, 500)
+
+    def test_timed_out_call_is_retried_and_only_acted_on_once(self):
+        client = self.fake.client(read_timeout=0.3, max_retries=2, retry_seconds=0.05)
+        intent = client.create_payment_intent(amount=500, currency='usd')
+        # The first request is acted on but answered too late
+        self.fake.faults.append(1.0)
+        with self.assertLogs('checkout.stripe_client', 'WARNING'):
+            client.modify_payment_intent(intent.id, amount=600)
+        self.assertEqual(self.fake.calls['modify_payment_intent'], 1)
+        self.assertEqual(self.fake.calls['replayed'], 1)
+        self.assertEqual(self.fake.intents[intent.id]['amount'], 600)
+
+    def test_retries_stop_after_max_retries(self):
+        client = self.fake.client(max_retries=2, retry_seconds=0.05)
+        self.fake.faults += [500, 500, 500]
+        with self.assertLogs('checkout.stripe_client', 'WARNING') as logs:
+            with self.assertRaises(stripe.error.APIError):
+                client.retrieve_charge('ch_missing')
+        self.assertEqual(self.fake.requests, 3)
+        self.assertIn('failed after 2 retries', logs.output[-1])
+
+    def test_client_errors_are_not_retried(self):
+        client = self.fake.client(max_retries=2, retry_seconds=0.05)
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            client.retrieve_charge('ch_missing')
+        self.assertEqual(self.fake.requests, 1)
+
+    def test_circuit_breaker(self):
+        client = self.fake.client(
+            max_retries=0, breaker=CircuitBreaker(failure_threshold=3, reset_seconds=0.5))
+        intent = client.create_payment_intent(amount=100, currency='usd')
+        self.fake.faults += [500] * 3
+        with self.assertLogs('checkout.stripe_client', 'WARNING'):
+            for _ in range(3):
+                with self.assertRaises(stripe.error.APIError):
+                    client.modify_payment_intent(intent.id, amount=200)
+
+        # Calls are refused without reaching Stripe while it's failing
+        requests = self.fake.requests
+        with self.assertLogs('checkout.stripe_client', 'WARNING'):
+            with self.assertRaises(CircuitOpen):
+                client.modify_payment_intent(intent.id, amount=200)
+        self.assertEqual(self.fake.requests, requests)
+        self.assertTrue(client.breaker.is_open)
+
+        # and allowed again once it answers
+        time.sleep(0.6)
+        with self.assertLogs('checkout.stripe_client', 'INFO'):
+            client.modify_payment_intent(intent.id, amount=300)
+        self.assertFalse(client.breaker.is_open)
+        self.assertEqual(self.fake.intents[intent.id]['amount'], 300)
+
+    def test_webhook_signatures(self):
+        client = self.fake.client()
+        payload = json.dumps({
+            'id': 'evt_test', 'object': 'event', 'type': 'payment_intent.succeeded',
+            'data': {'object': {'id': 'pi_test', 'object': 'payment_intent'}},
+        })
+        event = client.construct_event(payload, sign(payload, 'whsec_test'), 'whsec_test')
+        self.assertEqual(event.data.object.id, 'pi_test')
+        with self.assertRaises(stripe.error.SignatureVerificationError):
+            client.construct_event(payload, sign(payload, 'whsec_other'), 'whsec_test')
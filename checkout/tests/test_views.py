@@ -0,0 +1,52 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from boutique_ado.testing import QueryBudgetMixin
+from products.tests import make_catalog
+from checkout.models import Order, OrderLineItem
+
+
+def make_order(products, user_profile=None, **fields):
+    """ Create an order with a line for each of products """
+    order = Order.objects.create(
+        user_profile=user_profile,
+        full_name='Test Shopper',
+        email='shopper@example.com',
+        phone_number='0123456789',
+        country='IE',
+        town_or_city='Dublin',
+        street_address1='1 Test Street',
+        **fields,
+    )
+    for product in products:
+        OrderLineItem.objects.create(order=order, product=product, quantity=2)
+    order.update_total()
+    return order
+
+
+class CheckoutSuccessQueryTests(QueryBudgetMixin, TestCase):
+    """ The checkout success page stays within its budget in QUERY_BUDGETS """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog(categories=1)
+        cls.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+
+    def test_anonymous_checkout_success(self):
+        order = make_order(self.products)
+        response = self.assertWithinQueryBudget(
+            f'/checkout/checkout_success/{order.order_number}')
+        self.assertContains(response, order.order_number)
+
+    def test_checkout_success_saving_info(self):
+        order = make_order(self.products)
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['save_info'] = True
+        session.save()
+
+        response = self.assertWithinQueryBudget(
+            f'/checkout/checkout_success/{order.order_number}')
+        self.assertContains(response, order.order_number)
+        order.refresh_from_db()
+        self.assertEqual(order.user_profile, self.user.userprofile)
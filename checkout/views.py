@@ -4,15 +4,24 @@ from django.contrib import messages
 from django.conf import settings
 
 from .forms import OrderForm
-from .models import Order, OrderLineItem
+from .models import Order
+from .orders import create_order
+from . import payments, pricing
 from products.models import Product
 from profiles.forms import UserProfileForm
 from profiles.models import UserProfile
-from bag.contexts import bag_contents
+from bag import cart
+from bag.contexts import get_bag_contents
+from inventory import stock
 
 import stripe
 import json
 
+
+def to_stripe_amount(total):
+    """ Stripe takes amounts in cents, which is how Money holds them """
+    return total.cents
+
 @require_POST
 def cache_checkout_data(request):
     try:
@@ -21,17 +30,27 @@ def cache_checkout_data(request):
         # the 1st part will be the 'Payment Intent Id'. This is then
         # stored in a variable called 'pid'
         pid = request.POST.get('client_secret').split('_secret')[0]
-        # Set up stripe using secret key to modify the payment intent
-        stripe.api_key = settings.STRIPE_SECRET_KEY
         # Give payment intent the pid and tell it what we want to modify.
         # In this case we are adding some metadata
-        stripe.PaymentIntent.modify(pid, metadata={
+        # Delivery depends on the country the order is going to, so the
+        # bag is priced again for it and the amount to charge updated.
+        # These are the same rules Order.price_order uses for the order.
+        discount_code = request.session.get(pricing.DISCOUNT_SESSION_KEY, '')
+        contents = get_bag_contents(request)
+        quote = pricing.quote_total(
+            contents['total'], country=request.POST.get('country'),
+            discount_code=discount_code)
+        # Stripe is only asked to change the intent if the amount or
+        # metadata differ from what was last sent for it
+        payments.update_payment_intent(request, pid, to_stripe_amount(quote.grand_total), {
             # Add json dump of users shopping bag
-            'bag': json.dumps(request.session.get('bag', {})),
+            'bag': json.dumps(cart.get_bag(request)),
             # If they checked to save their information
             'save_info': request.POST.get('save_info'),
             # User placing the order
             'username': request.user,
+            # Discount code for the webhook to apply to the order
+            'discount_code': quote.discount_code,
         })
         return HttpResponse(status=200)
     # Error message if anything goes wrong
@@ -42,16 +61,15 @@ def cache_checkout_data(request):
 
 def checkout(request):
     stripe_public_key = settings.STRIPE_PUBLIC_KEY
-    stripe_secret_key = settings.STRIPE_SECRET_KEY
 
-    bag = request.session.get('bag', {})
+    # The cart in the same format as Order.original_bag
+    bag = cart.get_bag(request)
     # Prevents manually entering checkout url
     if not bag:
         messages.error(request, "There's nothing in your bag at the moment")
         return redirect(reverse('products'))
 
     if request.method == 'POST':
-        bag = request.session.get('bag', {})
 
         # Putting form data into dictionary.
         # Done manually in order to skip the save infobox
@@ -76,48 +94,26 @@ def checkout(request):
             order = order_form.save(commit=False)
             # Get payment id for this specific order
             pid = request.POST.get('client_secret').split('_secret')[0]
-            order.stripe_pid = pid
+            order.stripe_pid = pid or None
             # Set original shopping bag on the model and dump
             # shopping bag to a json string and set on the order
             order.original_bag = json.dumps(bag)
-            # save the order
-            order.save()
-            for item_id, item_data in bag.items():
-                try:
-                    # Get product id out of bag
-                    product = Product.objects.get(id=item_id)
-                    # If the items value is an integer, then we are
-                    # working with an item that does not have sizes
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            # No size sets the quantity to the item_data
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    # else, we are working with an item that does have sizes
-                    else:
-                        # Iterate through each size and
-                        # create a line item accordingly
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-                # This should generally never happen, but If a product isnt found, 
-                # an error message is displayed, the empty order will be deleted,
-                # and the user will be returned to the shopping bag page.
-                except Product.DoesNotExist:
-                    messages.error(request, (
-                        "One of the products in your bag wasn't found in our database. "
-                        "Please call us for assistance!")
-                    )
-                    order.delete()
-                    return redirect(reverse('view_bag'))
+            # The discount is checked again when the order is totalled
+            order.discount_code = request.session.get(pricing.DISCOUNT_SESSION_KEY, '')
+            # Save the order with a line item for each line in the bag.
+            # If the webhook has already made the order for this payment,
+            # that order is used instead.
+            # This should generally never happen, but If a product isnt found,
+            # an error message is displayed, nothing is saved,
+            # and the user will be returned to the shopping bag page.
+            try:
+                order, _ = create_order(order, bag)
+            except Product.DoesNotExist:
+                messages.error(request, (
+                    "One of the products in your bag wasn't found in our database. "
+                    "Please call us for assistance!")
+                )
+                return redirect(reverse('view_bag'))
 
             # checking if the user requested to save their information
             request.session['save_info'] = 'save-info' in request.POST
@@ -130,20 +126,58 @@ def checkout(request):
             messages.error(request, 'There was an error with your form. \
                 Please double check your information.')
     else:
-        bag = request.session.get('bag', {})
+        # Resolved once here and reused by the template
+        current_bag = get_bag_contents(request)
         # Prevents manually entering checkout url
-        if not bag:
+        if not current_bag['bag_items']:
             messages.error(request, "There's nothing in your bag at the moment")
             return redirect(reverse('products'))
 
-        current_bag = bag_contents(request)
+        # The totals shown around the site are the ones stored with the
+        # cart. Payment is always for the current prices, read above, and
+        # if the stored totals have fallen behind them they're put right.
+        cart_id = cart.get_cart_id(request)
+        stored_total, _ = cart.get_totals(cart_id)
+        if stored_total != current_bag['total']:
+            cart.refresh_totals(cart_id)
+            messages.info(request, 'Some prices in your bag have changed since you added them.')
+
         total = current_bag['grand_total']
-        stripe_total = round(total * 100)
-        stripe.api_key = stripe_secret_key
-        intent = stripe.PaymentIntent.create(
-            amount=stripe_total,
-            currency=settings.STRIPE_CURRENCY,
-        )
+        stripe_total = to_stripe_amount(total)
+        # Reloading the page reuses the payment intent made on the first
+        # visit, and only changes it if the bag has changed since
+        # If Stripe can't be reached, or is failing, the shopper is
+        # sent back to their bag rather than kept waiting
+        try:
+            pid, client_secret, changed = payments.get_payment_intent(request, bag, stripe_total)
+        except stripe.error.StripeError:
+            messages.error(request, "Sorry, we can't take payments right now. \
+                Please try again in a few minutes.")
+            return redirect(reverse('view_bag'))
+
+        # The stock is held until the payment succeeds, fails or expires,
+        # so two shoppers can't pay for the last one. Stock held on an
+        # earlier visit is kept if the bag hasn't changed, and otherwise
+        # given back before the bag's stock is held again.
+        previous = request.session.get(stock.RESERVATION_SESSION_KEY)
+        try:
+            if changed or previous != pid or not stock.is_held(pid):
+                stock.release(previous)
+                stock.reserve(pid, [
+                    (item['item_id'], item.get('size'), item['quantity'])
+                    for item in current_bag['bag_items']
+                ])
+        except stock.OutOfStock as e:
+            product = next(
+                item['product'] for item in current_bag['bag_items']
+                if int(item['item_id']) == e.product_id)
+            size = f'size {e.size.upper()} ' if e.size else ''
+            if e.available:
+                messages.error(request, f'Sorry, there are only {e.available} of {size}{product.name} left')
+            else:
+                messages.error(request, f'Sorry, {size}{product.name} is out of stock')
+            return redirect(reverse('view_bag'))
+        request.session[stock.RESERVATION_SESSION_KEY] = pid
 
         # If the user is authenticated, attempt to prefill the
         # form with any info the user maintains in their profile
@@ -177,7 +211,7 @@ def checkout(request):
     context = {
         'order_form': order_form,
         'stripe_public_key': stripe_public_key,
-        'client_secret': intent.client_secret,
+        'client_secret': client_secret,
     }
 
     return render(request, template, context)
@@ -189,8 +223,11 @@ def checkout_success(request, order_number):
     """
     # Checks if user wants to save their information
     save_info = request.session.get('save_info')
-    # Gets order number created in previous view to send to the template
-    order = get_object_or_404(Order, order_number=order_number)
+    # Gets order number created in previous view to send to the template,
+    # prefetching the line items and products the template lists
+    order = get_object_or_404(
+        Order.objects.prefetch_related('lineitems__product'),
+        order_number=order_number)
     
     # User must be authenticated
     if request.user.is_authenticated:
@@ -223,9 +260,14 @@ def checkout_success(request, order_number):
         Your order number is {order_number}. A confirmation \
         email will be sent to {order.email}.')
     
-    # Delete the users shopping bag from the current session
-    if 'bag' in request.session:
-        del request.session['bag']
+    # Delete the users shopping bag now the order has been placed
+    cart.clear(request)
+    request.session.pop(pricing.DISCOUNT_SESSION_KEY, None)
+    # The stock held for it now belongs to the order, and is committed
+    # by the webhook, so a later checkout mustn't give it back
+    request.session.pop(stock.RESERVATION_SESSION_KEY, None)
+    # The next checkout is a new payment
+    request.session.pop(payments.PAYMENT_INTENT_SESSION_KEY, None)
     
     # Set the template and the context
     template = 'checkout/checkout_success.html'
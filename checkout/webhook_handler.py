@@ -1,31 +1,39 @@
 from django.http import HttpResponse
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
 
-from .models import Order, OrderLineItem
-from products.models import Product
+from .models import Order
+from .orders import create_order
+from .stripe_client import get_client
+from boutique_ado.money import Money
+from inventory import stock
+from outbox.mail import queue_mail
 from profiles.models import UserProfile
 
 import json
-import time
-import stripe
+import logging
+
+logger = logging.getLogger(__name__)
 
 class StripeWH_Handler:
     """Handle Stripe webhooks"""
 
     # init method of the class is a setup method that's
     # called every time an instance of the class is created.
-    def __init__(self, request):
+    def __init__(self, request=None):
         # Assigning request as an attribute of the class in
         # case we need to access any attributes of the request
-        # coming from stripe.
+        # coming from stripe. Events handled from the queue by
+        # process_webhooks don't have one.
         self.request = request
     
     # private method prefaced with underscore
     # as it will only be used inside this class
     def _send_confirmation_email(self, order):
-        """Send the user a confirmation email"""
+        """
+        Queue the user's confirmation email, once however many times
+        the webhook is delivered
+        """
         # Get customers email
         cust_email = order.email
         # Render email text files to strings
@@ -36,15 +44,46 @@ class StripeWH_Handler:
             'checkout/confirmation_emails/confirmation_email_body.txt',
             {'order': order, 'contact_email': settings.DEFAULT_FROM_EMAIL})
         
-        # Send mail with specified parameters
-        send_mail(
+        # Queue mail with specified parameters, for send_outbox to send
+        queue_mail(
             subject,
             body,
             # Send email from
             settings.DEFAULT_FROM_EMAIL,
             # Send email to
-            [cust_email]
-        ) 
+            [cust_email],
+            key=f'order-confirmation:{order.order_number}',
+        )
+
+    def _update_profile(self, profile, shipping_details):
+        """
+        Save the shipping details as the profile's default
+        delivery information
+        """
+        profile.default_phone_number = shipping_details.phone
+        profile.default_country = shipping_details.address.country
+        profile.default_postcode = shipping_details.address.postal_code
+        profile.default_town_or_city = shipping_details.address.city
+        profile.default_street_address1 = shipping_details.address.line1
+        profile.default_street_address2 = shipping_details.address.line2
+        profile.default_county = shipping_details.address.state
+        profile.save()
+
+    def dispatch(self, event):
+        """
+        Handle an event with the method for its type, or the
+        generic one for types that aren't handled
+        """
+        # Map webhook events to relevant handler functions
+        event_map = {
+            'payment_intent.succeeded': self.handle_payment_intent_succeeded,
+            'payment_intent.payment_failed': self.handle_payment_intent_payment_failed,
+        }
+        # If there's a handler for it, get it from the event map
+        # Use the generic one by default
+        event_handler = event_map.get(event['type'], self.handle_event)
+        # Call the event handler with the event
+        return event_handler(event)
 
     def handle_event(self, event):
         """
@@ -64,22 +103,24 @@ class StripeWH_Handler:
         pid = intent.id
         bag = intent.metadata.bag
         save_info = intent.metadata.save_info
+        # Intents created before discount codes existed don't have one
+        discount_code = intent.metadata.get('discount_code', '')
 
         # Get the Charge object
-        stripe_charge = stripe.Charge.retrieve(
+        stripe_charge = get_client().retrieve_charge(
             intent.latest_charge
         )
 
         billing_details = stripe_charge.billing_details
         shipping_details = intent.shipping
-        grand_total = round(stripe_charge.amount / 100, 2)
+        # Stripe gives the amount in cents, the same as Money holds it
+        grand_total = Money(stripe_charge.amount)
 
         # Clean the data in the shipping details
         for field, value in shipping_details.address.items():
             if value == "":
                 shipping_details.address[field] = None
 
-        # Update profile information if save_info was checked
         # Profile set to None so we can still allow anonymous users to checkout
         profile = None
         username = intent.metadata.username
@@ -87,125 +128,80 @@ class StripeWH_Handler:
         if username != 'AnonymousUser':
             # Get profile using username
             profile = UserProfile.objects.get(user__username=username)
-            # If user has saved info box checked (from metadata)
-            if save_info:
-                # Update profile by adding shipping details as default delivery information
-                profile.default_phone_number = shipping_details.phone
-                profile.default_country = shipping_details.address.country
-                profile.default_postcode = shipping_details.address.postal_code
-                profile.default_town_or_city = shipping_details.address.city
-                profile.default_street_address1 = shipping_details.address.line1
-                profile.default_street_address2 = shipping_details.address.line2
-                profile.default_county = shipping_details.address.state
-                profile.save()
-        
-        order_exists = False
-        attempt = 1
-        # While loop runs giving the webhook 5 attempts to
-        # find the existing order, if it cannot find one
-        # after 5 attempts, the order will be created
-        # automatically by the webhook. This allows the
-        # view time to submit the form and create the order.
-        while attempt <= 5:
-            try:
-                order = Order.objects.get(
-                    # __iexact lookup field used to make data
-                    # an exact match but case insensitive
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=billing_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    # These items in the shopping details object
-                    # are inside and address key (.address). This
-                    # is for the webhook to deliver correctly
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True
-                break
-                
-            except Order.DoesNotExist:
-                # If order does not exist, attempt increments by 1.
-                # Then pythons time module sleeps for 1 second
-                attempt += 1
-                time.sleep(1)
-        if order_exists:
-            # Send confirmation email before returning response to Stripe
+
+        def on_saved(order, created):
+            """
+            Runs in the order's transaction. The profile is only updated
+            when the order is created here, as the checkout view updates
+            it for orders it saves, but the email is queued either way.
+            """
+            # Update profile information if save_info was checked
+            if created and profile is not None and save_info:
+                self._update_profile(profile, shipping_details)
             self._send_confirmation_email(order)
+
+        try:
+            # The order for this payment, using all the data from the
+            # payment intent. If the checkout view has already saved one
+            # for it, or saves it while this one is being saved,
+            # create_order returns that order instead, so the view and
+            # the webhook never make two orders or wait for each other.
+            order = Order(
+                full_name=shipping_details.name,
+                # Add user profile to created order to overwrite profile
+                # being set to None if the user was not logged in. This
+                # allows the webhook handler to create orders for users
+                # that are authenticated by attaching their profile and
+                # for anonymous users by setting that field to None.
+                user_profile=profile,
+                email=billing_details.email,
+                phone_number=shipping_details.phone,
+                country=shipping_details.address.country,
+                postcode=shipping_details.address.postal_code,
+                town_or_city=shipping_details.address.city,
+                street_address1=shipping_details.address.line1,
+                street_address2=shipping_details.address.line2,
+                county=shipping_details.address.state,
+                original_bag=bag,
+                stripe_pid=pid,
+                # Applied by price_order when the order is placed
+                discount_code=discount_code,
+            )
+            # bag is loaded from the json version in the
+            # payment intent instead of from the session. The
+            # confirmation email is queued in the same transaction as
+            # the order, so it's only sent if the order is saved.
+            order, created = create_order(order, json.loads(bag), on_saved=on_saved)
+        # If anything goes wrong, nothing is saved and a 500
+        # server error response is returned to Stripe. This will
+        # cause Stripe to automatically try the webhook again later
+        except Exception as e:
             return HttpResponse(
-                content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',
-                status=200)
+                content=f'Webhook received: {event["type"]} | ERROR: {e}',
+                status=500)
+
+        if order.grand_total != grand_total:
+            logger.warning(
+                'Order %s totals %s but payment %s charged %s',
+                order.order_number, order.grand_total, pid, grand_total)
+        # The stock held for the payment is kept for the order
+        stock.commit(pid)
+        if created:
+            result = 'Created order in webhook'
         else:
-            order = None
-            try:
-                # Creating form to save using objects.create
-                # using all the data from the payment intent
-                order = Order.objects.create(
-                    full_name=shipping_details.name,
-                    # Add user profile to created order to overwrite profile
-                    # being set to None if the user was not logged in. This
-                    # allows the webhook handler to create orders for users
-                    # that are authenticated by attaching their profile and
-                    # for anonymous users by setting that field to None.
-                    user_profile=profile,
-                    email=billing_details.email,
-                    phone_number=shipping_details.phone,
-                    country=shipping_details.address.country,
-                    postcode=shipping_details.address.postal_code,
-                    town_or_city=shipping_details.address.city,
-                    street_address1=shipping_details.address.line1,
-                    street_address2=shipping_details.address.line2,
-                    county=shipping_details.address.state,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                # bag is loaded from the json version in the
-                # payment intent instead of from the session.
-                # Code copied from checkout view.
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-            # If anything goes wrong, the order will be deleted if
-            # one was created and return 500 server error response
-            # to Stripe. This will cause Stripe to automatically
-            # try the webhook again later
-            except Exception as e:
-                if order:
-                    order.delete()
-                return HttpResponse(
-                    content=f'Webhook received: {event["type"]} | ERROR: {e}',
-                    status=500)
-        # Send confirmation email before returning response to Stripe
-        self._send_confirmation_email(order)
+            result = 'Verified order already in database'
         return HttpResponse(
-            content=f'Webhook received: {event["type"]} | SUCCESS: Created order in webhook',
+            content=f'Webhook received: {event["type"]} | SUCCESS: {result}',
             status=200)
 
     def handle_payment_intent_payment_failed(self, event):
         """
         Handle the payment_intent.payment_failed webhook from Stripe
         """
+        # The stock held for the payment is put back. If the shopper
+        # then pays with another card, the webhook for that payment
+        # takes it again.
+        stock.release(event.data.object.id)
         return HttpResponse(
             content=f'Webhook received: {event["type"]}',
             status=200)
@@ -0,0 +1,99 @@
+import json
+import logging
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.utils import timezone
+
+from boutique_ado import queues
+from .models import WebhookEvent
+from .webhook_handler import StripeWH_Handler
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookFailed(Exception):
+    """ The handler answered an event with a server error """
+
+
+def enqueue(event, payload):
+    """
+    Store a verified event for process_webhooks to handle. Returns
+    False if the event was already stored, as Stripe sends an event
+    again when it doesn't get an answer in time.
+    """
+    _, created = WebhookEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={
+            'type': event['type'],
+            'payload': payload.decode() if isinstance(payload, bytes) else payload,
+        },
+    )
+    return created
+
+
+def claim(batch_size):
+    """ Claim up to batch_size events that are due, for this worker alone """
+    return queues.claim(
+        WebhookEvent, batch_size, settings.WEBHOOK_LEASE_SECONDS, WebhookEvent.PROCESSING)
+
+
+def process(webhook_event):
+    """
+    Handle a claimed event, then mark it done, or schedule it to be
+    tried again, or dead-letter it once it has failed too many times.
+    Returns True if it was handled.
+    """
+    mine = WebhookEvent.objects.filter(pk=webhook_event.pk, claim=webhook_event.claim)
+    try:
+        event = stripe.Event.construct_from(
+            json.loads(webhook_event.payload), settings.STRIPE_SECRET_KEY)
+        response = StripeWH_Handler().dispatch(event)
+        if response.status_code >= 500:
+            raise WebhookFailed(response.content.decode(errors='replace'))
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        if webhook_event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+            logger.error(
+                'Webhook %s failed %d times and was dead-lettered: %s',
+                webhook_event, webhook_event.attempts, error)
+            mine.update(status=WebhookEvent.DEAD, last_error=error, claim='', lease_expires=None)
+        else:
+            delay = queues.retry_delay(
+                webhook_event.attempts, settings.WEBHOOK_RETRY_SECONDS,
+                settings.WEBHOOK_RETRY_MAX_SECONDS)
+            logger.warning(
+                'Webhook %s failed, trying again in %.0fs: %s', webhook_event, delay, error)
+            mine.update(
+                status=WebhookEvent.PENDING, last_error=error, claim='', lease_expires=None,
+                next_attempt=timezone.now() + timedelta(seconds=delay))
+        return False
+
+    mine.update(status=WebhookEvent.DONE, processed=timezone.now(), claim='', lease_expires=None)
+    return True
+
+
+def work(batch_size=10):
+    """ Claim and handle one batch of events, returning how many were claimed """
+    events = claim(batch_size)
+    for webhook_event in events:
+        process(webhook_event)
+    return len(events)
+
+
+def retry_dead():
+    """ Queue dead-lettered events to be tried again, from the start """
+    return WebhookEvent.objects.filter(status=WebhookEvent.DEAD).update(
+        status=WebhookEvent.PENDING, attempts=0, next_attempt=timezone.now())
+
+
+def queue_stats():
+    """
+    The number of events in each status, how many are due, how long
+    the oldest has waited, and the time from Stripe's delivery to an
+    event being handled over the last hour
+    """
+    return queues.queue_stats(
+        WebhookEvent, (WebhookEvent.PENDING, WebhookEvent.PROCESSING),
+        WebhookEvent.DONE, 'received', 'processed')
@@ -3,7 +3,8 @@ from django.http import HttpResponse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 
-from checkout.webhook_handler import StripeWH_Handler
+from checkout import webhook_queue
+from checkout.stripe_client import get_client
 
 import stripe
 
@@ -13,7 +14,6 @@ def webhook(request):
     """Listen for webhooks from Stripe"""
     # Setup
     wh_secret = settings.STRIPE_WH_SECRET
-    stripe.api_key = settings.STRIPE_SECRET_KEY
 
     # Get the webhook data and verify its signature
     payload = request.body
@@ -21,7 +21,7 @@ def webhook(request):
     event = None
 
     try:
-        event = stripe.Webhook.construct_event(
+        event = get_client().construct_event(
         payload, sig_header, wh_secret
         )
     except ValueError as e:
@@ -35,22 +35,10 @@ def webhook(request):
     except Exception as e:
         return HttpResponse(content=e, status=400)
     
-    # Set up a webhook handler
-    handler = StripeWH_Handler(request)
-
-    # Map webhook events to relevant handler functions
-    event_map = {
-        'payment_intent.succeeded': handler.handle_payment_intent_succeeded,
-        'payment_intent.payment_failed': handler.handle_payment_intent_payment_failed,
-    }
-
-    # Get the webhook type from Stripe
-    event_type = event['type']
-
-    # If there's a handler for it, get it from the event map
-    # Use the generic one by default
-    event_handler = event_map.get(event_type, handler.handle_event)
-
-    # Call the event handler with the event
-    response = event_handler(event)
-    return response
\ No newline at end of file
+    # The event is queued for process_webhooks to handle, and Stripe
+    # is answered straight away rather than after the order is made
+    # and emailed. An event Stripe sends again is only queued once.
+    queued = webhook_queue.enqueue(event, payload)
+    return HttpResponse(
+        content=f'Webhook received: {event["type"]} | {"Queued" if queued else "Already queued"}',
+        status=200)
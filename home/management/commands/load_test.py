@@ -0,0 +1,391 @@
+import json
+import math
+import multiprocessing
+import random
+import statistics
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from http.cookiejar import CookieJar
+from importlib import import_module
+from urllib import error, parse, request as urlrequest
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from bag.cart import CART_SESSION_KEY
+from bag.models import Cart
+from checkout.stripe_client import use_client
+from checkout.tests.fake_stripe import FakeStripe
+from products.models import Category, Product
+
+# Tables written when a session is saved, by this project's backend
+# or Django's own
+SESSION_TABLES = ('sessionstore_', 'django_session')
+SIZES = ('xs', 's', 'm', 'l', 'xl')
+SORTS = ('price', 'rating', 'name', 'category')
+
+
+class RequestRecorder:
+    """
+    Counts the queries run for one request on this thread's database
+    connections, and the statements and bytes written to the session
+    tables. Only used in-process, where the queries can be seen.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.session_writes = 0
+        self.session_bytes = 0
+        self._stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        statement = sql.lstrip()[:6].upper()
+        if statement in ('INSERT', 'UPDATE', 'DELETE') and any(
+                table in sql for table in SESSION_TABLES):
+            self.session_writes += 1
+            rows = params if many else [params]
+            for row in rows:
+                for value in row or ():
+                    if isinstance(value, (bytes, bytearray, memoryview)):
+                        self.session_bytes += len(value)
+                    elif isinstance(value, str):
+                        self.session_bytes += len(value.encode())
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self._stack = None
+
+
+class InProcessShopper:
+    """ A shopper using the WSGI app in this process, through the test client """
+
+    def __init__(self):
+        # Views that fail return a 500, counted as an error, rather
+        # than stopping the shopper
+        self.client = Client(raise_request_exception=False)
+
+    def request(self, method, path, data=None):
+        with RequestRecorder() as recorder:
+            start = time.perf_counter()
+            if method == 'POST':
+                response = self.client.post(path, data)
+            else:
+                response = self.client.get(path)
+            elapsed = time.perf_counter() - start
+        return (response.status_code, elapsed, recorder.queries,
+                recorder.session_writes, recorder.session_bytes)
+
+    def finish(self):
+        session_key = self.client.cookies.get(settings.SESSION_COOKIE_NAME)
+        session_key = session_key.value if session_key else None
+        cart_id = self.client.session.get(CART_SESSION_KEY) if session_key else None
+        # Each thread has its own connections, which would otherwise
+        # stay open until the thread ends
+        connections.close_all()
+        return session_key, cart_id
+
+
+class NoRedirects(urlrequest.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpShopper:
+    """
+    A shopper sending requests to a running server. Queries come from
+    the X-DB-Query-Count header, when the server sends it, and session
+    writes can't be seen.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = CookieJar()
+        self.opener = urlrequest.build_opener(
+            urlrequest.HTTPCookieProcessor(self.cookies), NoRedirects)
+
+    def _csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+        return ''
+
+    def request(self, method, path, data=None):
+        url = self.base_url + path
+        body = None
+        headers = {}
+        if method == 'POST':
+            body = parse.urlencode(data or {}).encode()
+            headers = {'X-CSRFToken': self._csrf_token(), 'Referer': url}
+        start = time.perf_counter()
+        try:
+            response = self.opener.open(urlrequest.Request(
+                url, data=body, headers=headers, method=method), timeout=30)
+            response.read()
+        except error.HTTPError as e:
+            # Redirects arrive here too, as they aren't followed
+            response = e
+            response.read()
+        except OSError:
+            return 0, time.perf_counter() - start, None, None, None
+        elapsed = time.perf_counter() - start
+        queries = response.headers.get('X-DB-Query-Count')
+        return response.status, elapsed, queries and int(queries), None, None
+
+    def finish(self):
+        return None, None
+
+
+def shop(plan, options):
+    """
+    Walk one shopper through the shop: browse the products, look at
+    and add items with and without sizes, change a quantity, view the
+    bag and open the checkout. Returns each request's sample and what
+    the shopper left in the database.
+    """
+    rng = random.Random(plan['seed'])
+    if options['url']:
+        shopper = HttpShopper(options['url'])
+    else:
+        shopper = InProcessShopper()
+    think = options['think_ms'] / 1000
+    samples = []
+
+    def step(scenario, method, path, data=None):
+        status, elapsed, queries, writes, written = shopper.request(method, path, data)
+        samples.append((scenario, status, elapsed, queries, writes, written))
+        if think:
+            time.sleep(rng.uniform(0, 2 * think))
+
+    listing = reverse('products')
+    pages = [listing, f'{listing}?sort={rng.choice(SORTS)}&direction={rng.choice(("asc", "desc"))}']
+    if plan['categories']:
+        pages.append(f'{listing}?category={rng.choice(plan["categories"])}')
+    for page in rng.sample(pages, k=len(pages)):
+        step('browse', 'GET', page)
+
+    added = []
+    for _ in range(options['items']):
+        sized = plan['sized'] and (not plan['unsized'] or rng.random() < 0.5)
+        product_id = rng.choice(plan['sized'] if sized else plan['unsized'])
+        detail = reverse('product_detail', args=[product_id])
+        step('product_detail', 'GET', detail)
+        data = {'quantity': rng.randint(1, 3), 'redirect_url': detail}
+        if sized:
+            data['product_size'] = rng.choice(SIZES)
+        step('add_sized' if sized else 'add_unsized', 'POST',
+             reverse('add_to_bag', args=[product_id]), data)
+        added.append((product_id, data.get('product_size')))
+
+    step('view_bag', 'GET', reverse('view_bag'))
+    if added:
+        product_id, size = rng.choice(added)
+        data = {'quantity': rng.randint(0, 5)}
+        if size:
+            data['product_size'] = size
+        step('adjust_bag', 'POST', reverse('adjust_bag', args=[product_id]), data)
+        step('view_bag', 'GET', reverse('view_bag'))
+    if rng.random() < options['checkout_ratio']:
+        step('checkout', 'GET', reverse('checkout'))
+
+    return samples, shopper.finish()
+
+
+def percentile(ordered, fraction):
+    """ The nearest-rank percentile of an already sorted list """
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return round(ordered[index], 2)
+
+
+def summarise(samples, duration):
+    """ Throughput, latency, queries and session writes for some samples """
+    latencies = sorted(elapsed * 1000 for _, _, elapsed, _, _, _ in samples)
+    errors = sum(1 for _, status, _, _, _, _ in samples if not status or status >= 400)
+    queries = [queries for _, _, _, queries, _, _ in samples if queries is not None]
+    writes = [writes for _, _, _, _, writes, _ in samples if writes is not None]
+    written = [written for _, _, _, _, _, written in samples if written is not None]
+
+    def mean(values):
+        return round(statistics.mean(values), 2) if values else None
+
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'throughput_rps': round(len(samples) / duration, 2) if duration else None,
+        'latency_ms': {
+            'mean': mean(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': percentile(latencies, 1),
+        },
+        'queries_per_request': {
+            'mean': mean(queries),
+            'max': max(queries) if queries else None,
+        },
+        'session_writes': {
+            'statements_per_request': mean(writes),
+            'bytes_per_request': mean(written),
+            'bytes_total': sum(written) if written else None,
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = ('Simulate many shoppers at once browsing the products, adding '
+            'items with and without sizes, adjusting and viewing the bag '
+            'and opening the checkout, and report throughput, latency, '
+            'queries and session writes for each step as JSON. Runs the '
+            'app in-process against a local fake Stripe, or against --url.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--shoppers', type=int, default=200,
+            help='Number of shopper sessions to simulate')
+        parser.add_argument(
+            '--concurrency', type=int, default=20,
+            help='Number of shoppers active at once')
+        parser.add_argument(
+            '--pool', choices=('thread', 'process'), default='thread',
+            help='Run shoppers in threads, or in forked processes')
+        parser.add_argument(
+            '--items', type=int, default=3,
+            help='Number of items each shopper adds to their bag')
+        parser.add_argument(
+            '--checkout-ratio', type=float, default=0.5,
+            help='Fraction of shoppers that go on to the checkout')
+        parser.add_argument(
+            '--think-ms', type=float, default=0,
+            help='Average pause between a shopper\'s requests')
+        parser.add_argument(
+            '--stripe-latency-ms', type=float, default=0,
+            help='Time each call to the fake Stripe takes, in-process only')
+        parser.add_argument(
+            '--url', default=None,
+            help='Base url of a running server to test instead, such as '
+                 'http://localhost:8000. Stripe must be stubbed there.')
+        parser.add_argument(
+            '--seed', type=int, default=None,
+            help='Seed for the shoppers\' choices, to repeat a run')
+        parser.add_argument(
+            '--output', default=None,
+            help='Write the JSON report to this file, and a summary to the console')
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the sessions and carts the shoppers created')
+
+    def handle(self, *args, **options):
+        if options['shoppers'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--shoppers and --concurrency must be at least 1')
+        products = list(Product.objects.values_list('id', 'has_sizes'))
+        if not products:
+            raise CommandError('There are no products. Load the fixtures or run import_catalog.')
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        rng = random.Random(seed)
+        categories = list(Category.objects.values_list('name', flat=True))
+        plans = [{
+            'seed': rng.randrange(2 ** 32),
+            'sized': [product_id for product_id, has_sizes in products if has_sizes],
+            'unsized': [product_id for product_id, has_sizes in products if not has_sizes],
+            'categories': categories,
+        } for _ in range(options['shoppers'])]
+
+        fake = client = None
+        with ExitStack() as stack:
+            if not options['url']:
+                # Started before any threads start or processes fork, so
+                # every shopper's checkout calls it
+                fake = stack.enter_context(
+                    FakeStripe(latency=options['stripe_latency_ms'] / 1000))
+                client = stack.enter_context(
+                    use_client(fake.client(pool_size=options['concurrency'])))
+            if options['pool'] == 'process':
+                # Forked processes must not share this one's connections
+                connections.close_all()
+                pool = ProcessPoolExecutor(
+                    options['concurrency'], mp_context=multiprocessing.get_context('fork'))
+            else:
+                pool = ThreadPoolExecutor(options['concurrency'])
+            start = time.perf_counter()
+            with pool:
+                results = list(pool.map(shop, plans, [options] * len(plans)))
+            duration = time.perf_counter() - start
+
+        samples = [sample for shopper_samples, _ in results for sample in shopper_samples]
+        if not options['url'] and not options['keep']:
+            self._clean_up([left for _, left in results])
+
+        by_scenario = defaultdict(list)
+        for sample in samples:
+            by_scenario[sample[0]].append(sample)
+        report = {
+            'target': options['url'] or 'in-process',
+            'pool': options['pool'],
+            'shoppers': options['shoppers'],
+            'concurrency': options['concurrency'],
+            'items': options['items'],
+            'checkout_ratio': options['checkout_ratio'],
+            'seed': seed,
+            'duration_s': round(duration, 3),
+            'overall': summarise(samples, duration),
+            'scenarios': {
+                scenario: summarise(scenario_samples, duration)
+                for scenario, scenario_samples in sorted(by_scenario.items())
+            },
+        }
+        if fake:
+            report['stripe'] = {
+                'requests': fake.requests,
+                'connections': len(fake.connections),
+                # Forked shoppers record their calls in their own process
+                'calls': client.metrics.snapshot() if options['pool'] == 'thread' else None,
+            }
+
+        if not options['output']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self._print_summary(report, options['output'])
+
+    def _clean_up(self, left):
+        """ Delete the sessions and carts the shoppers created """
+        session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        for session_key, _ in left:
+            if session_key:
+                session_store().delete(session_key)
+        cart_ids = [cart_id for _, cart_id in left if cart_id]
+        Cart.objects.filter(id__in=cart_ids).delete()
+
+    def _print_summary(self, report, output):
+        self.stdout.write(
+            'scenario        requests  errors    req/s    p50 ms    p95 ms    p99 ms  queries  session bytes')
+        rows = list(report['scenarios'].items()) + [('overall', report['overall'])]
+        for scenario, summary in rows:
+            latency = summary['latency_ms']
+            queries = summary['queries_per_request']['mean']
+            written = summary['session_writes']['bytes_per_request']
+            self.stdout.write(
+                f'{scenario:<14}  {summary["requests"]:>8}  {summary["errors"]:>6}  '
+                f'{summary["throughput_rps"]:>7.1f}  {latency["p50"]:>8.2f}  '
+                f'{latency["p95"]:>8.2f}  {latency["p99"]:>8.2f}  '
+                f'{"-" if queries is None else f"{queries:.1f}":>7}  '
+                f'{"-" if written is None else f"{written:.0f}":>13}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{report["overall"]["requests"]} requests from {report["shoppers"]} '
+            f'shoppers in {report["duration_s"]:.1f}s, report written to '
+            f'{output}'))
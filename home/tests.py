@@ -1,3 +1,90 @@
-from django.test import TestCase
+from contextlib import ExitStack
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings
+
+from boutique_ado.middleware import ReplicaPinningMiddleware
+
+# The configured replicas, or the one the test settings add
+REPLICAS = settings.DATABASE_REPLICAS or ['replica']
+
+
+class AliasRecorder:
+    """ Records the alias of each database a query is sent to """
+
+    def __init__(self):
+        self.aliases = set()
+        self._stack = None
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for alias in connections:
+            self._stack.enter_context(
+                connections[alias].execute_wrapper(self._wrapper(alias)))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+
+    def _wrapper(self, alias):
+        def wrapper(execute, sql, params, many, context):
+            self.aliases.add(alias)
+            return execute(sql, params, many, context)
+        return wrapper
+
+
+def site_view(request):
+    """ Reads the site name, after changing it on a POST """
+    site = Site.objects.filter(pk=settings.SITE_ID)
+    if request.method == 'POST':
+        site.update(name=request.POST['name'])
+    return HttpResponse(site.values_list('name', flat=True).first())
+
+
+@override_settings(DATABASE_REPLICAS=REPLICAS)
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Reads go to the replicas, and a visitor who writes keeps reading
+    from the primary. The replicas mirror the test database, so these
+    check where queries are sent rather than what they find.
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.middleware = ReplicaPinningMiddleware(site_view)
+        self.factory = RequestFactory()
+
+    def assertReadsFrom(self, request, aliases):
+        with AliasRecorder() as recorder:
+            response = self.middleware(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(recorder.aliases)
+        self.assertLessEqual(recorder.aliases, set(aliases))
+        return response
+
+    def test_get_reads_from_a_replica(self):
+        self.assertReadsFrom(self.factory.get('/products/'), REPLICAS)
+
+    def test_write_pins_the_visitor_to_the_primary(self):
+        response = self.assertReadsFrom(
+            self.factory.post('/bag/add/', {'name': 'Renamed'}), [DEFAULT_DB_ALIAS])
+        self.assertContains(response, 'Renamed')
+        cookie = response.cookies[ReplicaPinningMiddleware.cookie_name]
+
+        pinned = self.factory.get('/products/')
+        pinned.COOKIES[ReplicaPinningMiddleware.cookie_name] = cookie.value
+        self.assertReadsFrom(pinned, [DEFAULT_DB_ALIAS])
+
+        # Anyone else still reads from the replicas
+        self.assertReadsFrom(self.factory.get('/products/'), REPLICAS)
+
+    def test_primary_paths_read_from_the_primary(self):
+        self.assertReadsFrom(
+            self.factory.get('/checkout/checkout_success/x/'), [DEFAULT_DB_ALIAS])
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertReadsFrom(self.factory.get('/products/'), [DEFAULT_DB_ALIAS])
@@ -1,7 +1,10 @@
 from django.shortcuts import render
 
+from boutique_ado.caching import anonymous_page_cache
+
 # Create your views here.
 
+@anonymous_page_cache
 def index(request):
     """ A view to return the index page """
 
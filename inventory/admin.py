@@ -0,0 +1,25 @@
+from django.contrib import admin
+from .models import StockLevel, Reservation
+
+
+class StockLevelAdmin(admin.ModelAdmin):
+    list_display = ('product', 'size', 'shard', 'quantity',)
+    list_filter = ('size',)
+    search_fields = ('product__name', 'product__sku',)
+
+    ordering = ('product', 'size', 'shard',)
+
+
+class ReservationAdmin(admin.ModelAdmin):
+    list_display = ('payment_intent', 'product', 'size', 'quantity',
+                    'status', 'created', 'expires',)
+    list_filter = ('status',)
+    search_fields = ('payment_intent',)
+    readonly_fields = ('payment_intent', 'product', 'size', 'quantity',
+                       'status', 'created', 'expires',)
+
+    ordering = ('-created',)
+
+
+admin.site.register(StockLevel, StockLevelAdmin)
+admin.site.register(Reservation, ReservationAdmin)
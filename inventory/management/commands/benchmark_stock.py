@@ -0,0 +1,108 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from inventory import stock
+from inventory.models import Reservation, StockLevel
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = ('Have many buyers reserve the same product at once, with its '
+            'stock split across different numbers of shards, checking no '
+            'more is reserved than was in stock and timing each reservation. '
+            'SQLite runs one write at a time whatever the shards, so compare '
+            'shard counts on PostgreSQL.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--buyers', type=int, default=300,
+            help='Number of buyers trying to reserve the product')
+        parser.add_argument(
+            '--concurrency', type=int, default=50,
+            help='Number of buyers reserving at the same moment')
+        parser.add_argument(
+            '--stock', type=int, default=100,
+            help='Stock of the product at the start of each run')
+        parser.add_argument(
+            '--quantity', type=int, default=1,
+            help='Quantity each buyer reserves')
+        parser.add_argument(
+            '--shards', nargs='*', type=int, default=[1, 8],
+            help='Numbers of shards to split the stock across, one run for each')
+        parser.add_argument(
+            '--product', type=int, default=None,
+            help='Id of the product to buy, by default the first one')
+
+    def handle(self, *args, **options):
+        product = Product.objects.order_by('id')
+        if options['product'] is not None:
+            product = product.filter(id=options['product'])
+        product = product.first()
+        if product is None:
+            raise CommandError('There is no product to buy. Load the fixtures first.')
+
+        # The product's stock is put back as it was once the runs finish
+        levels = list(StockLevel.objects.filter(product=product, size=''))
+        try:
+            self.stdout.write('shards  buyers  reserved  sold out  errors  '
+                              'left  p50 ms  p99 ms  reservations/s')
+            for shards in options['shards']:
+                self._run(product, shards, options)
+        finally:
+            with transaction.atomic():
+                Reservation.objects.filter(payment_intent__startswith='pi_benchmark_').delete()
+                StockLevel.objects.filter(product=product, size='').delete()
+                StockLevel.objects.bulk_create(levels)
+
+    def _run(self, product, shards, options):
+        stock.set_stock(product.id, '', options['stock'], shards=shards)
+        quantity = options['quantity']
+
+        def buy(buyer):
+            start = time.perf_counter()
+            try:
+                stock.reserve(f'pi_benchmark_{shards}_{buyer}', [(product.id, '', quantity)])
+                outcome = 'reserved'
+            except stock.OutOfStock:
+                outcome = 'sold out'
+            except Exception:
+                # Such as the database giving up waiting for a lock
+                outcome = 'error'
+            elapsed = (time.perf_counter() - start) * 1000
+            # Each thread has its own connection, closed once it's done
+            connections.close_all()
+            return outcome, elapsed
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            results = list(pool.map(buy, range(options['buyers'])))
+        duration = time.perf_counter() - start
+
+        outcomes = [outcome for outcome, _ in results]
+        times = sorted(elapsed for _, elapsed in results)
+        reserved = outcomes.count('reserved')
+        left = stock.stock_levels([product.id]).get((product.id, ''), 0)
+        self.stdout.write(
+            f'{shards:>6}  {len(results):>6}  {reserved:>8}  '
+            f'{outcomes.count("sold out"):>8}  {outcomes.count("error"):>6}  '
+            f'{left:>4}  {statistics.median(times):>6.1f}  '
+            f'{times[min(len(times) - 1, int(len(times) * 0.99))]:>6.1f}  '
+            f'{len(results) / duration:>14.0f}')
+
+        # Every unit is either still in stock or held by one reservation,
+        # so none were sold twice or lost
+        if reserved * quantity + left != options['stock']:
+            raise CommandError(
+                f'{reserved} buyers reserved {quantity} each and {left} are '
+                f'left, from a stock of {options["stock"]}')
+
+        # Releasing every reservation puts all the stock back
+        for buyer in range(options['buyers']):
+            stock.release(f'pi_benchmark_{shards}_{buyer}')
+        left = stock.stock_levels([product.id]).get((product.id, ''), 0)
+        if left != options['stock']:
+            raise CommandError(f'{left} in stock after releasing every reservation')
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from inventory.stock import release_expired
+
+
+class Command(BaseCommand):
+    help = ('Put back the stock held for checkouts that were never paid '
+            'for, once their reservations have expired. Run it every few '
+            'minutes, for example from cron or the Heroku scheduler.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of payments whose reservations are released per batch')
+        parser.add_argument(
+            '--max-seconds', type=float, default=None,
+            help='Stop after this long, leaving the rest for the next run')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        released = 0
+        batches = 0
+        finished = True
+        for count in release_expired(batch_size=options['batch_size']):
+            released += count
+            batches += 1
+            if (options['max_seconds'] is not None
+                    and time.perf_counter() - start >= options['max_seconds']):
+                finished = False
+                break
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Released {released} expired reservations in {batches} batches '
+            f'({elapsed:.2f}s){"" if finished else ", stopped early"}'))
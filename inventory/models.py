@@ -0,0 +1,53 @@
+from django.db import models
+
+from products.models import Product
+
+
+class StockLevel(models.Model):
+    """
+    Part of the stock of one product, or one size of a product. Stock
+    is split across several rows, or shards, so that checkouts buying
+    the same product at once take from different rows rather than all
+    waiting on one. The stock level is the sum of its shards.
+    """
+
+    class Meta:
+        unique_together = ('product', 'size', 'shard')
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_levels')
+    # Empty for products without sizes
+    size = models.CharField(max_length=10, blank=True, default='')
+    shard = models.PositiveSmallIntegerField(default=0)
+    quantity = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        size = f' size {self.size.upper()}' if self.size else ''
+        return f'{self.product}{size} (shard {self.shard})'
+
+
+class Reservation(models.Model):
+    """
+    Stock held for a payment while it's being made. It's committed
+    when the payment succeeds, and released, putting the stock back,
+    if the payment fails or isn't made before it expires.
+    """
+    HELD = 'held'
+    COMMITTED = 'committed'
+    RELEASED = 'released'
+    STATUS_CHOICES = (
+        (HELD, 'Held'),
+        (COMMITTED, 'Committed'),
+        (RELEASED, 'Released'),
+    )
+
+    payment_intent = models.CharField(max_length=254, db_index=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    size = models.CharField(max_length=10, blank=True, default='')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=HELD)
+    created = models.DateTimeField(auto_now_add=True)
+    # Indexed so expired reservations can be found and released in batches
+    expires = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product} for {self.payment_intent}'
@@ -0,0 +1,226 @@
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import StockLevel, Reservation
+
+logger = logging.getLogger(__name__)
+
+# Where the payment intent of the visitor's current reservation is kept,
+# so it can be given back if they open the checkout again
+RESERVATION_SESSION_KEY = 'stock_reservation'
+
+
+class OutOfStock(Exception):
+    """ Raised when there isn't enough of a product, or size, to reserve """
+
+    def __init__(self, product_id, size, available):
+        self.product_id = product_id
+        self.size = size
+        self.available = available
+        super().__init__(f'Only {available} of product {product_id} {size} in stock')
+
+
+def _levels(using, product_id, size):
+    return StockLevel.objects.using(using).filter(product_id=product_id, size=size or '')
+
+
+def set_stock(product_id, size, quantity, shards=None):
+    """
+    Set the stock of a product, or one size of it, spreading it evenly
+    across shards rows. Stock already reserved isn't counted in it.
+    """
+    shards = shards or settings.INVENTORY_SHARDS
+    using = router.db_for_write(StockLevel)
+    base, extra = divmod(quantity, shards)
+    with transaction.atomic(using=using):
+        _levels(using, product_id, size).delete()
+        StockLevel.objects.using(using).bulk_create([
+            StockLevel(product_id=product_id, size=size or '', shard=shard,
+                       quantity=base + (1 if shard < extra else 0))
+            for shard in range(shards)
+        ])
+
+
+def stock_levels(product_ids):
+    """
+    Return the stock of the given products as {(product_id, size):
+    quantity}. Products and sizes missing from it aren't stocked, and
+    can be bought in any quantity.
+    """
+    using = router.db_for_write(StockLevel)
+    rows = (
+        StockLevel.objects.using(using).filter(product_id__in=product_ids)
+        .values_list('product_id', 'size').annotate(quantity=Sum('quantity'))
+    )
+    return {(product_id, size): quantity for product_id, size, quantity in rows}
+
+
+def _take(using, product_id, size, quantity, shards):
+    """
+    Take quantity from a product's stock, returning False if there isn't
+    enough. shards are the ones last seen holding enough, tried first.
+    Must run in a transaction.
+    """
+    levels = _levels(using, product_id, size)
+    # Usually one shard holds enough. Each buyer tries them in a
+    # different order, taking its stock with an update that only
+    # succeeds if it's still there, so buyers rarely wait on a lock
+    # another holds and never take stock that's gone. Writing before
+    # reading also means SQLite never has to give up on the lock.
+    for shard in shards:
+        if levels.filter(shard=shard, quantity__gte=quantity).update(
+                quantity=F('quantity') - quantity):
+            return True
+
+    # Otherwise it's taken from several shards. Updating them without
+    # changing them locks them on every database while that's done.
+    levels.update(quantity=F('quantity'))
+    rows = list(levels.filter(quantity__gt=0).order_by('shard').values_list('shard', 'quantity'))
+    if sum(held for _, held in rows) < quantity:
+        return False
+    remaining = quantity
+    for shard, held in rows:
+        taken = min(held, remaining)
+        levels.filter(shard=shard).update(quantity=F('quantity') - taken)
+        remaining -= taken
+        if not remaining:
+            break
+    return True
+
+
+def _put_back(using, product_id, size, quantity):
+    """ Return quantity to one of a product's shards, if it's still stocked """
+    levels = _levels(using, product_id, size)
+    shards = list(levels.values_list('shard', flat=True))
+    if shards:
+        levels.filter(shard=random.choice(shards)).update(quantity=F('quantity') + quantity)
+
+
+def reserve(payment_intent, lines, expires=None):
+    """
+    Hold stock for the lines of (product_id, size, quantity) being paid
+    for with payment_intent. Either all the stocked lines are reserved,
+    or, if any is short, none are and OutOfStock is raised.
+    """
+    wanted = {}
+    for product_id, size, quantity in lines:
+        key = (int(product_id), size or '')
+        wanted[key] = wanted.get(key, 0) + quantity
+    if not wanted:
+        return []
+
+    using = router.db_for_write(StockLevel)
+    # Read before the transaction starts, as a hint of which shards
+    # hold enough. Products and sizes with no shards aren't stocked.
+    shards = {}
+    for product_id, size, shard, held in (
+            StockLevel.objects.using(using)
+            .filter(product_id__in={product_id for product_id, _ in wanted})
+            .values_list('product_id', 'size', 'shard', 'quantity')):
+        shards.setdefault((product_id, size), []).append((held, shard))
+    expires = expires or timezone.now() + timedelta(minutes=settings.INVENTORY_RESERVATION_MINUTES)
+    reservations = []
+    with transaction.atomic(using=using):
+        # Always taken in the same order, so two buyers of the same
+        # products can't each wait on a lock the other holds
+        for (product_id, size), quantity in sorted(wanted.items()):
+            if (product_id, size) not in shards:
+                continue
+            enough = [shard for held, shard in shards[(product_id, size)] if held >= quantity]
+            random.shuffle(enough)
+            if not _take(using, product_id, size, quantity, enough):
+                available = _levels(using, product_id, size).aggregate(
+                    total=Sum('quantity'))['total'] or 0
+                raise OutOfStock(product_id, size, available)
+            reservations.append(Reservation(
+                payment_intent=payment_intent, product_id=product_id,
+                size=size, quantity=quantity, expires=expires))
+        # A payment reserved again, after its bag changed, replaces the
+        # reservation it gave back, so if it's paid late only the
+        # current lines are taken again
+        Reservation.objects.using(using).filter(
+            payment_intent=payment_intent, status=Reservation.RELEASED).delete()
+        Reservation.objects.using(using).bulk_create(reservations)
+    return reservations
+
+
+def is_held(payment_intent):
+    """ Whether stock is reserved for payment_intent and hasn't expired """
+    return bool(payment_intent) and Reservation.objects.filter(
+        payment_intent=payment_intent, status=Reservation.HELD,
+        expires__gt=timezone.now()).exists()
+
+
+def commit(payment_intent):
+    """
+    Keep the stock reserved for a payment that has succeeded. If its
+    reservation had already expired, the stock is taken again, and a
+    warning logged for anything no longer in stock.
+    """
+    if not payment_intent:
+        return 0
+    using = router.db_for_write(Reservation)
+    reservations = Reservation.objects.using(using).filter(payment_intent=payment_intent)
+    with transaction.atomic(using=using):
+        committed = reservations.filter(status=Reservation.HELD).update(
+            status=Reservation.COMMITTED)
+        if committed or reservations.filter(status=Reservation.COMMITTED).exists():
+            return committed
+
+        late = list(reservations.filter(status=Reservation.RELEASED))
+        for reservation in late:
+            if not _take(using, reservation.product_id, reservation.size,
+                         reservation.quantity, []):
+                logger.warning(
+                    'Payment %s succeeded after its reservation expired, and '
+                    '%d of product %s %s is no longer in stock', payment_intent,
+                    reservation.quantity, reservation.product_id, reservation.size)
+        return reservations.filter(pk__in=[reservation.pk for reservation in late]).update(
+            status=Reservation.COMMITTED)
+
+
+def release(payment_intent):
+    """ Put back the stock held for a payment that failed or was abandoned """
+    if not payment_intent:
+        return 0
+    using = router.db_for_write(Reservation)
+    held = list(Reservation.objects.using(using).filter(
+        payment_intent=payment_intent, status=Reservation.HELD))
+    if not held:
+        return 0
+    with transaction.atomic(using=using):
+        # Moving them out of held first means a payment succeeding at
+        # the same time can't have its stock put back
+        released = Reservation.objects.using(using).filter(
+            pk__in=[reservation.pk for reservation in held],
+            status=Reservation.HELD,
+        ).update(status=Reservation.RELEASED)
+        if released != len(held):
+            transaction.set_rollback(True, using=using)
+            return 0
+        for reservation in held:
+            _put_back(using, reservation.product_id, reservation.size, reservation.quantity)
+    return released
+
+
+def release_expired(batch_size=100):
+    """
+    Release reservations that have expired, a batch of payments at a
+    time with each payment in its own transaction, yielding the number
+    of reservations released by each batch.
+    """
+    now = timezone.now()
+    while True:
+        payment_intents = list(dict.fromkeys(
+            Reservation.objects.filter(status=Reservation.HELD, expires__lt=now)
+            .order_by('expires').values_list('payment_intent', flat=True)[:batch_size]
+        ))
+        if not payment_intents:
+            return
+        yield sum(release(payment_intent) for payment_intent in payment_intents)
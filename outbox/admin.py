@@ -0,0 +1,25 @@
+from django.contrib import admin
+from django.utils import timezone
+from .models import OutgoingEmail
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'status', 'attempts',
+                    'created', 'sent',)
+    list_filter = ('status',)
+    search_fields = ('subject', 'key',)
+    readonly_fields = ('key', 'subject', 'body', 'html_body', 'from_email',
+                       'to', 'cc', 'bcc', 'reply_to', 'headers', 'status',
+                       'attempts', 'created', 'next_attempt', 'claim',
+                       'lease_expires', 'sent', 'last_error',)
+    actions = ('retry',)
+
+    ordering = ('-created',)
+
+    @admin.action(description='Send the selected emails again')
+    def retry(self, request, queryset):
+        queryset.exclude(status=OutgoingEmail.SENDING).update(
+            status=OutgoingEmail.PENDING, attempts=0, next_attempt=timezone.now())
+
+
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
@@ -0,0 +1,17 @@
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .mail import queue_message
+
+
+class OutboxBackend(BaseEmailBackend):
+    """
+    Email backend that writes each message to the outbox instead of
+    sending it, for send_outbox to deliver. With it as EMAIL_BACKEND,
+    send_mail, allauth's verification emails and everything else that
+    sends email returns without waiting on the mail server.
+    """
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            queue_message(message)
+        return len(email_messages)
@@ -0,0 +1,170 @@
+import logging
+import time
+from datetime import timedelta
+from smtplib import SMTPException
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from boutique_ado import queues
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+
+def queue_message(message, key=None):
+    """
+    Write an EmailMessage to the outbox, in the current transaction if
+    there is one. If key is given and an email with that key has been
+    queued before, that email is returned and nothing new is queued.
+    """
+    if message.attachments:
+        raise ValueError('Emails with attachments cannot be queued in the outbox')
+    body = message.body
+    html_body = next((
+        content for content, mimetype in getattr(message, 'alternatives', ())
+        if mimetype == 'text/html'), '')
+    if message.content_subtype == 'html':
+        html_body, body = body, strip_tags(body)
+
+    from_email = message.from_email or settings.DEFAULT_FROM_EMAIL
+    # Without an address to send from the email could never be sent,
+    # so that's reported here rather than as a failed insert
+    if not from_email:
+        raise ImproperlyConfigured(
+            'Set DEFAULT_FROM_EMAIL, or give a from address, to queue emails')
+
+    fields = {
+        'subject': message.subject,
+        'body': body,
+        'html_body': html_body,
+        'from_email': from_email,
+        'to': list(message.to),
+        'cc': list(message.cc),
+        'bcc': list(message.bcc),
+        'reply_to': list(message.reply_to),
+        'headers': dict(message.extra_headers),
+    }
+    if key is None:
+        return OutgoingEmail.objects.create(**fields)
+    try:
+        with transaction.atomic():
+            return OutgoingEmail.objects.create(key=key, **fields)
+    except IntegrityError:
+        # Only a clash on the key means the email was queued before
+        existing = OutgoingEmail.objects.filter(key=key).first()
+        if existing is None:
+            raise
+        return existing
+
+
+def queue_mail(subject, message, from_email, recipient_list, html_message=None, key=None):
+    """ Queue an email in the outbox, taking the same arguments as send_mail """
+    email = EmailMultiAlternatives(subject, message, from_email, recipient_list)
+    if html_message:
+        email.attach_alternative(html_message, 'text/html')
+    return queue_message(email, key=key)
+
+
+class RateLimit:
+    """ Spaces out calls to wait() so there are at most rate a second """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = 0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next:
+            time.sleep(self.next - now)
+            now = self.next
+        self.next = now + self.interval
+
+
+def claim(batch_size):
+    """ Claim up to batch_size emails that are due, for this sender alone """
+    return queues.claim(
+        OutgoingEmail, batch_size, settings.OUTBOX_LEASE_SECONDS, OutgoingEmail.SENDING)
+
+
+def deliver(emails, connection, rate_limit):
+    """
+    Send claimed emails over one open connection, recording whether each
+    was sent. A failed email is tried again later with backoff, and is
+    dead-lettered once it has failed OUTBOX_MAX_ATTEMPTS times. Returns
+    the number sent.
+    """
+    sent = 0
+    for email in emails:
+        mine = OutgoingEmail.objects.filter(pk=email.pk, claim=email.claim)
+        rate_limit.wait()
+        try:
+            # Opens the connection if it isn't open already, such as
+            # after a failure closed it, and otherwise keeps using it
+            connection.open()
+            if not connection.send_messages([email.as_message(connection)]):
+                raise SMTPException('The mail server did not accept the email')
+        except Exception as e:
+            # The connection may be broken, so a new one is opened for
+            # the next email
+            connection.close()
+            error = f'{type(e).__name__}: {e}'
+            if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                logger.error(
+                    'Email %s failed %d times and was dead-lettered: %s',
+                    email.pk, email.attempts, error)
+                mine.update(status=OutgoingEmail.DEAD, last_error=error,
+                            claim='', lease_expires=None)
+            else:
+                delay = queues.retry_delay(
+                    email.attempts, settings.OUTBOX_RETRY_SECONDS,
+                    settings.OUTBOX_RETRY_MAX_SECONDS)
+                logger.warning('Email %s failed, trying again in %.0fs: %s', email.pk, delay, error)
+                mine.update(status=OutgoingEmail.PENDING, last_error=error, claim='',
+                            lease_expires=None,
+                            next_attempt=timezone.now() + timedelta(seconds=delay))
+            continue
+        mine.update(status=OutgoingEmail.SENT, sent=timezone.now(), last_error='',
+                    claim='', lease_expires=None)
+        sent += 1
+    return sent
+
+
+def send_due(batch_size=50, connection=None, rate_limit=None):
+    """
+    Send every email that's due, a batch at a time over one connection,
+    returning the number claimed and the number sent
+    """
+    connection = connection or get_connection(settings.OUTBOX_EMAIL_BACKEND)
+    rate_limit = rate_limit or RateLimit(settings.OUTBOX_RATE_PER_SECOND)
+    claimed = sent = 0
+    try:
+        while True:
+            emails = claim(batch_size)
+            if not emails:
+                return claimed, sent
+            claimed += len(emails)
+            sent += deliver(emails, connection, rate_limit)
+    finally:
+        connection.close()
+
+
+def retry_dead():
+    """ Queue dead-lettered emails to be sent again, from the start """
+    return OutgoingEmail.objects.filter(status=OutgoingEmail.DEAD).update(
+        status=OutgoingEmail.PENDING, attempts=0, next_attempt=timezone.now())
+
+
+def queue_stats():
+    """
+    The number of emails in each status, how many are due, how long
+    the oldest has waited, and the time from an email being queued to
+    it being sent over the last hour
+    """
+    return queues.queue_stats(
+        OutgoingEmail, (OutgoingEmail.PENDING, OutgoingEmail.SENDING),
+        OutgoingEmail.SENT, 'created', 'sent')
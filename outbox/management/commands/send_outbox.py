@@ -0,0 +1,70 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from outbox import mail
+
+
+class Command(BaseCommand):
+    help = ('Send the emails waiting in the outbox, in batches over one '
+            'connection to OUTBOX_EMAIL_BACKEND, which is closed while there '
+            'is nothing to send. Failed emails are retried with backoff and '
+            'dead-lettered after OUTBOX_MAX_ATTEMPTS. Runs until stopped, or '
+            'with --once until nothing is due.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=50,
+            help='Number of emails claimed at a time')
+        parser.add_argument(
+            '--rate', type=float, default=settings.OUTBOX_RATE_PER_SECOND,
+            help='Most emails sent a second, or 0 for no limit')
+        parser.add_argument(
+            '--poll-seconds', type=float, default=5,
+            help='How long to wait before looking again when nothing is due')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Stop once no emails are due, instead of waiting for more')
+        parser.add_argument(
+            '--stats', action='store_true',
+            help='Write out queue depth and latency as JSON, and stop')
+        parser.add_argument(
+            '--retry-dead', action='store_true',
+            help='Queue the dead-lettered emails to be sent again, and stop')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(mail.queue_stats(), indent=2))
+            return
+        if options['retry_dead']:
+            count = mail.retry_dead()
+            self.stdout.write(self.style.SUCCESS(f'Queued {count} dead-lettered emails again'))
+            return
+
+        connection = get_connection(settings.OUTBOX_EMAIL_BACKEND, fail_silently=False)
+        # Shared across batches, so the rate holds between them too
+        rate_limit = mail.RateLimit(options['rate'])
+        claimed = sent = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                batch_claimed, batch_sent = mail.send_due(
+                    options['batch_size'], connection, rate_limit)
+                claimed += batch_claimed
+                sent += batch_sent
+                if batch_claimed:
+                    self.stdout.write(json.dumps(mail.queue_stats()))
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['poll_seconds'])
+        except KeyboardInterrupt:
+            pass
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Sent {sent} of {claimed} emails in {elapsed:.1f}s'))
+        self.stdout.write(json.dumps(mail.queue_stats()))
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.23 on 2026-10-18 13:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(blank=True, default=None, max_length=255, null=True, unique=True)),
+                ('subject', models.TextField()),
+                ('body', models.TextField()),
+                ('html_body', models.TextField(blank=True, default='')),
+                ('from_email', models.CharField(max_length=254)),
+                ('to', models.JSONField(default=list)),
+                ('cc', models.JSONField(blank=True, default=list)),
+                ('bcc', models.JSONField(blank=True, default=list)),
+                ('reply_to', models.JSONField(blank=True, default=list)),
+                ('headers', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('dead', 'Dead')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claim', models.CharField(blank=True, db_index=True, default='', max_length=32)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('sent', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outgoingemail',
+            index=models.Index(fields=['status', 'next_attempt'], name='outbox_outg_status_33c9d9_idx'),
+        ),
+    ]
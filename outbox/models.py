@@ -0,0 +1,65 @@
+from django.core.mail import EmailMultiAlternatives
+from django.db import models
+from django.utils import timezone
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email waiting to be sent, or that has been, by send_outbox.
+    It's written in the same transaction as whatever caused it, so an
+    order that's rolled back never has its confirmation sent, and
+    sending it never holds up a request.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        # Failed too many times, and left for someone to look at
+        (DEAD, 'Dead'),
+    )
+
+    class Meta:
+        indexes = [
+            # How the sender finds the emails that are due
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    # Emails that must only be sent once, such as an order's
+    # confirmation, are given a key so queueing one again does nothing
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True, default=None)
+    subject = models.TextField()
+    body = models.TextField()
+    html_body = models.TextField(blank=True, default='')
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    # The sender delivering the email, and when it's given up on if
+    # that sender stops before finishing
+    claim = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    def as_message(self, connection=None):
+        """ The email as a message that can be sent with connection """
+        message = EmailMultiAlternatives(
+            self.subject, self.body, self.from_email, self.to, bcc=self.bcc,
+            connection=connection, headers=self.headers, cc=self.cc,
+            reply_to=self.reply_to)
+        if self.html_body:
+            message.attach_alternative(self.html_body, 'text/html')
+        return message
+
+    def __str__(self):
+        return f'{self.subject} to {", ".join(self.to)}'
@@ -0,0 +1,193 @@
+import socketserver
+import threading
+import time
+
+from django.core import mail as django_mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage, get_connection, send_mail
+from django.test import TestCase, override_settings
+
+from . import mail
+from .models import OutgoingEmail
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """ Speaks just enough SMTP for Django's SMTP backend to send through it """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost stand-in SMTP ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command.split(':', 1)[1].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command.split(':', 1)[1].strip().strip('<>')
+                if recipient in server.reject:
+                    self.reply(f'451 {recipient} is unavailable, try again later')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append({
+                        'from': sender, 'to': recipients, 'data': b''.join(data),
+                    })
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    A local SMTP server that keeps the messages sent to it, for checking
+    email delivery without a real mail server. Messages to an address in
+    reject are refused with a temporary failure. Used as a context
+    manager, it listens on a free port on localhost in a thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, reject=()):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.reject = set(reject)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+@override_settings(
+    EMAIL_BACKEND='outbox.backends.OutboxBackend',
+    DEFAULT_FROM_EMAIL='shop@example.com')
+class OutboxTests(TestCase):
+    """ Emails are queued by send_mail and delivered by send_due """
+
+    def test_send_mail_queues_without_sending(self):
+        send_mail('Your order', 'Thanks for your order', 'shop@example.com',
+                  ['shopper@example.com'], html_message='<p>Thanks for your order</p>')
+
+        self.assertEqual(django_mail.outbox, [])
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.status, OutgoingEmail.PENDING)
+        self.assertEqual(email.to, ['shopper@example.com'])
+        self.assertEqual(email.html_body, '<p>Thanks for your order</p>')
+
+    def test_queueing_with_a_key_queues_once(self):
+        first = mail.queue_mail('Your order', 'Thanks', None, ['shopper@example.com'], key='order:1')
+        second = mail.queue_mail('Your order', 'Thanks', None, ['shopper@example.com'], key='order:1')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(OutgoingEmail.objects.count(), 1)
+
+    @override_settings(DEFAULT_FROM_EMAIL=None)
+    def test_queueing_without_a_from_address(self):
+        with self.assertRaises(ImproperlyConfigured):
+            mail.queue_mail('Your order', 'Thanks', None, ['shopper@example.com'], key='order:1')
+        self.assertFalse(OutgoingEmail.objects.exists())
+
+    def test_attachments_are_refused(self):
+        message = EmailMessage('Invoice', 'Attached', None, ['shopper@example.com'])
+        message.attach('invoice.txt', 'Invoice', 'text/plain')
+        with self.assertRaises(ValueError):
+            mail.queue_message(message)
+
+    @override_settings(OUTBOX_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_send_due_delivers_each_email_once(self):
+        for number in range(3):
+            send_mail(f'Email {number}', 'Body', 'shop@example.com', [f'shopper{number}@example.com'])
+
+        self.assertEqual(mail.send_due(batch_size=2), (3, 3))
+        self.assertEqual(mail.send_due(), (0, 0))
+        self.assertEqual(len(django_mail.outbox), 3)
+        self.assertEqual(
+            OutgoingEmail.objects.filter(status=OutgoingEmail.SENT).count(), 3)
+
+
+@override_settings(
+    EMAIL_BACKEND='outbox.backends.OutboxBackend',
+    OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_SECONDS=0)
+class SMTPDeliveryTests(TestCase):
+    """
+    Emails sent to a local stand-in SMTP server go over one connection
+    at the set rate, and ones the server refuses are retried and then
+    dead-lettered
+    """
+    emails = 20
+    rate = 100
+
+    def setUp(self):
+        self.server = SMTPStandIn(reject=['shopper0@example.com', 'shopper1@example.com'])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def connection(self):
+        return get_connection(
+            'django.core.mail.backends.smtp.EmailBackend', host='127.0.0.1',
+            port=self.server.port, use_tls=False, use_ssl=False,
+            username='', password='', timeout=5, fail_silently=False)
+
+    def test_delivery(self):
+        addresses = [f'shopper{number}@example.com' for number in range(self.emails)]
+        for number, address in enumerate(addresses):
+            send_mail(f'Email {number}', 'Body', 'shop@example.com', [address])
+        self.assertEqual(self.server.messages, [])
+
+        start = time.perf_counter()
+        with self.assertLogs('outbox.mail', 'WARNING'):
+            claimed, sent = mail.send_due(10, self.connection(), mail.RateLimit(self.rate))
+        elapsed = time.perf_counter() - start
+
+        accepted = sorted(set(addresses) - self.server.reject)
+        self.assertEqual(sent, len(accepted))
+        self.assertEqual(
+            sorted(to for message in self.server.messages for to in message['to']), accepted)
+        dead = OutgoingEmail.objects.filter(status=OutgoingEmail.DEAD)
+        self.assertEqual(sorted(email.to[0] for email in dead), sorted(self.server.reject))
+        self.assertTrue(all(email.attempts == 2 for email in dead))
+        self.assertFalse(OutgoingEmail.objects.exclude(
+            status__in=(OutgoingEmail.SENT, OutgoingEmail.DEAD)).exists())
+
+        # One connection, and a new one after each failure
+        failed_attempts = len(self.server.reject) * 2
+        self.assertLessEqual(self.server.connections, 1 + failed_attempts)
+        # No faster than the rate allows
+        self.assertGreaterEqual(elapsed, (sent + failed_attempts - 1) / self.rate * 0.95)
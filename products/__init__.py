@@ -0,0 +1 @@
+default_app_config = 'products.apps.ProductsConfig'
\ No newline at end of file
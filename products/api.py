@@ -0,0 +1,192 @@
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_safe
+
+from .catalog import catalog_version, catalog_last_modified
+from .listing import product_listing
+from .models import Product
+from .pagination import keyset_queryset, ranked_rows, encode_cursor, cached_count
+
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Product rows are read with values() so no model instances are built
+API_FIELDS = (
+    'id', 'sku', 'name', 'description', 'price', 'rating', 'has_sizes',
+    'image', 'image_url', 'image_derivatives',
+    'category__name', 'category__friendly_name',
+)
+
+# Serialized products are cached until the catalog changes
+API_CACHE_TIMEOUT = 60 * 60
+
+
+def _catalog_etag(request, *args, **kwargs):
+    """
+    Every response is tagged with the catalog version and its url, so
+    the tag changes whenever any product does. The version comes from
+    the shared cache, so every worker gives a request the same tag, and
+    unchanged requests are answered with a 304 before any query.
+    """
+    key_source = f'{catalog_version()}:{request.get_full_path()}'
+    return hashlib.md5(key_source.encode()).hexdigest()
+
+
+def _catalog_last_modified(request, *args, **kwargs):
+    return catalog_last_modified()
+
+
+catalog_conditions = condition(
+    etag_func=_catalog_etag, last_modified_func=_catalog_last_modified)
+
+
+def serialize_product(row):
+    """ The API representation of a product row read with API_FIELDS """
+    derivatives = {
+        size: {
+            'width': files['width'],
+            **{extension: default_storage.url(name)
+               for extension, name in files.items() if extension != 'width'},
+        }
+        for size, files in (row['image_derivatives'] or {}).items()
+    }
+    return {
+        'id': row['id'],
+        'sku': row['sku'],
+        'name': row['name'],
+        'description': row['description'],
+        'price': str(row['price']),
+        'rating': row['rating'],
+        'has_sizes': bool(row['has_sizes']),
+        'category': row['category__name'] and {
+            'name': row['category__name'],
+            'friendly_name': row['category__friendly_name'],
+        },
+        'image': row['image'] and default_storage.url(row['image']),
+        'image_url': row['image_url'],
+        'image_derivatives': derivatives,
+    }
+
+
+def _dumps(data):
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+def _page_url(request, name, cursor):
+    """ Absolute url for the neighbouring page, given its cursor """
+    query = request.GET.copy()
+    query.pop('after', None)
+    query.pop('before', None)
+    query[name] = cursor
+    return request.build_absolute_uri(f'{request.path}?{query.urlencode()}')
+
+
+def _stream_page(request, rows, sortkey, page_size, cursor, backwards, total):
+    """
+    Generate the JSON for a page of products piece by piece, so each
+    row is serialized and sent as it comes out of the database
+    """
+    yield '{"count": %d, "results": [' % total
+
+    has_more = False
+    if backwards:
+        # Rows before a cursor come out in reverse, so this page is
+        # read in full to put it back in order. Pages are bounded by
+        # API_MAX_PAGE_SIZE, so this never holds much.
+        rows = list(rows)
+        has_more = len(rows) > page_size
+        rows = reversed(rows[:page_size])
+
+    first = last = None
+    for index, row in enumerate(rows):
+        # One extra row is fetched to find out if there is another page
+        if index == page_size:
+            has_more = True
+            break
+        if first is None:
+            first = row
+        last = row
+        yield (',' if index else '') + _dumps(serialize_product(row))
+
+    next_url = previous_url = None
+    if last is not None:
+        if has_more or backwards:
+            next_url = _page_url(
+                request, 'after', encode_cursor(last[sortkey], last['id']))
+        if (has_more and backwards) or (cursor is not None and not backwards):
+            previous_url = _page_url(
+                request, 'before', encode_cursor(first[sortkey], first['id']))
+
+    yield '], "next": %s, "previous": %s}' % (_dumps(next_url), _dumps(previous_url))
+
+
+# Clients may keep responses but must check they're still current
+@require_safe
+@cache_control(public=True, no_cache=True)
+@catalog_conditions
+def product_list(request):
+    """
+    List products as JSON, taking the same sort, direction, category,
+    q and facet parameters as the products page. Pages are selected
+    with the after and before cursors given in the next and previous
+    urls, and page_size sets how many products each page holds.
+    """
+    if 'q' in request.GET and not request.GET['q']:
+        return JsonResponse({'error': "You didn't enter any search criteria!"}, status=400)
+
+    try:
+        page_size = int(request.GET.get('page_size', API_PAGE_SIZE))
+    except ValueError:
+        page_size = API_PAGE_SIZE
+    page_size = max(1, min(page_size, API_MAX_PAGE_SIZE))
+
+    listing = product_listing(request.GET)
+    total = cached_count(listing.products, *listing.count_key())
+
+    sortkey = listing.sortkey or 'id'
+    if listing.ranked_ids is not None:
+        # Search results follow their order of relevance, with each
+        # row given its rank to build the cursors from
+        rows, cursor, backwards = ranked_rows(
+            listing.products.values(*API_FIELDS), listing.ranked_ids,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+            limit=page_size + 1,
+        )
+    else:
+        queryset, cursor, backwards = keyset_queryset(
+            listing.products, sortkey, listing.descending,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'),
+        )
+        fields = API_FIELDS if sortkey in API_FIELDS else API_FIELDS + (sortkey,)
+        # The rows are fetched from a server side cursor where the database
+        # supports one, rather than loaded into memory all at once
+        rows = queryset.values(*fields)[:page_size + 1].iterator(chunk_size=API_PAGE_SIZE)
+
+    return StreamingHttpResponse(
+        _stream_page(request, rows, sortkey, page_size, cursor, backwards, total),
+        content_type='application/json')
+
+
+# Clients may keep responses but must check they're still current
+@require_safe
+@cache_control(public=True, no_cache=True)
+@catalog_conditions
+def product_detail(request, product_id):
+    """ A single product as JSON """
+    key = f'products:api:product:{catalog_version()}:{product_id}'
+    content = cache.get(key)
+    if content is None:
+        row = Product.objects.filter(pk=product_id).values(*API_FIELDS).first()
+        if row is None:
+            return JsonResponse({'error': 'Product not found'}, status=404)
+        content = _dumps(serialize_product(row))
+        cache.set(key, content, API_CACHE_TIMEOUT)
+    return HttpResponse(content, content_type='application/json')
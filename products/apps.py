@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    # Imports the signals module so the search index is kept
+    # up to date whenever products or categories are changed
+    def ready(self):
+        import products.signals
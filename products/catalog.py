@@ -0,0 +1,103 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.core.cache import cache
+
+CATALOG_VERSION_KEY = 'products:catalog_version'
+CATALOG_MODIFIED_KEY = 'products:catalog_modified'
+PRICE_VERSION_KEY = 'products:price_version'
+
+# Versions already read from the shared cache during the current
+# request, so each is only fetched once. Outside a request they're
+# always fetched.
+_request_versions = ContextVar('catalog_versions', default=None)
+
+
+@contextmanager
+def versions_for_request():
+    """ Remember the versions read within the block, usually one request """
+    token = _request_versions.set({})
+    try:
+        yield
+    finally:
+        _request_versions.reset(token)
+
+
+def new_version():
+    """
+    A version number not used before. It's made from the current time,
+    so a version lost from the cache never comes back, with a random
+    part so two processes moving a version on at once don't pick the
+    same one.
+    """
+    return int(time.time() * 1000) * 1000 + random.randrange(1000)
+
+
+def _current_version(key, default=new_version):
+    seen = _request_versions.get()
+    if seen is not None and key in seen:
+        return seen[key]
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, default(), None)
+        version = cache.get(key)
+    if seen is not None:
+        seen[key] = version
+    return version
+
+
+def _bump_version(key):
+    # Set rather than incremented, as not every cache increments
+    # atomically, and two changes at once must still each leave a
+    # version nothing was cached under
+    version = new_version()
+    cache.set(key, version, None)
+    seen = _request_versions.get()
+    if seen is not None:
+        seen[key] = version
+    return version
+
+
+def catalog_version():
+    """
+    Return the current catalog version. Cache keys for anything derived
+    from the catalog include it, so they change whenever a product does.
+    """
+    return _current_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """ Move the catalog on to a new version after a product change """
+    cache.set(CATALOG_MODIFIED_KEY, time.time(), None)
+    seen = _request_versions.get()
+    if seen is not None:
+        seen.pop(CATALOG_MODIFIED_KEY, None)
+    return _bump_version(CATALOG_VERSION_KEY)
+
+
+def price_version():
+    """
+    Return the current price version. It only moves on when a price
+    changes or a product is deleted, so totals stored with a version
+    are known to be right while it stays the same.
+    """
+    return _current_version(PRICE_VERSION_KEY)
+
+
+def bump_price_version():
+    """ Move prices on to a new version after a price change """
+    return _bump_version(PRICE_VERSION_KEY)
+
+
+def catalog_last_modified():
+    """
+    Return when the catalog last changed, as an aware datetime. Like the
+    version, it lives in the shared cache so every process gives the
+    same answer. If it's been lost it restarts from now, which only
+    means clients fetch a fresh copy.
+    """
+    timestamp = _current_version(CATALOG_MODIFIED_KEY, time.time)
+    return datetime.fromtimestamp(int(timestamp), tz=timezone.utc)
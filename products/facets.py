@@ -0,0 +1,377 @@
+import hashlib
+import json
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When
+
+from .catalog import catalog_version
+from .models import Category, FacetCell, Product
+
+# (min_price, max_price, label) for each price facet. Bounds
+# are inclusive and prices only ever have two decimal places.
+PRICE_BUCKETS = (
+    (None, Decimal('24.99'), 'Under $25'),
+    (Decimal('25'), Decimal('49.99'), '$25 to $50'),
+    (Decimal('50'), Decimal('99.99'), '$50 to $100'),
+    (Decimal('100'), None, '$100 & above'),
+)
+
+# Minimum ratings offered as "& up" facets
+RATING_BUCKETS = (4, 3, 2, 1)
+
+# Cell counts, read from FacetCell, and counts for searches and
+# uneven ranges are cached until the catalog changes
+FACET_CACHE_TIMEOUT = 60 * 60
+
+RANGE_FILTERS = ('min_price', 'max_price', 'min_rating', 'max_rating')
+
+
+def parse_filters(params):
+    """
+    Read the range filters and has_sizes toggle from GET
+    parameters, ignoring any values that aren't valid numbers
+    """
+    filters = {}
+    for name in RANGE_FILTERS:
+        try:
+            filters[name] = Decimal(params[name])
+        except (KeyError, InvalidOperation):
+            filters[name] = None
+        else:
+            if not filters[name].is_finite():
+                filters[name] = None
+    filters['has_sizes'] = params.get('has_sizes') == '1'
+    return filters
+
+
+def filter_queryset(products, filters):
+    """ Apply the parsed range filters to a product queryset """
+    if filters['min_price'] is not None:
+        products = products.filter(price__gte=filters['min_price'])
+    if filters['max_price'] is not None:
+        products = products.filter(price__lte=filters['max_price'])
+    if filters['min_rating'] is not None:
+        products = products.filter(rating__gte=filters['min_rating'])
+    if filters['max_rating'] is not None:
+        products = products.filter(rating__lte=filters['max_rating'])
+    if filters['has_sizes']:
+        products = products.filter(has_sizes=True)
+    return products
+
+
+def price_bucket(price):
+    """ Index of the price bucket a price falls into """
+    for index, (low, high, label) in enumerate(PRICE_BUCKETS):
+        if high is None or price <= high:
+            return index
+    return len(PRICE_BUCKETS) - 1
+
+
+def rating_floor(rating):
+    """
+    The highest of 0 and RATING_BUCKETS a rating reaches, or None
+    for products without a rating
+    """
+    if rating is None:
+        return None
+    return next((minimum for minimum in RATING_BUCKETS if rating >= minimum), 0)
+
+
+def product_cell(category_id, price, rating, has_sizes):
+    """ The (category_id, price bucket, rating floor, has_sizes) cell of a product """
+    return category_id, price_bucket(price), rating_floor(rating), bool(has_sizes)
+
+
+def _bucket_q(index):
+    """ A filter for the products in a price bucket """
+    low, high, label = PRICE_BUCKETS[index]
+    q = Q()
+    if low is not None:
+        q &= Q(price__gte=low)
+    if high is not None:
+        q &= Q(price__lte=high)
+    return q
+
+
+def _cells(products, category_field='category__name'):
+    """
+    Count the products in each cell of (category, price bucket, rating
+    floor, has_sizes), with one grouped query. This is only used to
+    count search results and to rebuild FacetCell, as the catalog's
+    own counts are kept up to date by the product signals.
+    """
+    price = Case(
+        *[When(_bucket_q(index), then=Value(index)) for index in range(len(PRICE_BUCKETS))],
+        output_field=IntegerField())
+    rating = Case(
+        *[When(rating__gte=minimum, then=Value(minimum)) for minimum in RATING_BUCKETS],
+        When(rating__isnull=False, then=Value(0)),
+        default=None, output_field=IntegerField())
+    rows = (
+        products
+        .annotate(price_bucket=price, rating_floor=rating)
+        .values_list(category_field, 'price_bucket', 'rating_floor', 'has_sizes')
+        .annotate(products=Count('id'))
+        .order_by()
+    )
+    return [(category, bucket, floor, bool(has_sizes), products)
+            for category, bucket, floor, has_sizes, products in rows]
+
+
+def _grid(cell_model, category_id, counts=None):
+    """ A row for every cell of a category, with counts from a dict of cell to count """
+    counts = counts or {}
+    return [
+        cell_model(category_id=category_id, price_bucket=bucket, rating_floor=floor,
+                   has_sizes=has_sizes,
+                   products=counts.get((category_id, bucket, floor, has_sizes), 0))
+        for bucket in range(len(PRICE_BUCKETS))
+        for floor in (None, 0) + RATING_BUCKETS
+        for has_sizes in (False, True)
+    ]
+
+
+def add_category_cells(category_id):
+    """ Create the empty cells for a new category """
+    FacetCell.objects.bulk_create(_grid(FacetCell, category_id), ignore_conflicts=True)
+
+
+def write_cells(cell_model, category_ids, products):
+    """
+    Replace every cell with counts from one grouped query over the
+    products. Used by rebuild_cells, and by the migration that adds
+    FacetCell with its own models.
+    """
+    counts = {
+        (category_id, bucket, floor, has_sizes): count
+        for category_id, bucket, floor, has_sizes, count in _cells(products, 'category_id')
+    }
+    cell_model.objects.all().delete()
+    for category_id in [None, *category_ids]:
+        cell_model.objects.bulk_create(_grid(cell_model, category_id, counts))
+    return sum(counts.values())
+
+
+def rebuild_cells():
+    """
+    Count every cell again from the products, for when they've been
+    changed without signals, such as by bulk_create or update().
+    Returns the number of products counted.
+    """
+    with transaction.atomic():
+        counted = write_cells(
+            FacetCell, Category.objects.values_list('id', flat=True), Product.objects.all())
+    cache.delete(_cells_cache_key())
+    return counted
+
+
+def _adjust(cell, amount):
+    """ Add amount to the products in a cell """
+    category_id, bucket, floor, has_sizes = cell
+    updated = FacetCell.objects.filter(
+        category_id=category_id, price_bucket=bucket, rating_floor=floor, has_sizes=has_sizes,
+    ).update(products=F('products') + amount)
+    if not updated:
+        # Only cells lost since the category was created are missing
+        FacetCell.objects.create(
+            category_id=category_id, price_bucket=bucket, rating_floor=floor,
+            has_sizes=has_sizes, products=amount)
+
+
+def move_product(old_cell, new_cell):
+    """
+    Move a product from one cell to another, either of which is None
+    for a product being created or deleted
+    """
+    if old_cell == new_cell:
+        return
+    if old_cell is not None:
+        _adjust(old_cell, -1)
+    if new_cell is not None:
+        _adjust(new_cell, 1)
+
+
+def move_category_cells(category_id):
+    """
+    Move the counts of a category that's being deleted into the cells
+    without a category, as its products are left without one
+    """
+    cells = FacetCell.objects.filter(category_id=category_id, products__gt=0)
+    for cell in cells:
+        _adjust((None, cell.price_bucket, cell.rating_floor, cell.has_sizes), cell.products)
+    cells.update(products=0)
+
+
+def _cells_cache_key():
+    return f'products:facet_cells:{catalog_version()}'
+
+
+def facet_cells():
+    """
+    The cell counts for the current catalog, read from FacetCell. They're
+    kept in the shared cache until the catalog changes, so most requests
+    don't read them at all.
+    """
+    key = _cells_cache_key()
+    cells = cache.get(key)
+    if cells is None:
+        cells = list(FacetCell.objects.filter(products__gt=0).values_list(
+            'category__name', 'price_bucket', 'rating_floor', 'has_sizes', 'products'))
+        cache.set(key, cells, FACET_CACHE_TIMEOUT)
+    return cells
+
+
+def _aligned_buckets(filters):
+    """
+    The price buckets and rating floors the range filters cover, each
+    None when that filter isn't set. Returns None if a filter cuts
+    through a bucket, as its counts can't be added up from cells.
+    """
+    min_price, max_price = filters['min_price'], filters['max_price']
+    buckets = None
+    if min_price is not None or max_price is not None:
+        lows = [low for low, high, label in PRICE_BUCKETS]
+        highs = [high for low, high, label in PRICE_BUCKETS]
+        if min_price is None or min_price <= 0:
+            first = 0
+        elif min_price in lows:
+            first = lows.index(min_price)
+        else:
+            return None
+        if max_price is None:
+            last = len(PRICE_BUCKETS) - 1
+        elif max_price in highs:
+            last = highs.index(max_price)
+        else:
+            return None
+        buckets = set(range(first, last + 1))
+
+    min_rating, max_rating = filters['min_rating'], filters['max_rating']
+    floors = None
+    if max_rating is not None:
+        return None
+    if min_rating is not None:
+        if min_rating <= 0:
+            min_rating = 0
+        elif min_rating not in RATING_BUCKETS:
+            return None
+        floors = {floor for floor in (0,) + RATING_BUCKETS if floor >= min_rating}
+    return buckets, floors
+
+
+def _count_cells(cells, filters, categories, buckets, floors):
+    """
+    Add up cells into facet counts. Each facet ignores its own filter,
+    so the other options in it stay visible with the number of
+    products they would show.
+    """
+    want_sizes = filters['has_sizes']
+    counts = Counter()
+    for category_name, bucket, floor, has_sizes, products in cells:
+        category_ok = categories is None or category_name in categories
+        price_ok = buckets is None or bucket in buckets
+        rating_ok = floors is None or floor in floors
+        sizes_ok = has_sizes or not want_sizes
+
+        if price_ok and rating_ok and sizes_ok and category_name is not None:
+            counts['category', category_name] += products
+        if category_ok and rating_ok and sizes_ok:
+            counts['price', bucket] += products
+        if category_ok and price_ok and sizes_ok and floor is not None:
+            for minimum in RATING_BUCKETS:
+                if floor >= minimum:
+                    counts['rating', minimum] += products
+        if category_ok and price_ok and rating_ok and has_sizes:
+            counts['has_sizes'] += products
+    return counts
+
+
+def _aggregate_counts(filters, categories, product_ids):
+    """
+    Count facets in the database, for ranges that cut through buckets.
+    Two queries, both using the indexes on price and rating: one
+    grouped by category, and one for the rest.
+    """
+    products = Product.objects.order_by()
+    if product_ids is not None:
+        products = products.filter(id__in=product_ids)
+
+    price_q, rating_q = Q(), Q()
+    if filters['min_price'] is not None:
+        price_q &= Q(price__gte=filters['min_price'])
+    if filters['max_price'] is not None:
+        price_q &= Q(price__lte=filters['max_price'])
+    if filters['min_rating'] is not None:
+        rating_q &= Q(rating__gte=filters['min_rating'])
+    if filters['max_rating'] is not None:
+        rating_q &= Q(rating__lte=filters['max_rating'])
+    filters_q = {
+        'category': Q(category__name__in=categories) if categories is not None else Q(),
+        'price': price_q,
+        'rating': rating_q,
+        'has_sizes': Q(has_sizes=True) if filters['has_sizes'] else Q(),
+    }
+
+    def others(facet):
+        # Every filter but the facet's own
+        q = Q()
+        for name, facet_q in filters_q.items():
+            if name != facet:
+                q &= facet_q
+        return q
+
+    counts = Counter()
+    by_category = (
+        products.filter(others('category'), category__isnull=False)
+        .values_list('category__name').annotate(products=Count('id'))
+    )
+    for category_name, count in by_category:
+        counts['category', category_name] += count
+
+    aggregates = {
+        f'price_{index}': Count('id', filter=others('price') & _bucket_q(index))
+        for index in range(len(PRICE_BUCKETS))
+    }
+    aggregates.update({
+        f'rating_{minimum}': Count('id', filter=others('rating') & Q(rating__gte=minimum))
+        for minimum in RATING_BUCKETS
+    })
+    aggregates['has_sizes'] = Count('id', filter=others('has_sizes') & Q(has_sizes=True))
+    totals = products.aggregate(**aggregates)
+    for index in range(len(PRICE_BUCKETS)):
+        counts['price', index] = totals[f'price_{index}']
+    for minimum in RATING_BUCKETS:
+        counts['rating', minimum] = totals[f'rating_{minimum}']
+    counts['has_sizes'] = totals['has_sizes']
+    return +counts
+
+
+def facet_counts(filters, categories=None, product_ids=None, query=None):
+    """
+    Return a Counter of facet counts for the current listing, keyed by
+    ('category', name), ('price', bucket index), ('rating', minimum)
+    and 'has_sizes'. query identifies the product_ids for caching.
+    """
+    aligned = _aligned_buckets(filters)
+    if aligned is not None and product_ids is None:
+        return _count_cells(facet_cells(), filters, categories, *aligned)
+
+    key_source = json.dumps([
+        catalog_version(), sorted(categories or []), query,
+        [filters[name] for name in RANGE_FILTERS], filters['has_sizes'],
+    ], default=str)
+    key = 'products:facets:' + hashlib.md5(key_source.encode()).hexdigest()
+    counts = cache.get(key)
+    if counts is None:
+        if aligned is not None:
+            # Search results, counted into cells of their own
+            counts = _count_cells(
+                _cells(Product.objects.filter(id__in=product_ids)),
+                filters, categories, *aligned)
+        else:
+            counts = _aggregate_counts(filters, categories, product_ids)
+        cache.set(key, counts, FACET_CACHE_TIMEOUT)
+    return counts
@@ -29,4 +29,16 @@ class ProductForm(forms.ModelForm):
         # Iterate through the fields and set classes
         # to match the theme of the rest of site.
         for field_name, field in self.fields.items():
-            field.widget.attrs['class'] = 'border-black rounded-0'
\ No newline at end of file
+            field.widget.attrs['class'] = 'border-black rounded-0'
+
+    def save(self, commit=True):
+        """
+        Clear the resized copies of a replaced or removed
+        image until new ones have been built
+        """
+        product = super().save(commit=False)
+        if 'image' in self.changed_data:
+            product.image_derivatives = {}
+        if commit:
+            product.save()
+        return product
@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .catalog import bump_catalog_version
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# Maximum width in pixels of each derivative image
+DERIVATIVE_SIZES = {
+    'thumb': 150,
+    'card': 400,
+    'detail': 1000,
+}
+
+# File extension and Pillow format for each derivative format.
+# WebP is served to browsers that support it, with JPEG as a fallback.
+DERIVATIVE_FORMATS = {
+    'webp': 'WEBP',
+    'jpg': 'JPEG',
+}
+
+DERIVATIVE_QUALITY = 82
+DERIVATIVES_LOCATION = 'derivatives'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def derivative_name(image_name, size, extension):
+    """ Storage name for one derivative of an uploaded image """
+    stem = os.path.splitext(image_name)[0]
+    return f'{DERIVATIVES_LOCATION}/{stem}-{size}.{extension}'
+
+
+def build_derivatives(image_name):
+    """
+    Build every size and format of derivative for an image, writing
+    them through the default storage. Returns the derivatives dict
+    stored on Product.image_derivatives, keyed by size name.
+
+    Runs in a worker process, so it must not touch the database.
+    """
+    with default_storage.open(image_name, 'rb') as image_file:
+        original = Image.open(image_file)
+        # Camera images may be stored on their side with an EXIF rotation
+        original = ImageOps.exif_transpose(original).convert('RGB')
+
+    derivatives = {}
+    built_widths = {}
+    for size, max_width in sorted(DERIVATIVE_SIZES.items(), key=lambda item: item[1]):
+        image = original.copy()
+        # Images are only ever scaled down, keeping their aspect ratio
+        image.thumbnail((max_width, max_width * 4), Image.LANCZOS)
+        # Larger sizes of a small original would all be the same
+        # image, so they share the files already built for it
+        if image.width in built_widths:
+            derivatives[size] = derivatives[built_widths[image.width]]
+            continue
+        built_widths[image.width] = size
+        derivatives[size] = {'width': image.width}
+        for extension, image_format in DERIVATIVE_FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, image_format, quality=DERIVATIVE_QUALITY, optimize=True)
+            name = derivative_name(image_name, size, extension)
+            # Storage backends rename files rather than overwrite them
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            derivatives[size][extension] = default_storage.save(
+                name, ContentFile(buffer.getvalue()))
+    return derivatives
+
+
+def store_derivatives(image_name, derivatives):
+    """
+    Record built derivatives on every product using the image. The
+    update time changes too, so cached product cards are refreshed.
+    """
+    Product.objects.filter(image=image_name).update(
+        image_derivatives=derivatives, updated_at=timezone.now())
+    bump_catalog_version()
+
+
+def get_executor():
+    """ The process pool derivatives are built in, started on first use """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=2)
+        return _executor
+
+
+def _on_built(image_name, future):
+    """ Store the result of a finished build back in the web process """
+    close_old_connections()
+    try:
+        store_derivatives(image_name, future.result())
+    except Exception:
+        logger.exception('Failed to build derivatives for %s', image_name)
+    finally:
+        close_old_connections()
+
+
+def schedule_derivatives(image_name):
+    """
+    Build derivatives for an image in the process pool once the current
+    transaction commits, so the request doesn't wait for the resizing
+    """
+    def submit():
+        future = get_executor().submit(build_derivatives, image_name)
+        future.add_done_callback(lambda done: _on_built(image_name, done))
+
+    transaction.on_commit(submit)
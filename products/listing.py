@@ -0,0 +1,112 @@
+# Special object used to generate search query
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from .models import Product, Category
+from . import search, facets
+from .pagination import SORT_KEYS
+
+
+class Listing:
+    """
+    The products matching the sort, category, search and facet
+    GET parameters shared by the product page and the catalog API
+    """
+
+    def __init__(self):
+        # Category is selected along with each product as every
+        # product card displays its category's friendly name
+        self.products = Product.objects.select_related('category')
+        self.query = None
+        self.categories = None
+        self.category_names = None
+        self.search_ids = None
+        # Every search match in order of relevance, which the page
+        # follows when no other sort has been chosen
+        self.ranked_ids = None
+        self.sort = None
+        self.direction = None
+        # Field and direction used to order the page of products
+        self.sortkey = None
+        self.descending = False
+        self.filters = None
+
+    def count_key(self):
+        """ Identifies the filters applied, for caching the product count """
+        return (
+            self.category_names and ','.join(self.category_names), self.query,
+            [self.filters[name] for name in facets.RANGE_FILTERS],
+            self.filters['has_sizes'],
+        )
+
+
+def product_listing(params):
+    """
+    Filter and order products from a dict of GET parameters. An empty
+    q parameter should be rejected by the caller before getting here.
+    """
+    listing = Listing()
+    products = listing.products
+
+    # Check if sort is in the parameters
+    if 'sort' in params:
+        # if it is, we set it to both sort (which is None) and sortkey
+        sortkey = params['sort']
+        listing.sort = sortkey
+        # Sets case insensitivity sorting on name
+        # field by setting name to lowercase
+        if sortkey == 'name':
+            # preserves original field name by renaming sortkey to
+            # lower_name in the event the user is sorting by name
+            sortkey = 'lower_name'
+            # Annotate current list of products with new field
+            products = products.annotate(lower_name=Lower('name'))
+        # Allows categorized products to be sorted by name
+        if sortkey == 'category':
+            sortkey = 'category__name'
+        # Unknown sort keys are ignored rather than raising an error
+        if sortkey not in SORT_KEYS:
+            sortkey = None
+        listing.sortkey = sortkey
+        # Checks to see if direction is ascending or descending
+        if 'direction' in params:
+            listing.direction = params['direction']
+            # Reverses direction if direction is descending
+            listing.descending = listing.direction == 'desc'
+
+    # If a category is submitted
+    if 'category' in params:
+        # splits categories into list at the commas
+        listing.category_names = params['category'].split(',')
+        # Filters all products whos category name is in list
+        products = products.filter(category__name__in=listing.category_names)
+        # Filter categories down to names in the list
+        listing.categories = Category.objects.filter(name__in=listing.category_names)
+
+    # if 'q' is in the parameters, assigns variable to submitted value
+    if params.get('q'):
+        query = listing.query = params['q']
+
+        if search.is_index_empty():
+            # Falls back to filtering on name OR description until
+            # the search index has been built.
+            # "i" makes queries case insensitive
+            queries = Q(name__icontains=query) | Q(description__icontains=query)
+            products = products.filter(queries)
+            listing.search_ids = Product.objects.filter(queries).values('id')
+        else:
+            # Every product matching the query in the search index is
+            # listed and counted, filtered with a subquery rather than
+            # a list of ids that grows with the number of matches
+            matches = search.matching_products(query)
+            products = products.filter(id__in=matches)
+            listing.search_ids = matches
+            # Best matches are shown first unless a sort was chosen
+            if not listing.sortkey:
+                listing.ranked_ids = search.ranked_ids(query)
+                listing.sortkey = 'search_rank'
+
+    # Price and rating ranges and the has sizes toggle
+    listing.filters = facets.parse_filters(params)
+    listing.products = facets.filter_queryset(products, listing.filters)
+    return listing
@@ -0,0 +1,96 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from boutique_ado.money import Money
+from products.models import Product, Category
+from products import search
+
+# Words used to build synthetic product names and descriptions
+WORDS = (
+    'cotton shirt jeans denim dress linen blue black white red slim fit '
+    'relaxed classic stretch soft wool knit jacket sweater hoodie towel '
+    'sheet pillow mug plate bowl glass kitchen bath bed summer winter '
+    'casual formal vintage organic washable imported pocket button zip'
+).split()
+
+# Real catalogs have a long tail of rarer words, so the common words
+# above are padded out with made up ones on a Zipf-like distribution
+VOCABULARY = WORDS + [f'{word}{n}' for n in range(100) for word in WORDS]
+VOCABULARY_WEIGHTS = [1 / rank for rank in range(1, len(VOCABULARY) + 1)]
+
+
+class Command(BaseCommand):
+    help = ('Compare search latency of the inverted index against the '
+            'icontains filter, optionally on a generated catalog')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--generate', type=int, default=0,
+            help='Add this many synthetic products before benchmarking. '
+                 'They are rolled back once the benchmark finishes.')
+        parser.add_argument(
+            '--queries', nargs='*',
+            default=['jeans', 'cotton shirt', 'kitchen', 'blue denim jacket'],
+            help='Search terms to benchmark')
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Number of times each query is timed')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['generate']:
+                self._generate(options['generate'])
+            self._benchmark(options['queries'], options['repeat'])
+            # Always discard any generated products
+            transaction.set_rollback(True)
+
+    def _generate(self, count):
+        categories = list(Category.objects.all()) or [None]
+        products = []
+        for i in range(count):
+            products.append(Product(
+                sku=f'bench{i:08d}',
+                name=' '.join(self._words(3)).title(),
+                description=' '.join(self._words(30)),
+                category=random.choice(categories),
+                price=Money(random.randint(100, 20000)),
+            ))
+        # bulk_create skips the post_save signals, so
+        # the index is rebuilt in one pass afterwards
+        Product.objects.bulk_create(products, batch_size=1000)
+        start = time.perf_counter()
+        search.rebuild_index()
+        self.stdout.write(
+            f'Generated and indexed {count} products '
+            f'(index build {time.perf_counter() - start:.2f}s)')
+
+    def _words(self, count):
+        return random.choices(VOCABULARY, weights=VOCABULARY_WEIGHTS, k=count)
+
+    def _time(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings), result
+
+    def _benchmark(self, queries, repeat):
+        self.stdout.write(f'Catalog size: {Product.objects.count()} products')
+        self.stdout.write(
+            f'{"query":<24}{"icontains ms":>14}{"hits":>8}{"index ms":>12}{"hits":>8}')
+        for query in queries:
+            icontains_ms, icontains_hits = self._time(
+                lambda: len(Product.objects.filter(
+                    Q(name__icontains=query) | Q(description__icontains=query)
+                ).values_list('id', flat=True)), repeat)
+            index_ms, index_hits = self._time(
+                lambda: len(search.search(query)), repeat)
+            self.stdout.write(
+                f'{query:<24}{icontains_ms:>14.2f}{icontains_hits:>8}'
+                f'{index_ms:>12.2f}{index_hits:>8}')
@@ -0,0 +1,48 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from products.models import Product
+from products.images import build_derivatives, store_derivatives
+
+
+class Command(BaseCommand):
+    help = 'Build resized and WebP copies of existing product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Rebuild derivatives for images that already have them')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of worker processes (defaults to the CPU count)')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['all']:
+            products = products.filter(image_derivatives={})
+        # Several products can share an image, which is only built once
+        image_names = sorted(set(products.values_list('image', flat=True)))
+        self.stdout.write(f'Building derivatives for {len(image_names)} images')
+
+        start = time.perf_counter()
+        built = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(build_derivatives, name): name
+                for name in image_names
+            }
+            # Results are stored from this process as the workers finish
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    store_derivatives(name, future.result())
+                    built += 1
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Failed to build {name}: {e}')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Built {built} images in {elapsed:.1f}s ({failed} failed)'))
@@ -0,0 +1,324 @@
+import csv
+import json
+import os
+import tarfile
+import time
+import zipfile
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from boutique_ado.money import Money
+from products.models import Product, Category
+from products.catalog import bump_catalog_version, bump_price_version
+from products import facets, search
+
+# Product fields that can be imported, besides category
+PRODUCT_FIELDS = (
+    'sku', 'name', 'description', 'has_sizes', 'price',
+    'rating', 'image_url', 'image',
+)
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_array(stream):
+    """
+    Yield the objects in a JSON array one at a time, reading the
+    file in chunks so the whole document is never held in memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip whitespace and the commas between items
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != '[':
+                raise CommandError('JSON files must contain an array of objects')
+            started = True
+            position += 1
+            continue
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The next item runs past the end of the buffer
+            if eof:
+                raise CommandError('JSON file ended part way through an item')
+            chunk = stream.read(READ_CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        # A number at the very end of the buffer may have been cut short
+        if end == len(buffer) and not eof:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield item
+        position = end
+
+
+def iter_records(path, file_format):
+    """ Yield one dictionary per row of a JSON, JSONL or CSV file """
+    with open(path, encoding='utf-8', newline='') as stream:
+        if file_format == 'json':
+            yield from iter_json_array(stream)
+        elif file_format == 'jsonl':
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(stream)
+
+
+class ImageArchive:
+    """ Read access to images in a zip or tar archive, by file name """
+
+    def __init__(self, path):
+        if zipfile.is_zipfile(path):
+            self.archive = zipfile.ZipFile(path)
+            names = self.archive.namelist()
+        else:
+            self.archive = tarfile.open(path)
+            names = [member.name for member in self.archive.getmembers() if member.isfile()]
+        # Images are matched on their base name, wherever they
+        # sit in the archive's folder structure
+        self.members = {os.path.basename(name): name for name in names}
+
+    def read(self, name):
+        member = self.members.get(os.path.basename(name))
+        if member is None:
+            return None
+        if isinstance(self.archive, zipfile.ZipFile):
+            return self.archive.read(member)
+        return self.archive.extractfile(member).read()
+
+    def close(self):
+        self.archive.close()
+
+
+class Command(BaseCommand):
+    help = ('Stream products from a JSON, JSONL or CSV file into the '
+            'catalog, creating or updating them by sku in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='Files to import, in order. Fixture category ids refer '
+                 'to categories from an earlier file in the same run.')
+        parser.add_argument(
+            '--format', choices=('json', 'jsonl', 'csv'),
+            help='File format, detected from the extension by default')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of products written per batch')
+        parser.add_argument(
+            '--images',
+            help='Zip or tar archive containing the product image files')
+        parser.add_argument(
+            '--skip-index', action='store_true',
+            help="Don't update the search index. Run rebuild_search_index afterwards.")
+
+    def handle(self, *args, **options):
+        files = []
+        for path in options['paths']:
+            file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+            if file_format not in ('json', 'jsonl', 'csv'):
+                raise CommandError(f'Unknown file format: {file_format}')
+            files.append((path, file_format))
+
+        self.batch_size = options['batch_size']
+        self.update_index = not options['skip_index']
+        self.images = ImageArchive(options['images']) if options['images'] else None
+        # Every category is held in memory, as there are only ever a few
+        self.category_ids = dict(Category.objects.values_list('name', 'id'))
+        self.known_category_ids = set(self.category_ids.values())
+        # Fixture category pks seen in this file, mapped to database ids
+        self.fixture_category_ids = {}
+        self.created = self.updated = self.skipped = self.images_saved = 0
+        self.prices_changed = False
+
+        start = time.perf_counter()
+        rows = 0
+        batch = []
+        try:
+            for path, file_format in files:
+                for record in iter_records(path, file_format):
+                    rows += 1
+                    values = self._product_values(record)
+                    if values is None:
+                        self.skipped += 1
+                        continue
+                    batch.append(values)
+                    if len(batch) >= self.batch_size:
+                        self._write_batch(batch)
+                        batch = []
+                        self._report(rows, start)
+            self._write_batch(batch)
+        finally:
+            if self.images:
+                self.images.close()
+
+        # Products are written without signals, so the facet cells are
+        # counted again once, and cached listings and counts refreshed
+        facets.rebuild_cells()
+        bump_catalog_version()
+        # Stored bag totals are only recalculated if a price may have changed
+        if self.prices_changed:
+            bump_price_version()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {rows} rows in {elapsed:.1f}s '
+            f'({rows / max(elapsed, 0.001):.0f} rows/s): '
+            f'{self.created} created, {self.updated} updated, '
+            f'{self.skipped} skipped, {self.images_saved} images saved'))
+
+    def _report(self, rows, start):
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{rows} rows ({rows / max(elapsed, 0.001):.0f} rows/s)')
+
+    def _category_id(self, value):
+        """
+        Resolve a category given by name, or by id as in the fixtures,
+        creating categories named in the file that don't exist yet
+        """
+        if value in (None, ''):
+            return None
+        if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            value = int(value)
+            if value in self.fixture_category_ids:
+                return self.fixture_category_ids[value]
+            return value if value in self.known_category_ids else None
+        if value not in self.category_ids:
+            category = Category.objects.create(
+                name=value, friendly_name=value.replace('_', ' ').title())
+            self.category_ids[value] = category.id
+            self.known_category_ids.add(category.id)
+        return self.category_ids[value]
+
+    def _product_values(self, record):
+        """
+        Turn a record into a dictionary of Product field values, or
+        None if it isn't a product. Django fixture entries are accepted
+        as well as plain objects.
+        """
+        if 'model' in record:
+            if record['model'] == 'products.category':
+                self._import_category(record)
+                return None
+            if record['model'] != 'products.product':
+                return None
+            record = record['fields']
+
+        values = {field: record[field] for field in PRODUCT_FIELDS if field in record}
+        # Products are matched on their sku, so rows need one
+        if values.get('sku') in (None, '') or values.get('name') == '':
+            return None
+        try:
+            if 'price' in values:
+                values['price'] = Money.parse(str(values['price']))
+            if 'rating' in values:
+                rating = values['rating']
+                values['rating'] = None if rating in ('', None) else Decimal(str(rating))
+        except (InvalidOperation, ValueError):
+            return None
+        if isinstance(values.get('has_sizes'), str):
+            values['has_sizes'] = values['has_sizes'].strip().lower() in ('1', 'true', 'yes')
+        for field in ('image_url', 'image'):
+            if values.get(field) == '':
+                values[field] = None
+        if 'category' in record:
+            values['category_id'] = self._category_id(record['category'])
+        return values
+
+    def _import_category(self, record):
+        """ Create or rename a category from a fixture entry """
+        fields = record['fields']
+        category, created = Category.objects.update_or_create(
+            name=fields['name'],
+            defaults={'friendly_name': fields.get('friendly_name')})
+        self.category_ids[category.name] = category.id
+        self.known_category_ids.add(category.id)
+        if 'pk' in record:
+            self.fixture_category_ids[record['pk']] = category.id
+
+    def _save_images(self, batch):
+        """ Copy images the batch refers to out of the archive """
+        for values in batch:
+            name = values.get('image')
+            if not name or default_storage.exists(name):
+                continue
+            content = self.images.read(name)
+            if content is not None:
+                default_storage.save(name, ContentFile(content))
+                self.images_saved += 1
+
+    def _write_batch(self, batch):
+        """
+        Create or update a batch of products in a single transaction,
+        with one query to find which skus already exist
+        """
+        if not batch:
+            return
+
+        # Later rows for the same sku replace earlier ones
+        by_sku = {values['sku']: values for values in batch}
+
+        if self.images:
+            self._save_images(by_sku.values())
+
+        now = timezone.now()
+        with transaction.atomic():
+            existing = dict(
+                Product.objects.filter(sku__in=by_sku.keys()).values_list('sku', 'id'))
+
+            # New products need at least a name and a price
+            to_create = [
+                Product(**values, updated_at=now)
+                for sku, values in by_sku.items()
+                if sku not in existing and 'name' in values and 'price' in values
+            ]
+            Product.objects.bulk_create(to_create, batch_size=self.batch_size)
+
+            # Rows are grouped by the fields they give, so a column
+            # missing from a row keeps its current value in the database
+            to_update = defaultdict(list)
+            for sku, values in by_sku.items():
+                if sku in existing:
+                    product = Product(id=existing[sku], **values, updated_at=now)
+                    fields = set(values) | {'updated_at'}
+                    if 'image' in values:
+                        # Derivatives of the old image no longer apply
+                        product.image_derivatives = {}
+                        fields.add('image_derivatives')
+                    to_update[frozenset(fields)].append(product)
+            for fields, products in to_update.items():
+                Product.objects.bulk_update(products, fields, batch_size=self.batch_size)
+                self.prices_changed |= 'price' in fields
+
+            if self.update_index:
+                search.index_products(
+                    Product.objects.filter(sku__in=by_sku.keys()).select_related('category'))
+
+        self.created += len(to_create)
+        self.updated += len(existing)
+        self.skipped += len(batch) - len(to_create) - len(existing)
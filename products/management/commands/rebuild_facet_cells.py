@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.facets import rebuild_cells
+
+
+class Command(BaseCommand):
+    help = 'Count the facet cells again from every product'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        counted = rebuild_cells()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Counted {counted} products into facet cells in {elapsed:.2f}s'))
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of products indexed per batch')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        indexed = rebuild_index(batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {indexed} products in {elapsed:.2f}s'))
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.23 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_auto_20231210_1624'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('length', models.PositiveIntegerField(default=0)),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='products.product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64, unique=True)),
+                ('document_frequency', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchPosting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frequency', models.PositiveIntegerField(default=0)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='products.searchdocument')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='products.searchterm')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchposting',
+            index=models.Index(fields=['term', '-frequency'], name='products_se_term_id_5ad97c_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchposting',
+            unique_together={('term', 'document')},
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+import boutique_ado.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_product_image_derivatives'),
+    ]
+
+    operations = boutique_ado.money.cents_migration(
+        'products.Product', 'price',
+        models.DecimalField(max_digits=6, decimal_places=2),
+        boutique_ado.money.MoneyField(),
+    )
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.23 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_price_in_cents'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price'], name='products_pr_price_9b1a5f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['rating'], name='products_pr_rating_c3ba71_idx'),
+        ),
+    ]
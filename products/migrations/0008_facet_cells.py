@@ -0,0 +1,39 @@
+# Generated by Django 3.2.23 on 2026-10-18 14:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_cells(apps, schema_editor):
+    """ Count the products already in the catalog into their cells """
+    from products.facets import write_cells
+
+    Category = apps.get_model('products', 'Category')
+    FacetCell = apps.get_model('products', 'FacetCell')
+    Product = apps.get_model('products', 'Product')
+    write_cells(FacetCell, Category.objects.values_list('id', flat=True), Product.objects.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_price_rating_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price_bucket', models.PositiveSmallIntegerField()),
+                ('rating_floor', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('has_sizes', models.BooleanField()),
+                ('products', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='facet_cells', to='products.category')),
+            ],
+            options={
+                'unique_together': {('category', 'price_bucket', 'rating_floor', 'has_sizes')},
+            },
+        ),
+        migrations.RunPython(count_cells, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
 
+from boutique_ado.money import MoneyField
+
 
 class Category(models.Model):
 
@@ -17,15 +19,95 @@ class Category(models.Model):
 
 
 class Product(models.Model):
+
+    class Meta:
+        # Range filters and the facet counts for them use these
+        indexes = [
+            models.Index(fields=['price']),
+            models.Index(fields=['rating']),
+        ]
+
     category = models.ForeignKey('Category', null=True, blank=True, on_delete=models.SET_NULL)
     sku = models.CharField(max_length=254, null=True, blank=True)
     name = models.CharField(max_length=254)
     description = models.TextField()
     has_sizes = models.BooleanField(default=False, null=True, blank=True)
-    price = models.DecimalField(max_digits=6, decimal_places=2)
+    # Held in cents, see boutique_ado.money
+    price = MoneyField()
     rating = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
     image_url = models.URLField(max_length=1024, null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    # Resized copies of the image, built by products.images
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    # Changes on every save, and is used to version cached product cards
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class FacetCell(models.Model):
+    """
+    The number of products in one cell of (category, price bucket,
+    rating floor, has_sizes). Every category has a row for each cell
+    from when it's created, and the product signals move products
+    between them as they change, so facet counts are added up from
+    these rows instead of being counted from the products.
+    """
+
+    class Meta:
+        unique_together = ('category', 'price_bucket', 'rating_floor', 'has_sizes')
+
+    # Products without a category are counted in cells without one
+    category = models.ForeignKey('Category', null=True, blank=True, on_delete=models.CASCADE,
+                                 related_name='facet_cells')
+    # Index into products.facets.PRICE_BUCKETS
+    price_bucket = models.PositiveSmallIntegerField()
+    # The highest of 0 and facets.RATING_BUCKETS the rating reaches,
+    # or null for products without a rating
+    rating_floor = models.PositiveSmallIntegerField(null=True, blank=True)
+    has_sizes = models.BooleanField()
+    products = models.IntegerField(default=0)
+
+
+class SearchDocument(models.Model):
+    """
+    One entry per indexed product, holding the weighted
+    token count used for BM25 length normalisation
+    """
+    product = models.OneToOneField('Product', on_delete=models.CASCADE, related_name='search_document')
+    length = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'Search document for {self.product}'
+
+
+class SearchTerm(models.Model):
+    """
+    A stemmed term in the inverted index along with the
+    number of documents it appears in
+    """
+    term = models.CharField(max_length=64, unique=True)
+    document_frequency = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.term
+
+
+class SearchPosting(models.Model):
+    """
+    Links a term to a document it appears in, storing the
+    weighted frequency of the term within that document
+    """
+
+    class Meta:
+        unique_together = ('term', 'document')
+        # Lets a search read a term's strongest postings first
+        indexes = [models.Index(fields=['term', '-frequency'])]
+
+    term = models.ForeignKey('SearchTerm', on_delete=models.CASCADE, related_name='postings')
+    document = models.ForeignKey('SearchDocument', on_delete=models.CASCADE, related_name='postings')
+    frequency = models.PositiveIntegerField(default=0)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return f'{self.term} in {self.document}'
@@ -0,0 +1,234 @@
+import base64
+import binascii
+import hashlib
+import json
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import F, Q
+
+from boutique_ado.money import Money
+
+from .catalog import catalog_version
+
+PAGE_SIZE = 24
+
+# Fields the product listing can be sorted by. Each page is fetched
+# with a keyset predicate on the sort field plus the product id as a
+# tiebreaker, so later pages cost the same as the first.
+SORT_KEYS = ('price', 'rating', 'lower_name', 'category__name')
+
+# Cached product counts are also dropped whenever the catalog changes
+COUNT_CACHE_TIMEOUT = 60 * 60
+
+
+class Page:
+    """ A single page of results along with cursors for its neighbours """
+
+    def __init__(self, items, next_cursor=None, previous_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(value, pk):
+    """ Encode a sort value and product id into a url safe cursor """
+    if isinstance(value, (Decimal, Money)):
+        value = str(value)
+    data = json.dumps([value, pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor back into its sort value and product id.
+    Returns None if the cursor has been tampered with.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if not isinstance(pk, int):
+        return None
+    return value, pk
+
+
+def _ordering(sortkey, descending):
+    """
+    Ordering for a page. Nulls always sort last so the keyset
+    predicates below behave the same on SQLite and PostgreSQL.
+    """
+    if descending:
+        return [F(sortkey).desc(nulls_last=True), '-id']
+    return [F(sortkey).asc(nulls_last=True), 'id']
+
+
+def _reversed_ordering(sortkey, descending):
+    """ The exact reverse of _ordering, used to step backwards """
+    if descending:
+        return [F(sortkey).asc(nulls_first=True), 'id']
+    return [F(sortkey).desc(nulls_first=True), '-id']
+
+
+def _after(sortkey, descending, value, pk):
+    """ Rows that come after the cursor in the page ordering """
+    lookup = 'lt' if descending else 'gt'
+    if value is None:
+        # Nulls are last, so only other nulls with a later id follow
+        return Q(**{f'{sortkey}__isnull': True, f'id__{lookup}': pk})
+    return (
+        Q(**{f'{sortkey}__{lookup}': value})
+        | Q(**{sortkey: value, f'id__{lookup}': pk})
+        | Q(**{f'{sortkey}__isnull': True})
+    )
+
+
+def _before(sortkey, descending, value, pk):
+    """ Rows that come before the cursor in the page ordering """
+    lookup = 'gt' if descending else 'lt'
+    if value is None:
+        return (
+            Q(**{f'{sortkey}__isnull': True, f'id__{lookup}': pk})
+            | Q(**{f'{sortkey}__isnull': False})
+        )
+    return (
+        Q(**{f'{sortkey}__{lookup}': value})
+        | Q(**{sortkey: value, f'id__{lookup}': pk})
+    )
+
+
+def keyset_queryset(queryset, sortkey=None, descending=False, after=None, before=None):
+    """
+    Order the queryset by sortkey (or just by id when no sort key is
+    given) and filter it to the rows after or before the given cursor.
+    Returns the queryset, the decoded cursor and whether the rows run
+    backwards from the before cursor and need reversing.
+    """
+    if sortkey is None:
+        # Sorting by id alone is handled as a sort on a non-null
+        # field, where the id tiebreaker never comes into play
+        sortkey = 'id'
+
+    cursor = decode_cursor(before or after or '')
+    backwards = bool(before) and cursor is not None
+
+    if backwards:
+        queryset = queryset.filter(_before(sortkey, descending, *cursor))
+        queryset = queryset.order_by(*_reversed_ordering(sortkey, descending))
+    else:
+        if cursor is not None:
+            queryset = queryset.filter(_after(sortkey, descending, *cursor))
+        queryset = queryset.order_by(*_ordering(sortkey, descending))
+    return queryset, cursor, backwards
+
+
+def _row_id(row):
+    """ Rows are model instances, or dicts when read with values() """
+    return row['id'] if isinstance(row, dict) else row.id
+
+
+def _set_rank(row, rank):
+    if isinstance(row, dict):
+        row['search_rank'] = rank
+    else:
+        row.search_rank = rank
+
+
+def ranked_rows(queryset, ranked_ids, after=None, before=None, limit=PAGE_SIZE + 1):
+    """
+    Read up to limit rows of the queryset in the order of ranked_ids,
+    starting after or ending before the given cursor, whose value is a
+    position in ranked_ids. Ids are looked up a window at a time,
+    growing while the queryset's filters leave too few rows, so a page
+    far into a long list of results costs much the same as the first.
+    Each row gets its position as search_rank. Returns the rows, the
+    decoded cursor and whether they run backwards from the before
+    cursor, like keyset_queryset.
+    """
+    cursor = decode_cursor(before or after or '')
+    backwards = bool(before) and cursor is not None
+    position = cursor[0] if cursor is not None and isinstance(cursor[0], int) else None
+
+    if backwards:
+        positions = range(min(position, len(ranked_ids)) - 1, -1, -1) if position else range(0)
+    else:
+        positions = range(position + 1 if position is not None else 0, len(ranked_ids))
+
+    rows = []
+    start, window = 0, limit * 2
+    while start < len(positions) and len(rows) < limit:
+        ranks = {ranked_ids[index]: index for index in positions[start:start + window]}
+        found = list(queryset.filter(id__in=ranks))
+        for row in found:
+            _set_rank(row, ranks[_row_id(row)])
+        found.sort(key=lambda row: ranks[_row_id(row)], reverse=backwards)
+        rows.extend(found)
+        start += window
+        window *= 2
+    return rows[:limit], cursor, backwards
+
+
+def keyset_page(queryset, sortkey=None, descending=False, after=None,
+                before=None, page_size=PAGE_SIZE, ranked_ids=None):
+    """
+    Return a Page of the queryset ordered by sortkey (or just by id
+    when no sort key is given), starting after or ending before the
+    given cursor. Given ranked_ids, such as search results, the page
+    follows their order instead.
+    """
+    # One extra row is fetched to find out if there is another page
+    if ranked_ids is not None:
+        sortkey = 'search_rank'
+        items, cursor, backwards = ranked_rows(
+            queryset, ranked_ids, after, before, page_size + 1)
+    else:
+        sortkey = sortkey or 'id'
+        queryset, cursor, backwards = keyset_queryset(
+            queryset, sortkey, descending, after, before)
+        items = list(queryset[:page_size + 1])
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    if backwards:
+        items.reverse()
+
+    def cursor_for(product):
+        return encode_cursor(getattr_path(product, sortkey), product.id)
+
+    next_cursor = previous_cursor = None
+    if items:
+        if has_more or backwards:
+            next_cursor = cursor_for(items[-1])
+        if (has_more and backwards) or (cursor is not None and not backwards):
+            previous_cursor = cursor_for(items[0])
+
+    return Page(items, next_cursor, previous_cursor)
+
+
+def getattr_path(obj, path):
+    """ Follow a double underscore path such as category__name """
+    for attr in path.split('__'):
+        if obj is None:
+            return None
+        obj = getattr(obj, attr)
+    return obj
+
+
+def cached_count(queryset, *key_parts):
+    """
+    Count the queryset, caching the result until the catalog changes.
+    key_parts should identify the filters applied to the queryset.
+    """
+    key_source = json.dumps([catalog_version(), *key_parts], default=str)
+    key = 'products:count:' + hashlib.md5(key_source.encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.order_by().count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
@@ -0,0 +1,332 @@
+import hashlib
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Count, F
+
+from .catalog import bump_catalog_version, catalog_version
+from .models import Product, SearchDocument, SearchTerm, SearchPosting
+
+# Each field's tokens are counted this many times, so a match in
+# the product name outranks the same match in the description.
+FIELD_WEIGHTS = {
+    'name': 3,
+    'sku': 2,
+    'category': 2,
+    'description': 1,
+}
+
+# Standard BM25 tuning parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Once this few documents are left as candidates, postings for the
+# remaining search terms are only read for those documents
+CANDIDATE_FILTER_LIMIT = 500
+
+STATS_CACHE_KEY = 'products:search:stats'
+
+# Ranked results are cached until the catalog changes, so paging
+# through them doesn't score every match again for each page
+RESULTS_CACHE_TIMEOUT = 60 * 10
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for',
+    'from', 'in', 'into', 'is', 'it', 'its', 'of', 'on', 'or', 'our',
+    'so', 'that', 'the', 'their', 'this', 'to', 'too', 'was', 'with',
+    'you', 'your',
+))
+
+VOWELS = frozenset('aeiouy')
+
+
+def stem(word):
+    """
+    Reduce a word to a crude stem by stripping plural and
+    verb endings, so 'jeans' matches 'jean' and 'fitted' matches 'fit'
+    """
+    if len(word) <= 3 or word.isdigit():
+        return word
+
+    # Plurals
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies'):
+        word = word[:-3] + 'y'
+    elif word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        word = word[:-1]
+
+    # Verb and adverb endings, only stripped when a
+    # reasonable stem containing a vowel is left over
+    for suffix in ('ingly', 'edly', 'ing', 'ed', 'ly'):
+        base = word[:-len(suffix)]
+        if word.endswith(suffix) and len(base) >= 3 and VOWELS & set(base):
+            word = base
+            # Undo doubled consonants, e.g. 'running' -> 'runn' -> 'run'
+            if word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            break
+
+    return word
+
+
+def tokenize(text):
+    """ Split text into a list of lowercase, stemmed search terms """
+    if not text:
+        return []
+    return [
+        stem(token)[:64] for token in TOKEN_RE.findall(text.lower())
+        if token not in STOP_WORDS
+    ]
+
+
+def document_terms(product):
+    """
+    Build a Counter of weighted term frequencies for a product
+    """
+    fields = {
+        'name': product.name,
+        'sku': product.sku,
+        'description': product.description,
+        'category': '',
+    }
+    if product.category_id:
+        category = product.category
+        fields['category'] = f'{category.name} {category.friendly_name or ""}'
+
+    terms = Counter()
+    for field, text in fields.items():
+        for token in tokenize(text):
+            terms[token] += FIELD_WEIGHTS[field]
+    return terms
+
+
+def _invalidate_stats():
+    """ Drop cached corpus statistics once the index changes are committed """
+    transaction.on_commit(lambda: cache.delete(STATS_CACHE_KEY))
+
+
+def _ensure_terms(terms):
+    """
+    Create any missing terms and return a dictionary
+    mapping each term to its id
+    """
+    SearchTerm.objects.bulk_create(
+        [SearchTerm(term=term) for term in terms], ignore_conflicts=True)
+    return dict(SearchTerm.objects.filter(term__in=terms).values_list('term', 'id'))
+
+
+def _adjust_document_frequencies(counts, sign):
+    """
+    Add or subtract per-term document counts. Terms are grouped by
+    the amount they change by so a batch needs only a few updates.
+    """
+    by_amount = defaultdict(list)
+    for term_id, amount in counts.items():
+        by_amount[amount].append(term_id)
+    for amount, term_ids in by_amount.items():
+        SearchTerm.objects.filter(id__in=term_ids).update(
+            document_frequency=F('document_frequency') + sign * amount)
+
+
+def remove_products(product_ids):
+    """ Remove the given products from the search index """
+    product_ids = list(product_ids)
+    with transaction.atomic():
+        counts = dict(
+            SearchPosting.objects.filter(document__product_id__in=product_ids)
+            .values('term_id').annotate(n=Count('id')).values_list('term_id', 'n'))
+        _adjust_document_frequencies(counts, -1)
+        # Postings are removed along with their documents by cascade
+        SearchDocument.objects.filter(product_id__in=product_ids).delete()
+        _invalidate_stats()
+
+
+def index_products(products):
+    """
+    Add or refresh a batch of products in the search index.
+    Used for single product updates as well as full rebuilds.
+    """
+    products = list(products)
+    if not products:
+        return
+
+    doc_terms = {product.id: document_terms(product) for product in products}
+
+    with transaction.atomic():
+        remove_products(doc_terms.keys())
+
+        SearchDocument.objects.bulk_create([
+            SearchDocument(product_id=product_id, length=sum(terms.values()))
+            for product_id, terms in doc_terms.items()
+        ])
+        # bulk_create doesn't return ids on every database backend,
+        # so the new documents are looked up again by product
+        document_ids = dict(
+            SearchDocument.objects.filter(product_id__in=doc_terms.keys())
+            .values_list('product_id', 'id'))
+
+        term_ids = _ensure_terms(set().union(*doc_terms.values()))
+        SearchPosting.objects.bulk_create([
+            SearchPosting(
+                term_id=term_ids[term],
+                document_id=document_ids[product_id],
+                frequency=frequency,
+            )
+            for product_id, terms in doc_terms.items()
+            for term, frequency in terms.items()
+        ], batch_size=1000)
+
+        new_counts = Counter()
+        for terms in doc_terms.values():
+            new_counts.update(term_ids[term] for term in terms)
+        _adjust_document_frequencies(new_counts, 1)
+        _invalidate_stats()
+
+
+def index_product(product):
+    """ Add or refresh a single product in the search index """
+    index_products([product])
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Clear the search index and rebuild it from every product.
+    Returns the number of products indexed.
+    """
+    with transaction.atomic():
+        SearchPosting.objects.all().delete()
+        SearchDocument.objects.all().delete()
+        SearchTerm.objects.all().delete()
+
+        indexed = 0
+        batch = []
+        products = Product.objects.select_related('category').order_by('id')
+        for product in products.iterator(chunk_size=batch_size):
+            batch.append(product)
+            if len(batch) >= batch_size:
+                index_products(batch)
+                indexed += len(batch)
+                batch = []
+        index_products(batch)
+        indexed += len(batch)
+
+        # Terms no longer used by any product are dropped
+        SearchTerm.objects.filter(document_frequency=0).delete()
+    # Cached results were ranked with the old index
+    bump_catalog_version()
+    return indexed
+
+
+def corpus_stats():
+    """
+    Return the number of indexed documents and their average length
+    """
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        aggregate = SearchDocument.objects.aggregate(count=Count('id'), avg_length=Avg('length'))
+        stats = (aggregate['count'], float(aggregate['avg_length'] or 0))
+        cache.set(STATS_CACHE_KEY, stats)
+    return stats
+
+
+def is_index_empty():
+    """ True until the index has been built for at least one product """
+    return corpus_stats()[0] == 0
+
+
+def _query_terms(query):
+    """
+    Return a dict of term id to document frequency for the terms in
+    query, or None if it has no terms or a term no product has. Like
+    the original search, a product has to match all of the search
+    words, so there are no results if any word is missing.
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return None
+    term_frequencies = dict(
+        SearchTerm.objects.filter(term__in=terms, document_frequency__gt=0)
+        .values_list('id', 'document_frequency'))
+    if len(term_frequencies) < len(terms):
+        return None
+    return term_frequencies
+
+
+def matching_products(query):
+    """
+    Return a queryset of the ids of every product matching all the
+    terms in query, for filtering, counting and facets in the database
+    however many products match
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return Product.objects.none().values('id')
+    # Terms are joined on by name, so this is a single subquery
+    products = Product.objects.all()
+    for term in terms:
+        products = products.filter(search_document__postings__term__term=term)
+    return products.values('id')
+
+
+def search(query, limit=None):
+    """
+    Return a list of (product_id, score) tuples for products matching
+    every term in the query, best match first. Every match is scored,
+    and limit, if given, keeps only the best of them.
+    """
+    document_count, avg_length = corpus_stats()
+    term_frequencies = _query_terms(query) if document_count else None
+    if term_frequencies is None:
+        return []
+
+    scores = None
+    # Rarest terms are fetched first so the candidate documents
+    # can narrow down the postings read for the more common terms
+    for term_id, doc_freq in sorted(term_frequencies.items(), key=lambda item: item[1]):
+        postings = SearchPosting.objects.filter(term_id=term_id)
+        if scores is not None and len(scores) <= CANDIDATE_FILTER_LIMIT:
+            postings = postings.filter(document_id__in=scores.keys())
+
+        idf = math.log(1 + (document_count - doc_freq + 0.5) / (doc_freq + 0.5))
+        term_scores = {}
+        for document_id, product_id, length, frequency in postings.values_list(
+                'document_id', 'document__product_id', 'document__length', 'frequency').iterator():
+            if scores is not None and document_id not in scores:
+                continue
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+            previous = scores[document_id][1] if scores is not None else 0
+            term_scores[document_id] = (
+                product_id, previous + idf * frequency * (BM25_K1 + 1) / (frequency + norm))
+        scores = term_scores
+        if not scores:
+            return []
+
+    def rank(result):
+        return result[1], -result[0]
+
+    if limit is not None:
+        return heapq.nlargest(limit, scores.values(), key=rank)
+    return sorted(scores.values(), key=rank, reverse=True)
+
+
+def ranked_ids(query):
+    """
+    Return the ids of every product matching query, best match first.
+    They're cached until the catalog changes, which it does whenever
+    a product is indexed, so each page of the results reuses them.
+    """
+    terms = ' '.join(sorted(set(tokenize(query))))
+    key_source = f'{catalog_version()}:{terms}'
+    key = 'products:search:results:' + hashlib.md5(key_source.encode()).hexdigest()
+    product_ids = cache.get(key)
+    if product_ids is None:
+        product_ids = [product_id for product_id, score in search(query)]
+        cache.set(key, product_ids, RESULTS_CACHE_TIMEOUT)
+    return product_ids
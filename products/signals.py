@@ -0,0 +1,181 @@
+from django.db.models.signals import post_init, pre_save, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Product, Category
+from . import facets, search
+from .catalog import bump_catalog_version, bump_price_version
+
+# Raw saves come from loaddata, where related rows may not exist
+# yet. The index is rebuilt with the rebuild_search_index command.
+
+@receiver(pre_save, sender=Product)
+def set_updated_at_on_raw_save(sender, instance, raw, **kwargs):
+    """
+    Give products loaded from fixtures, which don't have an updated_at
+    and skip auto_now, the time they were loaded
+    """
+    if raw and instance.updated_at is None:
+        instance.updated_at = timezone.now()
+
+
+@receiver(post_save, sender=Product)
+def index_on_save(sender, instance, raw, **kwargs):
+    """
+    Add or refresh the product in the search index
+    """
+    if not raw:
+        search.index_product(instance)
+
+# pre_delete is used so the document frequencies of the product's
+# terms can be reduced before the postings are deleted by cascade
+@receiver(pre_delete, sender=Product)
+def unindex_on_delete(sender, instance, **kwargs):
+    """
+    Remove the product from the search index
+    """
+    search.remove_products([instance.id])
+
+
+@receiver(post_save, sender=Category)
+def reindex_on_category_save(sender, instance, created, raw, **kwargs):
+    """
+    Refresh every product in a category when it is renamed
+    """
+    if not created and not raw:
+        search.index_products(instance.product_set.select_related('category'))
+
+
+@receiver(post_save, sender=Product)
+def refresh_on_product_save(sender, instance, **kwargs):
+    """
+    Move the catalog on to a new version so cached product
+    counts, facet counts and listings are refreshed
+    """
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Product)
+def refresh_on_product_delete(sender, instance, **kwargs):
+    """
+    Move the catalog on to a new version, so the product
+    drops out of cached counts and listings
+    """
+    bump_catalog_version()
+
+
+@receiver(post_init, sender=Product)
+def remember_price(sender, instance, **kwargs):
+    """
+    Keep the price a product was loaded with, so a save can tell
+    whether it changed. A deferred price is left unread.
+    """
+    instance._loaded_price = instance.__dict__.get('price')
+
+
+@receiver(post_save, sender=Product)
+def refresh_prices_on_save(sender, instance, created, update_fields, **kwargs):
+    """
+    Move prices on to a new version when a product's price changes,
+    so bag totals stored with the old version are recalculated. New
+    products aren't in any bag yet.
+    """
+    if created or (update_fields is not None and 'price' not in update_fields):
+        return
+    price = instance.__dict__.get('price')
+    if price is None or price != instance._loaded_price:
+        bump_price_version()
+    instance._loaded_price = price
+
+
+@receiver(post_delete, sender=Product)
+def refresh_prices_on_delete(sender, instance, **kwargs):
+    """
+    Move prices on to a new version, as the product's lines
+    are removed from every bag holding it
+    """
+    bump_price_version()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_on_category_change(sender, **kwargs):
+    """
+    Move the catalog on to a new version. Category names are part of
+    the facet counts, so the cells are read again with the new name.
+    """
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Category)
+def touch_products_on_category_save(sender, instance, created, raw, **kwargs):
+    """
+    Mark a renamed category's products as updated, so their cached
+    product cards pick up the new category name
+    """
+    if not created and not raw:
+        instance.product_set.update(updated_at=timezone.now())
+
+# Products are moved out of a deleted category with a plain
+# update, so they are marked as updated before that happens
+@receiver(pre_delete, sender=Category)
+def touch_products_on_category_delete(sender, instance, **kwargs):
+    """
+    Mark a deleted category's products as updated, so their
+    cached product cards drop the category
+    """
+    instance.product_set.update(updated_at=timezone.now())
+
+
+# Facet counts are kept in FacetCell, which each product change moves
+# on by one. Changes made without signals, such as bulk_create and
+# update(), are counted again with the rebuild_facet_cells command.
+
+def _stored_cell(product_id):
+    """ The facet cell of a product as it is in the database, or None """
+    row = Product.objects.filter(pk=product_id).values_list(
+        'category_id', 'price', 'rating', 'has_sizes').first()
+    return facets.product_cell(*row) if row is not None else None
+
+
+@receiver(pre_save, sender=Product)
+def remember_facet_cell(sender, instance, **kwargs):
+    """
+    Read the cell the product is counted in before it's saved,
+    from the database, as the instance may have been changed
+    """
+    instance._stored_facet_cell = _stored_cell(instance.pk) if instance.pk else None
+
+
+@receiver(post_save, sender=Product)
+def move_facet_cell_on_save(sender, instance, **kwargs):
+    """ Move the product's count to the cell it's now in """
+    # Values given to a new instance haven't been converted yet
+    price, rating = (
+        Product._meta.get_field(name).to_python(getattr(instance, name))
+        for name in ('price', 'rating'))
+    facets.move_product(
+        instance._stored_facet_cell,
+        facets.product_cell(instance.category_id, price, rating, instance.has_sizes))
+
+
+@receiver(pre_delete, sender=Product)
+def remove_facet_cell_on_delete(sender, instance, **kwargs):
+    """ Take the product out of the cell it's counted in """
+    facets.move_product(_stored_cell(instance.pk), None)
+
+
+@receiver(post_save, sender=Category)
+def add_facet_cells(sender, instance, created, **kwargs):
+    """ Give a new category a row for each of its cells """
+    if created:
+        facets.add_category_cells(instance.id)
+
+
+@receiver(pre_delete, sender=Category)
+def move_facet_cells_on_category_delete(sender, instance, **kwargs):
+    """
+    Count a deleted category's products in the cells without a
+    category, as its products are moved out of it with a plain update
+    """
+    facets.move_category_cells(instance.id)
@@ -0,0 +1,61 @@
+from django import template
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+from products.images import DERIVATIVE_FORMATS
+
+register = template.Library()
+
+# How wide the image is shown for each layout, which lets the
+# browser pick the smallest derivative that is still sharp
+LAYOUT_SIZES = {
+    'thumb': '150px',
+    'card': '(min-width: 1200px) 25vw, (min-width: 992px) 33vw, (min-width: 576px) 50vw, 100vw',
+    'detail': '(min-width: 768px) 50vw, 100vw',
+}
+
+MIME_TYPES = {
+    'webp': 'image/webp',
+    'jpg': 'image/jpeg',
+}
+
+
+def _srcset(derivatives, extension):
+    """ Build a srcset listing every width of one derivative format """
+    widths = {
+        derivative['width']: derivative[extension]
+        for derivative in derivatives.values()
+    }
+    return ', '.join(
+        f'{default_storage.url(name)} {width}w' for width, name in sorted(widths.items()))
+
+
+# Creates template tag rendering a responsive product image
+@register.simple_tag
+def product_picture(product, layout, css_class=''):
+    """
+    Render a product's image as a <picture> with WebP and JPEG srcsets,
+    falling back to the original upload until its derivatives are built
+    """
+    if not product.image:
+        return format_html(
+            '<img class="{}" src="{}noimage.png" alt="{}">',
+            css_class, settings.MEDIA_URL, product.name)
+
+    derivatives = product.image_derivatives
+    if not derivatives:
+        return format_html(
+            '<img class="{}" src="{}" alt="{}">',
+            css_class, product.image.url, product.name)
+
+    sizes = LAYOUT_SIZES[layout]
+    sources = format_html(''.join(
+        format_html(
+            '<source type="{}" srcset="{}" sizes="{}">',
+            MIME_TYPES[extension], _srcset(derivatives, extension), sizes)
+        for extension in DERIVATIVE_FORMATS if extension != 'jpg'))
+    return format_html(
+        '<picture>{}<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy"></picture>',
+        sources, css_class, default_storage.url(derivatives[layout]['jpg']),
+        _srcset(derivatives, 'jpg'), sizes, product.name)
@@ -1,3 +1,291 @@
-from django.test import TestCase
+import json
+import random
+from collections import Counter
+from unittest import mock
+from decimal import Decimal
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from boutique_ado.testing import QueryBudgetMixin
+from . import facets, search
+from .models import Category, Product
+
+
+def make_catalog(categories=3, products_per_category=10):
+    """ Create categories each with a number of products """
+    products = []
+    for number in range(categories):
+        category = Category.objects.create(
+            name=f'category_{number}', friendly_name=f'Category {number}')
+        for index in range(products_per_category):
+            products.append(Product.objects.create(
+                category=category,
+                sku=f'sku{number}{index}',
+                name=f'Product {number} {index}',
+                description='A product for testing',
+                has_sizes=index % 2 == 0,
+                price=f'{index + 1}.99',
+                rating=index % 5,
+            ))
+    return products
+
+
+class ProductViewQueryTests(QueryBudgetMixin, TestCase):
+    """ The product pages stay within their budgets in QUERY_BUDGETS """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_catalog()
+
+    def setUp(self):
+        # Cards rendered by an earlier test would hide their queries
+        caches['fragments'].clear()
+
+    def test_all_products(self):
+        response = self.assertWithinQueryBudget('/products/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_all_products_filtered_and_sorted(self):
+        response = self.assertWithinQueryBudget(
+            '/products/?category=category_0,category_1&sort=price&direction=desc')
+        self.assertEqual(response.status_code, 200)
+
+    def test_all_products_search(self):
+        response = self.assertWithinQueryBudget('/products/?q=product')
+        self.assertEqual(response.status_code, 200)
+
+    def test_product_detail(self):
+        product = self.products[0]
+        response = self.assertWithinQueryBudget(f'/products/{product.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, product.name)
+
+
+def reference_counts(products, filters, categories=None, product_ids=None):
+    """ Facet counts worked out product by product """
+    counts = Counter()
+    for product in products:
+        if product_ids is not None and product.id not in product_ids:
+            continue
+        category_name = product.category.name if product.category else None
+        price, rating = product.price.to_decimal(), product.rating
+        category_ok = categories is None or category_name in categories
+        price_ok = ((filters['min_price'] is None or price >= filters['min_price'])
+                    and (filters['max_price'] is None or price <= filters['max_price']))
+        rating_ok = (filters['min_rating'] is None and filters['max_rating'] is None) or (
+            rating is not None
+            and (filters['min_rating'] is None or rating >= filters['min_rating'])
+            and (filters['max_rating'] is None or rating <= filters['max_rating']))
+        sizes_ok = product.has_sizes or not filters['has_sizes']
+
+        if price_ok and rating_ok and sizes_ok and category_name is not None:
+            counts['category', category_name] += 1
+        if category_ok and rating_ok and sizes_ok:
+            counts['price', facets.price_bucket(price)] += 1
+        if category_ok and price_ok and sizes_ok and rating is not None:
+            for minimum in facets.RATING_BUCKETS:
+                if rating >= minimum:
+                    counts['rating', minimum] += 1
+        if category_ok and price_ok and rating_ok and product.has_sizes:
+            counts['has_sizes'] += 1
+    return counts
+
+
+class FacetCountTests(TestCase):
+    """
+    Facet counts added up from cells, and counted in the database,
+    match counting every product
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(4)
+        categories = [Category.objects.create(name=f'category_{number}') for number in range(3)]
+        for index in range(120):
+            Product.objects.create(
+                category=rng.choice(categories + [None]),
+                name=f'Product {index}',
+                description='A product for testing',
+                has_sizes=rng.random() < 0.4,
+                # Often right on a bucket's edge
+                price=rng.choice(['0.99', '24.99', '25.00', '49.99', '50.00', '99.99',
+                                  '100.00', f'{rng.randint(1, 15000) / 100:.2f}']),
+                rating=rng.choice([None, Decimal('1'), Decimal('3.99'), Decimal('4'),
+                                   Decimal(rng.randint(0, 500)) / 100]),
+            )
+
+    def setUp(self):
+        self.products = list(Product.objects.select_related('category'))
+
+    def assertCounts(self, params, categories=None, product_ids=None):
+        filters = facets.parse_filters(params)
+        self.assertEqual(
+            +facets.facet_counts(filters, categories, product_ids, query=str(product_ids)),
+            +reference_counts(self.products, filters, categories, product_ids),
+            params)
+
+    def test_bucket_aligned_filters(self):
+        self.assertIsNotNone(facets._aligned_buckets(facets.parse_filters({'min_price': '25'})))
+        for params in ({}, {'min_price': '25', 'max_price': '49.99'}, {'max_price': '24.99'},
+                       {'min_price': '100'}, {'min_rating': '4'}, {'min_rating': '1'},
+                       {'has_sizes': '1', 'min_price': '50', 'min_rating': '3'}):
+            self.assertCounts(params)
+            self.assertCounts(params, categories=['category_0', 'category_2'])
+
+    def test_uneven_ranges(self):
+        self.assertIsNone(facets._aligned_buckets(facets.parse_filters({'min_price': '30'})))
+        for params in ({'min_price': '30'}, {'max_price': '60.50'}, {'min_rating': '3.5'},
+                       {'max_rating': '4'}, {'min_price': '10', 'max_rating': '2', 'has_sizes': '1'}):
+            self.assertCounts(params)
+            self.assertCounts(params, categories=['category_1'])
+
+    def test_search_results(self):
+        product_ids = {product.id for product in self.products[::3]}
+        self.assertCounts({}, product_ids=product_ids)
+        self.assertCounts({'min_price': '25', 'max_price': '49.99'}, product_ids=product_ids)
+
+    def test_counts_follow_changes(self):
+        self.assertCounts({'min_rating': '4'})
+        product = self.products[0]
+        product.rating = Decimal('4.5')
+        product.price = '120.00'
+        product.save()
+        Product.objects.filter(id=self.products[1].id).delete()
+        self.products = list(Product.objects.select_related('category'))
+        self.assertCounts({'min_rating': '4'})
+        self.assertCounts({'min_price': '100'})
+
+    def test_cells_follow_changes(self):
+        # Catalog wide counts come from the cells, never from products
+        with mock.patch.object(facets, '_cells', side_effect=AssertionError('counted products')):
+            product = self.products[0]
+            product.category = Category.objects.get(name='category_2')
+            product.has_sizes = not product.has_sizes
+            product.rating = None
+            product.save()
+            Product.objects.create(name='New', description='', price='60.00', rating='2.5')
+            Category.objects.get(name='category_1').delete()
+            new_category = Category.objects.create(name='category_3')
+            Product.objects.create(category=new_category, name='Other', description='', price='5.00')
+
+            self.products = list(Product.objects.select_related('category'))
+            for params in ({}, {'min_rating': '2'}, {'has_sizes': '1', 'min_price': '50'}):
+                self.assertCounts(params)
+                self.assertCounts(params, categories=['category_2', 'category_3'])
+
+    def test_rebuild(self):
+        cells = sorted(facets.facet_cells(), key=repr)
+        # Changes made without signals are only counted by a rebuild
+        Product.objects.update(has_sizes=True)
+        self.assertEqual(facets.rebuild_cells(), len(self.products))
+        self.products = list(Product.objects.select_related('category'))
+        self.assertCounts({'has_sizes': '1'})
+        self.assertNotEqual(sorted(facets.facet_cells(), key=repr), cells)
+
+
+class SearchPagingTests(TestCase):
+    """
+    Searches list and count every match, paged in order of relevance,
+    however many more there are than fit on a page
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='spares', friendly_name='Spares')
+        # More than the 500 results searches used to be cut off at,
+        # each mentioning widget a different number of times so they
+        # rank in a known order
+        Product.objects.bulk_create([
+            Product(category=category, sku=f'w{index}', name=f'Widget {index}',
+                    description=' '.join(['widget'] * (index % 7) + ['spare part']),
+                    price='9.99')
+            for index in range(620)
+        ])
+        Product.objects.create(category=category, sku='other', name='Other', price='1.00')
+        search.rebuild_index()
+
+    def setUp(self):
+        self.ranked = search.ranked_ids('widgets')
+
+    def test_every_match_is_ranked(self):
+        self.assertEqual(len(self.ranked), 620)
+        self.assertEqual(self.ranked, [product_id for product_id, score in search.search('widget')])
+        self.assertEqual(set(self.ranked), set(search.matching_products('widget').values_list('id', flat=True)))
+
+    def test_products_page(self):
+        url = reverse('products')
+        response = self.client.get(url, {'q': 'widget'})
+        self.assertEqual(response.context['total_products'], 620)
+
+        seen = []
+        pages = []
+        while True:
+            page = response.context['products']
+            pages.append([product.id for product in page])
+            seen.extend(pages[-1])
+            if page.next_cursor is None:
+                break
+            response = self.client.get(url, {'q': 'widget', 'after': page.next_cursor})
+        self.assertEqual(seen, self.ranked)
+
+        # And back again from the last page
+        page = response.context['products']
+        for expected in reversed(pages[:-1]):
+            response = self.client.get(url, {'q': 'widget', 'before': page.previous_cursor})
+            page = response.context['products']
+            self.assertEqual([product.id for product in page], expected)
+        self.assertIsNone(page.previous_cursor)
+
+    def get_json(self, url, params=None):
+        response = self.client.get(url, params)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_api(self):
+        data = self.get_json(reverse('api_products'), {'q': 'widget', 'page_size': 250})
+        seen = []
+        while True:
+            self.assertEqual(data['count'], 620)
+            seen.extend(row['id'] for row in data['results'])
+            if data['next'] is None:
+                break
+            data = self.get_json(data['next'])
+        self.assertEqual(seen, self.ranked)
+
+        data = self.get_json(data['previous'])
+        self.assertEqual([row['id'] for row in data['results']], self.ranked[250:500])
+
+    def test_sorted_search(self):
+        response = self.client.get(reverse('products'), {'q': 'widget', 'sort': 'name'})
+        self.assertEqual(response.context['total_products'], 620)
+        self.assertEqual(len(response.context['products']), 24)
+
+
+@override_settings(FULL_PAGE_CACHE=True)
+class PageCacheTests(TestCase):
+    """ Pages shared between anonymous visitors hold nothing of theirs """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_catalog(categories=1, products_per_category=1)[0]
+
+    def setUp(self):
+        caches['pages'].clear()
+
+    def test_product_detail_has_no_csrf_token(self):
+        url = reverse('product_detail', args=[self.product.id])
+        first = self.client.get(url)
+        self.assertEqual(first['X-Page-Cache'], 'miss')
+        self.assertContains(first, '<input type="hidden" name="csrfmiddlewaretoken" value="">', html=True)
+        self.assertNotIn(settings.CSRF_COOKIE_NAME, first.cookies)
+
+        second = Client().get(url)
+        self.assertEqual(second['X-Page-Cache'], 'hit')
+        self.assertEqual(second.content, first.content)
+
+        # Each visitor gets their own token from the fragments instead
+        fragments = Client().get(reverse('page_fragments')).json()
+        self.assertTrue(fragments['csrf_token'])
+        self.assertNotIn(fragments['csrf_token'].encode(), first.content)
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, api
 
 urlpatterns = [
     path('', views.all_products, name='products'),
@@ -10,4 +10,7 @@ urlpatterns = [
     path('add/', views.add_product, name='add_product'),
     path('edit/<int:product_id>/', views.edit_product, name='edit_product'),
     path('delete/<int:product_id>/', views.delete_product, name='delete_product'),
+    # Read only JSON catalog for the mobile apps and partners
+    path('api/', api.product_list, name='api_products'),
+    path('api/<int:product_id>/', api.product_detail, name='api_product_detail'),
 ]
@@ -1,85 +1,139 @@
 from django.shortcuts import render, redirect, reverse, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-# Special object used to generate search query
-from django.db.models import Q
-from django.db.models.functions import Lower
+
+from boutique_ado.caching import anonymous_page_cache
 
 from .models import Product, Category
 from .forms import ProductForm
+from . import facets, images
+from .listing import product_listing
+from .pagination import keyset_page, cached_count
 
 
+@anonymous_page_cache
 def all_products(request):
     """ A view to show all products, including sorting and search queries """
 
-    products = Product.objects.all()
-    query = None
-    categories = None
-    sort = None
-    direction = None
-
-    # Checks for a submitted query
-    if request.GET:
-        # Check if sort is in request.GET
-        if 'sort' in request.GET:
-            # if it is, we set it to both sort (which is None) and sortkey 
-            sortkey = request.GET['sort']
-            sort = sortkey
-            # Sets case insensitivity sorting on name
-            # field by setting name to lowercase
-            if sortkey == 'name':
-                # preserves original field name by renaming sortkey to
-                # lower_name in the event the user is sorting by name 
-                sortkey = 'lower_name'
-                # Annotate current list of products with new field
-                products = products.annotate(lower_name=Lower('name'))
-            # Allows categorized products to be sorted by name
-            if sortkey == 'category':
-                sortkey = 'category__name'
-            # Checks to see if direction is ascending or descending
-            if 'direction' in request.GET:
-                direction = request.GET['direction']
-                # Reverses direction if direction is descending
-                if direction == 'desc':
-                    sortkey = f'-{sortkey}'
-            # sorts products using order_by() method
-            products = products.order_by(sortkey)
-
-        # If a category is submitted
-        if 'category' in request.GET:
-            # splits categories into list at the commas
-            categories = request.GET['category'].split(',')
-            # Filters all products whos category name is in list 
-            products = products.filter(category__name__in=categories)
-            # Filter categories down to names in the list
-            categories = Category.objects.filter(name__in=categories)
-        
-        # if 'q' is in the request, assigns variable to submitted value
-        if 'q' in request.GET:
-            query = request.GET['q']
-            # if 'q' not in request, display error and redirect to products
-            if not query:
-                messages.error(request, "You didn't enter any search criteria!")
-                return redirect(reverse('products'))
-            
-            # Allows queries to be filtered based on name OR description
-            # "i" makes queries case insensitive
-            queries = Q(name__icontains=query) | Q(description__icontains=query)
-            products = products.filter(queries)
+    # if 'q' is in the request but empty, display error and redirect to products
+    if 'q' in request.GET and not request.GET['q']:
+        messages.error(request, "You didn't enter any search criteria!")
+        return redirect(reverse('products'))
+
+    # Sorting, category, search and facet filters are
+    # applied the same way as in the catalog API
+    listing = product_listing(request.GET)
+    filters = listing.filters
+
+    # Counts for each facet are added up from counts kept for each
+    # category, price bucket and rating, or counted in the database
+    # for searches and ranges that don't line up with the buckets
+    counts = facets.facet_counts(
+        filters, listing.category_names, listing.search_ids, listing.query)
+
+    # The total is cached per set of filters, so it isn't
+    # recounted for every page of the same listing
+    total_products = cached_count(listing.products, *listing.count_key())
+
+    # Only a single page of products is loaded, starting from the
+    # cursor passed in the after or before GET parameter. Search
+    # results without another sort are paged in order of relevance.
+    page = keyset_page(
+        listing.products, listing.sortkey, listing.descending,
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+        ranked_ids=listing.ranked_ids,
+    )
 
     # Return current sorting methodology to the template
-    current_sorting = f'{sort}_{direction}'
+    current_sorting = f'{listing.sort}_{listing.direction}'
 
     context = {
-        'products': products,
-        'search_term': query,
-        'current_categories': categories,
+        'products': page,
+        'total_products': total_products,
+        'next_page_url': page.next_cursor and _query_url(request, after=page.next_cursor),
+        'previous_page_url': page.previous_cursor and _query_url(request, before=page.previous_cursor),
+        'facets': _facet_context(request, counts, filters, listing.category_names),
+        'filters': filters,
+        'search_term': listing.query,
+        'current_categories': listing.categories,
         'current_sorting': current_sorting,
     }
 
     return render(request, 'products/products.html', context)
 
 
+def _query_url(request, **params):
+    """
+    Build a url for the product listing with the given GET parameters
+    changed, keeping the rest. Parameters set to None are removed, and
+    any page cursor is dropped unless it's one of the changes.
+    """
+    query = request.GET.copy()
+    query.pop('after', None)
+    query.pop('before', None)
+    for name, value in params.items():
+        if value is None:
+            query.pop(name, None)
+        else:
+            query[name] = value
+    return f'{request.path}?{query.urlencode()}'
+
+
+def _facet_context(request, counts, filters, category_names):
+    """
+    Build the facet links shown above the product grid, each with
+    the number of products it would show and a url that applies it
+    """
+    categories = [
+        {
+            'friendly_name': category.friendly_name,
+            'count': counts['category', category.name],
+            'selected': category_names is not None and category.name in category_names,
+            'url': _query_url(request, category=category.name),
+        }
+        for category in Category.objects.order_by('friendly_name')
+        if counts['category', category.name]
+    ]
+
+    price_ranges = []
+    for index, (low, high, label) in enumerate(facets.PRICE_BUCKETS):
+        price_ranges.append({
+            'label': label,
+            'count': counts['price', index],
+            'selected': filters['min_price'] == low and filters['max_price'] == high,
+            'url': _query_url(
+                request,
+                min_price=low and str(low),
+                max_price=high and str(high)),
+        })
+
+    ratings = [
+        {
+            'label': f'{minimum} & up',
+            'count': counts['rating', minimum],
+            'selected': filters['min_rating'] == minimum and filters['max_rating'] is None,
+            'url': _query_url(request, min_rating=str(minimum), max_rating=None),
+        }
+        for minimum in facets.RATING_BUCKETS
+    ]
+
+    return {
+        'categories': categories,
+        'price_ranges': price_ranges,
+        'ratings': ratings,
+        'has_sizes': {
+            'count': counts['has_sizes'],
+            'selected': filters['has_sizes'],
+            'url': _query_url(request, has_sizes=None if filters['has_sizes'] else '1'),
+        },
+        'clear_url': _query_url(
+            request, min_price=None, max_price=None, min_rating=None,
+            max_rating=None, has_sizes=None),
+    }
+
+
+@anonymous_page_cache
 def product_detail(request, product_id):
     """ A view to show individual product details """
 
@@ -108,6 +162,9 @@ def add_product(request):
         if form.is_valid():
             # Store product when calling form.save()
             product = form.save()
+            # Resized copies of the image are built in the background
+            if product.image:
+                images.schedule_derivatives(product.image.name)
             messages.success(request, 'Successfully added product!')
             # Redirect to the detail page of the added
             # product by sending along the product id.
@@ -142,6 +199,9 @@ def edit_product(request, product_id):
         form = ProductForm(request.POST, request.FILES, instance=product)
         if form.is_valid():
             form.save()
+            # Builds resized copies of a new image in the background
+            if 'image' in form.changed_data and product.image:
+                images.schedule_derivatives(product.image.name)
             messages.success(request, 'Successfully updated product!')
             # Redirect to the product detail page using the product id
             return redirect(reverse('product_detail', args=[product.id]))
@@ -1,3 +1,24 @@
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from boutique_ado.testing import QueryBudgetMixin
+from checkout.tests.test_views import make_order
+from products.tests import make_catalog
+
+
+class ProfileViewQueryTests(QueryBudgetMixin, TestCase):
+    """ The profile page stays within its budget in QUERY_BUDGETS """
+
+    @classmethod
+    def setUpTestData(cls):
+        products = make_catalog(categories=1)
+        cls.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+        for index in range(5):
+            make_order(products[index:index + 3], user_profile=cls.user.userprofile)
+
+    def test_profile(self):
+        self.client.force_login(self.user)
+        response = self.assertWithinQueryBudget('/profile/')
+        self.assertEqual(response.status_code, 200)
+        for order in self.user.userprofile.orders.all():
+            self.assertContains(response, order.order_number[:6])
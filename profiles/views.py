@@ -26,7 +26,9 @@ def profile(request):
         form = UserProfileForm(instance=profile)
     # The profile and the related name on the order model are used to
     # get the users orders and we then return those to the template.
-    orders = profile.orders.all()
+    # Line items and their products are prefetched as the order
+    # history lists them for every order.
+    orders = profile.orders.prefetch_related('lineitems__product')
 
     template = 'profiles/profile.html'
     context = {
@@ -40,7 +42,9 @@ def profile(request):
 
 def order_history(request, order_number):
     # Get order
-    order = get_object_or_404(Order, order_number=order_number)
+    order = get_object_or_404(
+        Order.objects.prefetch_related('lineitems__product'),
+        order_number=order_number)
 
     # Message letting user know they are looking at a past order confirmation
     messages.info(request, (
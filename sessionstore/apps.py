@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class SessionstoreConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'sessionstore'
+    verbose_name = 'Sessions'
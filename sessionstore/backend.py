@@ -0,0 +1,269 @@
+import logging
+import zlib
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.sessions.backends.base import CreateError, SessionBase
+from django.core.exceptions import SuspiciousOperation
+from django.db import IntegrityError, router, transaction
+from django.utils import timezone
+
+from .models import StoredSession, SessionValue
+
+logger = logging.getLogger(__name__)
+
+# Encoded values start with a byte saying how the rest is stored
+RAW = b'j'
+COMPRESSED = b'z'
+# Values shorter than this are never worth compressing
+COMPRESS_MIN_LENGTH = 64
+# A save that changes no values only moves the expiry date on if it
+# was last written longer ago than this, so a session saved several
+# times in one request, or on every request, isn't rewritten each time
+EXPIRY_REFRESH = timedelta(minutes=1)
+
+
+def encode_value(serializer, value):
+    """
+    Encode one session value as compact JSON, compressed with zlib when
+    that makes it smaller. A bag with many sized items compresses well.
+    """
+    raw = serializer.dumps(value)
+    if len(raw) >= COMPRESS_MIN_LENGTH:
+        compressed = zlib.compress(raw)
+        if len(compressed) < len(raw):
+            return COMPRESSED + compressed
+    return RAW + raw
+
+
+def decode_value(serializer, data):
+    """ Decode a value written by encode_value """
+    data = bytes(data)
+    if data[:1] == COMPRESSED:
+        return serializer.loads(zlib.decompress(data[1:]))
+    if data[:1] == RAW:
+        return serializer.loads(data[1:])
+    raise SuspiciousOperation('Session value has an unknown encoding')
+
+
+class SessionStore(SessionBase):
+    """
+    Database session store that keeps each key of a session separately
+    and only writes the keys that changed. Adding a message, or changing
+    the cart id, rewrites that one value rather than the whole session.
+
+    Changes are found by comparing each value's encoding with the one
+    last read or written, so values changed in place are saved too, and
+    however many times a session is changed during a request it is
+    written once, by SessionMiddleware, with the overall difference.
+    """
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        # Encoded values as they are in the database, for the
+        # session key in _stored_key, and when it expires
+        self._stored = {}
+        self._stored_key = None
+        self._stored_expiry = None
+
+    @classmethod
+    def get_model_class(cls):
+        return StoredSession
+
+    def _remember(self, session_key, encoded, expire_date):
+        self._stored = encoded
+        self._stored_key = session_key
+        self._stored_expiry = expire_date
+
+    def load(self):
+        serializer = self.serializer()
+        # One query reads every value, and checks the session hasn't expired
+        rows = list(SessionValue.objects.filter(
+            session_id=self.session_key,
+            session__expire_date__gt=timezone.now(),
+        ).values_list('key', 'data', 'session__expire_date'))
+
+        if not rows:
+            # Sessions are never saved empty, so no values means the
+            # session has expired or never existed
+            return self._load_legacy()
+
+        encoded = {key: bytes(data) for key, data, _ in rows}
+        self._remember(self.session_key, encoded, rows[0][2])
+        session = {}
+        for key, data in encoded.items():
+            try:
+                session[key] = decode_value(serializer, data)
+            except Exception as e:
+                # A value that can't be read is left out, and is
+                # removed from the database when the session is saved
+                logger.warning('Skipping unreadable session value %r: %s', key, e)
+        return session
+
+    def _load_legacy(self):
+        """
+        Read a session saved by Django's database backend before this
+        one was used, so visitors keep their login and cart. It's
+        written here in full the next time it's saved.
+        """
+        session_key = self.session_key
+        if session_key is not None and apps.is_installed('django.contrib.sessions'):
+            from django.contrib.sessions.backends.db import SessionStore as LegacyStore
+            session = LegacyStore(session_key).load()
+            if session:
+                self.modified = True
+                return session
+        self._session_key = None
+        return {}
+
+    def exists(self, session_key):
+        return StoredSession.objects.filter(session_key=session_key).exists()
+
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                # Save immediately to ensure we have a unique entry in the
+                # database.
+                self.save(must_create=True)
+            except CreateError:
+                # Key wasn't unique. Try again.
+                continue
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        """
+        Write the values that changed since the session was loaded or
+        last saved. If must_create is True, raise CreateError if a
+        session with this key already exists.
+        """
+        if self.session_key is None:
+            return self.create()
+        session_key = self.session_key
+        data = self._get_session(no_load=must_create)
+        serializer = self.serializer()
+        encoded = {key: encode_value(serializer, value) for key, value in data.items()}
+        expire_date = self.get_expiry_date()
+
+        stored = self._stored if self._stored_key == session_key and not must_create else {}
+        changed = [key for key, value in encoded.items() if stored.get(key) != value]
+        removed = [key for key in stored if key not in encoded]
+
+        recently_written = (
+            self._stored_key == session_key and self._stored_expiry is not None
+            and expire_date - self._stored_expiry < EXPIRY_REFRESH
+        )
+        if not must_create and not changed and not removed and recently_written:
+            return
+
+        using = router.db_for_write(StoredSession)
+        with transaction.atomic(using=using):
+            if must_create:
+                try:
+                    with transaction.atomic(using=using):
+                        StoredSession.objects.using(using).create(
+                            session_key=session_key, expire_date=expire_date)
+                except IntegrityError:
+                    raise CreateError
+            else:
+                updated = StoredSession.objects.using(using).filter(
+                    session_key=session_key).update(expire_date=expire_date)
+                if not updated:
+                    # The session was deleted, has only been loaded from
+                    # the legacy table, or expired and was swept since
+                    # it was loaded, so it's written again in full
+                    stored = {}
+                    changed = list(encoded)
+                    removed = []
+                    try:
+                        with transaction.atomic(using=using):
+                            StoredSession.objects.using(using).create(
+                                session_key=session_key, expire_date=expire_date)
+                    except IntegrityError:
+                        # Another request wrote it again first, so its
+                        # values are overwritten with these
+                        StoredSession.objects.using(using).filter(
+                            session_key=session_key).update(expire_date=expire_date)
+                    else:
+                        SessionValue.objects.using(using).filter(session_id=session_key).delete()
+
+            if removed:
+                SessionValue.objects.using(using).filter(
+                    session_id=session_key, key__in=removed).delete()
+            if changed:
+                _write_values(using, session_key, {key: encoded[key] for key in changed}, stored)
+        self._remember(session_key, encoded, expire_date)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        delete_sessions([session_key])
+        if session_key == self._stored_key:
+            self._remember(None, {}, None)
+
+    @classmethod
+    def clear_expired(cls):
+        for _ in sweep_expired():
+            pass
+
+
+def _write_values(using, session_key, values, stored):
+    """
+    Write a session's changed values, updating the keys it's known to
+    have and inserting the rest together. Another request saving the
+    same session may insert one of those keys first, in which case
+    each is written again as an update, so the last save wins rather
+    than failing.
+    """
+    session_values = SessionValue.objects.using(using).filter(session_id=session_key)
+    new = {}
+    for key, data in values.items():
+        if key not in stored or not session_values.filter(key=key).update(data=data):
+            new[key] = data
+    if not new:
+        return
+    try:
+        with transaction.atomic(using=using):
+            SessionValue.objects.using(using).bulk_create([
+                SessionValue(session_id=session_key, key=key, data=data)
+                for key, data in new.items()
+            ])
+    except IntegrityError:
+        for key, data in new.items():
+            if not session_values.filter(key=key).update(data=data):
+                SessionValue.objects.using(using).create(
+                    session_id=session_key, key=key, data=data)
+
+
+def delete_sessions(session_keys):
+    """ Delete sessions and their values in one transaction """
+    using = router.db_for_write(StoredSession)
+    with transaction.atomic(using=using):
+        SessionValue.objects.using(using).filter(session_id__in=session_keys).delete()
+        return StoredSession.objects.using(using).filter(session_key__in=session_keys).delete()[0]
+
+
+def sweep_expired(model=StoredSession, batch_size=1000):
+    """
+    Delete expired sessions a batch at a time, each in its own short
+    transaction, yielding the number deleted by each batch. Batches are
+    found through the expiry date index, oldest first, so stopping part
+    way leaves the rest for the next sweep. model may also be Django's
+    own Session model, to clear the table this backend replaced.
+    """
+    now = timezone.now()
+    while True:
+        session_keys = list(
+            model.objects.filter(expire_date__lt=now)
+            .order_by('expire_date')
+            .values_list('session_key', flat=True)[:batch_size]
+        )
+        if not session_keys:
+            return
+        if model is StoredSession:
+            yield delete_sessions(session_keys)
+        else:
+            yield model.objects.filter(session_key__in=session_keys).delete()[0]
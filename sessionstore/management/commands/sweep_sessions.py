@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from sessionstore.backend import sweep_expired
+from sessionstore.models import StoredSession
+
+
+class Command(BaseCommand):
+    help = ('Delete expired sessions in small batches, each in its own '
+            'transaction, so a large table can be cleared without long '
+            'locks. Use it in place of clearsessions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of sessions deleted per batch')
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Seconds to wait between batches, to let other writes through')
+        parser.add_argument(
+            '--max-seconds', type=float, default=None,
+            help='Stop after this long, leaving the rest for the next run')
+        parser.add_argument(
+            '--legacy', action='store_true',
+            help="Also sweep Django's own session table, used before this backend")
+
+    def handle(self, *args, **options):
+        models = [StoredSession]
+        if options['legacy']:
+            from django.contrib.sessions.models import Session
+            models.append(Session)
+
+        start = time.perf_counter()
+        deadline = None
+        if options['max_seconds'] is not None:
+            deadline = start + options['max_seconds']
+
+        for model in models:
+            deleted = 0
+            batches = 0
+            finished = True
+            for count in sweep_expired(model, batch_size=options['batch_size']):
+                deleted += count
+                batches += 1
+                if deadline is not None and time.perf_counter() >= deadline:
+                    finished = False
+                    break
+                if options['pause']:
+                    time.sleep(options['pause'])
+            self.stdout.write(
+                f'{model._meta.label}: deleted {deleted} expired sessions '
+                f'in {batches} batches{"" if finished else ", stopped early"}')
+            if not finished:
+                break
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'Swept sessions in {elapsed:.2f}s'))
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.23 on 2026-10-18 12:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredSession',
+            fields=[
+                ('session_key', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('expire_date', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SessionValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('data', models.BinaryField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='values', to='sessionstore.storedsession')),
+            ],
+            options={
+                'unique_together': {('session', 'key')},
+            },
+        ),
+    ]
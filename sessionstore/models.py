@@ -0,0 +1,32 @@
+from django.db import models
+
+
+class StoredSession(models.Model):
+    """
+    A session stored by sessionstore.backend. Its data is kept
+    in a SessionValue for each key, so that changing one key
+    doesn't mean rewriting the others.
+    """
+    session_key = models.CharField(max_length=40, primary_key=True)
+    # Indexed so expired sessions can be found and deleted in batches
+    expire_date = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.session_key
+
+
+class SessionValue(models.Model):
+    """ The encoded value of one key in a session """
+
+    class Meta:
+        unique_together = ('session', 'key')
+
+    # Values are always deleted before their session, in the same
+    # transaction, so deleting sessions doesn't have to look them up
+    session = models.ForeignKey(
+        StoredSession, on_delete=models.DO_NOTHING, related_name='values')
+    key = models.CharField(max_length=255)
+    data = models.BinaryField()
+
+    def __str__(self):
+        return f'{self.key} in {self.session_id}'
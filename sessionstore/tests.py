@@ -0,0 +1,49 @@
+from django.test import TestCase
+
+from .backend import SessionStore, delete_sessions
+from .models import SessionValue
+
+
+class SessionStoreConcurrentSaveTests(TestCase):
+    """ Saves from two requests holding the same session """
+
+    def setUp(self):
+        session = SessionStore()
+        session['cart_id'] = 1
+        session.create()
+        self.session_key = session.session_key
+
+    def _stored_value(self, key):
+        session = SessionStore(self.session_key)
+        return session[key]
+
+    def test_both_requests_add_the_same_key(self):
+        first = SessionStore(self.session_key)
+        second = SessionStore(self.session_key)
+        # Reading a value loads each session as a request would
+        first['cart_id']
+        second['cart_id']
+
+        first['_messages'] = 'first'
+        first.save()
+        second['_messages'] = 'second'
+        second.save()
+
+        self.assertEqual(self._stored_value('_messages'), 'second')
+        self.assertEqual(SessionValue.objects.filter(
+            session_id=self.session_key, key='_messages').count(), 1)
+
+    def test_both_requests_write_a_deleted_session_again(self):
+        first = SessionStore(self.session_key)
+        second = SessionStore(self.session_key)
+        first['cart_id']
+        second['cart_id']
+        delete_sessions([self.session_key])
+
+        first['cart_id'] = 2
+        first.save()
+        second['cart_id'] = 3
+        second.save()
+
+        self.assertEqual(self._stored_value('cart_id'), 3)
+